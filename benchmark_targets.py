@@ -0,0 +1,79 @@
+'''
+Times peer_mean and gated_ensemble of models/branches.py against the per-branch
+loops they replaced in the ONE / CL-ILR models, and checks that both agree.
+
+Example:
+```
+python benchmark_targets.py --num_branches 3 8 16
+```
+'''
+import argparse
+import time
+
+import torch
+import torch.nn.functional as F
+
+from models.branches import peer_mean, gated_ensemble
+
+parser = argparse.ArgumentParser(description='Time peer_mean and gated_ensemble against the former loops')
+parser.add_argument('--batch_size', default=128, type=int,
+                    help='Input the batch size: default(128)')
+parser.add_argument('--num_classes', default=100, type=int,
+                    help='Input the number of classes: default(100)')
+parser.add_argument('--num_branches', default=[3, 8, 16], type=int, nargs='+',
+                    help='Input the numbers of branches: default(3 8 16)')
+parser.add_argument('--repeat', default=100, type=int,
+                    help='Input the number of timed calls: default(100)')
+parser.add_argument('--device', default='cpu', type=str,
+                    help='Input the device: default(cpu)')
+
+
+def loop_peer_mean(pro):
+    """The former CL-ILR target: a nested loop over the branches growing the result with torch.cat."""
+    num_branches = pro.size(-1)
+    x_m = 0
+    for i in range(1, num_branches):
+        x_m += 1/(num_branches-1) * pro[:, :, i]
+    x_m = x_m.unsqueeze(-1)
+    for i in range(1, num_branches):
+        temp = 0
+        for j in range(0, num_branches):
+            if j != i:
+                temp += 1/(num_branches-1) * pro[:, :, j]
+        x_m = torch.cat([x_m, temp.unsqueeze(-1)], -1)
+    return x_m
+
+
+def loop_gated_ensemble(pro, gate):
+    """The former ONE target: one repeated gate column per branch."""
+    x_m = gate[:, 0].view(-1, 1).repeat(1, pro[:, :, 0].size(1)) * pro[:, :, 0]
+    for i in range(1, pro.size(-1)):
+        x_m += gate[:, i].view(-1, 1).repeat(1, pro[:, :, i].size(1)) * pro[:, :, i]
+    return x_m
+
+
+def mean_time(fn, inputs, repeat=100):
+    """Mean seconds per call of fn(*inputs), after a warm-up."""
+    for _ in range(10):
+        fn(*inputs)
+    if inputs[0].is_cuda:
+        torch.cuda.synchronize()
+    begin = time.perf_counter()
+    for _ in range(repeat):
+        fn(*inputs)
+    if inputs[0].is_cuda:
+        torch.cuda.synchronize()
+    return (time.perf_counter() - begin) / repeat
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    for num_branches in args.num_branches:
+        pro = torch.randn(args.batch_size, args.num_classes, num_branches, device=args.device)
+        gate = F.softmax(torch.randn(args.batch_size, num_branches, device=args.device), dim=1)
+        for name, fn, loop, inputs in [('peer_mean', peer_mean, loop_peer_mean, (pro,)),
+                                       ('gated_ensemble', gated_ensemble, loop_gated_ensemble, (pro, gate))]:
+            diff = (fn(*inputs) - loop(*inputs)).abs().max().item()
+            before, after = mean_time(loop, inputs, args.repeat), mean_time(fn, inputs, args.repeat)
+            print('{:<15s} N={:<3d} loop {:8.1f}us  closed form {:8.1f}us  speedup {:5.1f}x  max abs diff {:.3g}'.format(
+                name, num_branches, before * 1e6, after * 1e6, before / after, diff))
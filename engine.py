@@ -0,0 +1,865 @@
+'''
+Training engine shared by train.py, train_kd.py, train_GL.py, train_one.py and train_DML.py.
+
+Trainer owns everything the methods have in common: the epoch loop with
+prefetching, the optimizer and learning rate schedule, micro-batching,
+metric accumulation without host-device synchronization, TensorBoard logging,
+resuming and checkpointing. A Strategy owns what differs between the methods:
+the loss of one batch, the names of the metrics and the test metric that
+selects best.pth.
+
+    strategy = engine.GL(args)
+    trainer = engine.Trainer(model, strategy, model_dir, args, device)
+    trainer.fit(train_loader, test_loader)
+
+Launched by torchrun (e.g. `torchrun --nproc_per_node 4 train_GL.py ...`),
+every process trains a DistributedDataParallel replica on its own part of the
+data (nccl on GPUs, gloo on CPUs), --batch_size is the global batch size,
+metrics are summed over all processes and only rank 0 writes checkpoints,
+TensorBoard logs and train.log (the other ranks write train_rank<k>.log).
+With branch_parallel the GL model is split over the processes instead (see
+models.branches.BranchParallel) and every process reads the whole batch.
+
+With --micro_batch every batch is split into micro-batches whose gradients are
+accumulated, so one optimizer step still sees the whole --batch_size (the
+BatchNorm statistics of a step are those of its micro-batches). --micro_batch
+auto measures the device memory of the first batches and picks the largest
+micro-batch within --memory_budget, with --auto_checkpoint it first tries to
+fit the whole batch by checkpointing the activations of the model.
+'''
+import contextlib
+import logging
+import math
+import os
+import shutil
+import time
+from collections import OrderedDict
+import numpy as np
+
+import torch
+import torch.distributed as dist
+import torch.nn as nn
+import torch.optim as optim
+from torch.nn.parallel import DistributedDataParallel
+from torch.optim.lr_scheduler import MultiStepLR
+from tqdm import tqdm
+import utils
+import models
+import models.data_loader as data_loader
+from models.branches import BranchParallel, enable_checkpointing
+from torch.utils.tensorboard import SummaryWriter
+
+__all__ = ['init_device', 'get_rank', 'get_world_size', 'is_main', 'barrier',
+           'add_common_args', 'setup', 'load_data', 'amp_dtype', 'to_device', 'finish', 'Trainer',
+           'Strategy', 'Baseline', 'KD', 'GL', 'ONE', 'DML']
+
+# number of classes and model package of every dataset
+DATASETS = {'CIFAR10': (10, 'model_cifar'),
+            'CIFAR100': (100, 'model_cifar'),
+            'imagenet': (1000, 'model_imagenet')}
+
+
+def init_device():
+    """Returns the device of this process, joining the process group when launched by torchrun."""
+    if int(os.environ.get('WORLD_SIZE', 1)) > 1 and not dist.is_initialized():
+        if torch.cuda.is_available():
+            local_rank = int(os.environ.get('LOCAL_RANK', 0))
+            torch.cuda.set_device(local_rank)
+            dist.init_process_group('nccl')
+            return torch.device('cuda', local_rank)
+        dist.init_process_group('gloo')
+        return torch.device('cpu')
+    if dist.is_initialized() and torch.cuda.is_available():
+        return torch.device('cuda', torch.cuda.current_device())
+    return torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+
+def get_rank():
+    return dist.get_rank() if dist.is_initialized() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if dist.is_initialized() else 1
+
+
+def is_main():
+    """True in the process that writes checkpoints and logs (rank 0)."""
+    return get_rank() == 0
+
+
+def barrier():
+    if dist.is_initialized():
+        dist.barrier()
+
+
+def micro_batch_arg(value):
+    """Parses --micro_batch: a number of samples or 'auto'."""
+    return value if value == 'auto' else int(value)
+
+
+def add_common_args(parser):
+    """Adds the options shared by all training scripts to `parser`."""
+    parser.add_argument('--dataset', default='CIFAR10', type=str,
+                        help='Input the name of dataset: default(CIFAR10)')
+    parser.add_argument('--num_epochs', default=300, type=int,
+                        help='Input the number of epoches: default(300)')
+    parser.add_argument('--batch_size', default=128, type=int,
+                        help='Input the batch size: default(128)')
+    parser.add_argument('--lr', default=0.1, type=float,
+                        help='Input the learning rate: default(0.1)')
+    parser.add_argument('--schedule', type=int, nargs='+', default=[150, 225],
+                        help='Decrease learning rate at these epochs.')
+    parser.add_argument('--efficient', action='store_true',
+                        help='Decide whether or not to use efficient implementation(only of densenet): default(False)')
+    parser.add_argument('--wd', default=5e-4, type=float,
+                        help='Input the weight decay rate: default(5e-4)')
+    parser.add_argument('--dropout', default=0., type=float,
+                        help='Input the dropout rate: default(0.0)')
+    parser.add_argument('--resume', default='', type=str,
+                        help='Input the path of resume model: default('')')
+    parser.add_argument('--version', default='V0', type=str,
+                        help='Input the version of current model: default(V0)')
+    parser.add_argument('--num_workers', default=8, type=int,
+                        help='Input the number of works: default(8)')
+    parser.add_argument('--log_interval', default=0, type=int,
+                        help='Show the running loss every log_interval steps, 0 only at epoch end: default(0)')
+    parser.add_argument('--in_memory', action='store_true',
+                        help='Decide whether or not to keep CIFAR in memory and augment whole batches on the device: default(False)')
+    parser.add_argument('--shards', default='', type=str,
+                        help='Input the directory of ImageNet shards packed by models.shards: default('')')
+    parser.add_argument('--eval_cache', default='', type=str,
+                        help='Input the directory to cache the preprocessed test set in: default('')')
+    parser.add_argument('--compile', action='store_true',
+                        help='Decide whether or not to compile the model with torch.compile: default(False)')
+    parser.add_argument('--amp', default='off', choices=['off', 'fp16', 'bf16'],
+                        help='Input the mixed precision mode, fp16 uses a gradient scaler: default(off)')
+    parser.add_argument('--micro_batch', default=0, type=micro_batch_arg,
+                        help='Input the number of samples per forward/backward pass, auto measures the largest one within --memory_budget, 0 runs the whole batch: default(0)')
+    parser.add_argument('--memory_budget', default=0.9, type=float,
+                        help='Input the fraction of the free device memory --micro_batch auto may use: default(0.9)')
+    parser.add_argument('--auto_checkpoint', action='store_true',
+                        help='Decide whether or not to checkpoint the activations instead of splitting the batch when it does not fit --memory_budget: default(False)')
+    parser.add_argument('--gpu_id', default='0', type=str,
+                        help='id(s) for CUDA_VISIBLE_DEVICES')
+
+
+def setup(model_dir):
+    """Creates `model_dir` and logs to `model_dir/train.log` (train_rank<k>.log on the other ranks)."""
+    if not os.path.exists(model_dir):
+        print("Directory does not exist! Making directory {}".format(model_dir))
+        os.makedirs(model_dir, exist_ok=True)
+    if is_main():
+        utils.set_logger(os.path.join(model_dir, 'train.log'))
+    else:
+        utils.set_logger(os.path.join(model_dir, 'train_rank%d.log' % get_rank()), console=False)
+
+
+def load_data(args, device, root='./Data', **kwargs):
+    """Returns the number of classes, the model package and the train and test loaders of args.dataset.
+
+    Args:
+        args: (Namespace) the options of add_common_args
+        device: (torch.device) where the batches are needed
+        root: (string) the dataset directory
+        kwargs: further options of data_loader.dataloader (e.g. seed, replay)
+    """
+    logging.info("Loading the datasets...")
+    num_classes, model_folder = DATASETS[args.dataset]
+    # branch-parallel processes all read the same batches
+    world_size = 1 if getattr(args, 'branch_parallel', False) else get_world_size()
+    rank = get_rank() if world_size > 1 else 0
+    if world_size > 1 and kwargs.get('seed') is None:
+        # all processes shuffle with the same seed
+        seed = torch.randint(2**31, (1,), device=device)
+        dist.broadcast(seed, 0)
+        kwargs['seed'] = int(seed.item())
+    # rank 0 builds the test set cache, the other ranks then only load it
+    if args.eval_cache and not is_main():
+        barrier()
+    train_loader, test_loader = data_loader.dataloader(
+        data_name=args.dataset, batch_size=args.batch_size // world_size, num_workers=args.num_workers,
+        root=root, in_memory=args.in_memory, device=device, shards=args.shards,
+        eval_cache=args.eval_cache, rank=rank, num_replicas=world_size, **kwargs)
+    if args.eval_cache and is_main():
+        barrier()
+    logging.info("- Done.")
+    return num_classes, getattr(models, model_folder), train_loader, test_loader
+
+
+def amp_dtype(args):
+    """The autocast dtype of args.amp, None when off."""
+    return {'off': None, 'fp16': torch.float16, 'bf16': torch.bfloat16}[getattr(args, 'amp', 'off')]
+
+
+def to_device(model, device, find_unused_parameters=False, branch_parallel=False):
+    """Moves `model` to `device` and logs its size.
+
+    Under torchrun the model becomes a DistributedDataParallel replica, or with
+    branch_parallel a BranchParallel part; in a single process it is spread
+    over all visible GPUs with DataParallel.
+
+    Args:
+        model: (nn.Module) the network
+        device: (torch.device) the device of this process
+        find_unused_parameters: (bool) some parameters get no gradient in some
+            configurations (e.g. the ONE gate with --ind)
+        branch_parallel: (bool) split the branches of a GL model over the processes
+
+    Returns:
+        the model and its number of parameters in millions
+    """
+    num_params = (sum(p.numel() for p in model.parameters())/1000000.0)
+    if branch_parallel:
+        if not dist.is_initialized():
+            raise ValueError('branch parallelism needs several processes, launch with torchrun')
+        model = BranchParallel(model.to(device))
+        logging.info('- Branches {} of {}, {:.2f}M params on this rank'.format(
+            model.owned, model.module.num_branches,
+            sum(p.numel() for p in model.parameters())/1000000.0))
+    elif dist.is_initialized():
+        model = model.to(device)
+        device_ids = [device] if device.type == 'cuda' else None
+        model = DistributedDataParallel(model, device_ids=device_ids,
+                                        find_unused_parameters=find_unused_parameters)
+    elif torch.cuda.device_count() > 1:
+        model = nn.DataParallel(model).to(device)
+    else:
+        model = model.to(device)
+
+    logging.info('Total params: %.2fM' % num_params)
+    return model, num_params
+
+
+def finish(state, num_params, model_dir, begin_time):
+    """Logs the total time and saves the options of the run in `model_dir/parameters.json`."""
+    logging.info('Total time: {:.2f} hours'.format(
+        (time.time() - begin_time)/3600.0))
+    if is_main():
+        state['Total params'] = num_params
+        params_json_path = os.path.join(
+            model_dir, "parameters.json")  # save parameters
+        utils.save_dict_to_json(state, params_json_path)
+    if dist.is_initialized():
+        dist.destroy_process_group()
+
+
+class Trainer():
+    """Trains `model` with `strategy` and keeps last.pth and best.pth in `model_dir`.
+
+    Example:
+    ```
+    trainer = Trainer(model, Baseline(args), model_dir, args, device)
+    trainer.fit(train_loader, test_loader)
+    ```
+
+    Args:
+        model: (nn.Module) the network, already on `device`
+        strategy: (Strategy) the loss and the metrics of the method
+        model_dir: (string) where checkpoints, metrics and TensorBoard logs are written
+        args: (Namespace) lr, wd, schedule, num_epochs, resume, log_interval, compile, amp,
+            micro_batch, memory_budget and auto_checkpoint
+        device: (torch.device) where the batches are needed
+    """
+
+    def __init__(self, model, strategy, model_dir, args, device):
+        self.model = model
+        # the compiled module shares the parameters, checkpoints keep using `model`
+        self.net = torch.compile(model) if args.compile else model
+        self.distributed = isinstance(model, DistributedDataParallel)
+        self.branch_parallel = isinstance(model, BranchParallel)
+        # every rank evaluates its own part of the test set, without DDP collectives
+        self.eval_net = model.module if self.distributed else self.net
+        self.strategy = strategy
+        self.model_dir = model_dir
+        self.args = args
+        self.device = device
+        # None until --micro_batch auto has measured the first batch
+        self.micro_batch = getattr(args, 'micro_batch', 0)
+        if self.micro_batch == 'auto':
+            self.micro_batch = None
+
+        # SGD with 0.9 momentum and a step schedule for all methods
+        self.optimizer = optim.SGD(model.parameters(), lr=args.lr,
+                                   momentum=0.9, nesterov=True, weight_decay=args.wd)
+        self.scheduler = MultiStepLR(self.optimizer, milestones=args.schedule, gamma=0.1)
+
+        # mixed precision: the forward and the losses run under autocast, fp16 scales the loss
+        self.amp_dtype = amp_dtype(args)
+        if self.amp_dtype == torch.float16 and self.branch_parallel:
+            # every rank would skip steps on its own overflows
+            raise ValueError('use --amp bf16 with branch parallelism')
+        self.scaler = torch.amp.GradScaler(device.type, enabled=self.amp_dtype == torch.float16)
+        self.writers = {}
+
+    def _log(self, meters, phase, end):
+        for meter in meters.values():
+            meter.all_reduce()
+        values = OrderedDict((k, meter.value()) for k, meter in meters.items())
+        metrics = self.strategy.metrics(values, phase)
+        metrics['time'] = time.time() - end
+
+        metrics_string = " ; ".join("{}: {:05.3f}".format(k, v)
+                                    for k, v in metrics.items())
+        logging.info("- {} metrics: ".format(phase.capitalize()) + metrics_string)
+        return metrics
+
+    def _autocast(self):
+        return torch.autocast(self.device.type, dtype=self.amp_dtype, enabled=self.amp_dtype is not None)
+
+    def _batch(self, batch):
+        if not self.branch_parallel:
+            return batch
+        # all ranks compute the loss of rank 0's batch
+        labels = batch[1].clone()
+        dist.broadcast(labels, 0)
+        return (batch[0], labels) + tuple(batch[2:])
+
+    @staticmethod
+    def _split(batch, size):
+        """Splits every tensor of `batch` into chunks of `size` samples (the whole batch if size is 0)."""
+        if not size or size >= batch[0].size(0):
+            return [batch]
+        return list(zip(*(b.split(size) for b in batch)))
+
+    def _peak_memory(self, batch, size):
+        """Peak device memory of one training forward and backward over the first `size` samples of `batch`."""
+        # DDP would all-reduce the gradients of the probe
+        net = self.model.module if self.distributed else self.model
+        buffers = [b.clone() for b in self.model.buffers()]
+        torch.cuda.synchronize(self.device)
+        torch.cuda.reset_peak_memory_stats(self.device)
+        with self._autocast():
+            loss, _ = self.strategy.forward(net, tuple(b[:size] for b in batch), training=True)
+        self.scaler.scale(loss).backward()
+        torch.cuda.synchronize(self.device)
+        peak = torch.cuda.max_memory_allocated(self.device)
+        # the probe must not train the model
+        self.optimizer.zero_grad()
+        for b, value in zip(self.model.buffers(), buffers):
+            b.copy_(value)
+        return peak
+
+    def _fit_memory(self, batch):
+        """The largest micro-batch whose forward and backward fit args.memory_budget, from two probes."""
+        size = batch[0].size(0)
+        free = torch.cuda.mem_get_info(self.device)[0]
+        budget = torch.cuda.memory_allocated(self.device) + self.args.memory_budget * free
+        # peak memory grows linearly with the samples of the micro-batch
+        small, large = max(1, size // 8), max(2, size // 4)
+        peak_small, peak_large = self._peak_memory(batch, small), self._peak_memory(batch, large)
+        per_sample = max(peak_large - peak_small, 1) / (large - small)
+        fits = min(max(int((budget - peak_small) / per_sample) + small, 1), size)
+        if dist.is_initialized():
+            # every process must make the same choices and step at the same micro-batches
+            fits = torch.tensor([fits], device=self.device)
+            dist.all_reduce(fits, dist.ReduceOp.MIN)
+            fits = int(fits.item())
+        return fits
+
+    def _measure(self, batch):
+        """Resolves --micro_batch auto on the first training batch."""
+        size = batch[0].size(0)
+        if self.device.type != 'cuda' or size < 2:
+            logging.info('- No device memory to measure, micro-batching off')
+            return 0
+        micro_batch = self._fit_memory(batch)
+        # checkpointing keeps the BatchNorm statistics of the whole batch
+        module = self.model.module if hasattr(self.model, 'module') else self.model
+        for policy in ('branches', 'all'):
+            if micro_batch >= size or not self.args.auto_checkpoint:
+                break
+            if not enable_checkpointing(module, policy):
+                logging.info('- {} has no activation checkpointing'.format(type(module).__name__))
+                break
+            logging.info('- Checkpointing {}'.format(policy))
+            micro_batch = self._fit_memory(batch)
+        # micro-batches of equal size
+        micro_batch = math.ceil(size / math.ceil(size / micro_batch))
+        logging.info('- Micro-batch {} of {} samples'.format(micro_batch, size))
+        return 0 if micro_batch >= size else micro_batch
+
+    @staticmethod
+    def _update(meters, logs, n):
+        # every statistic is the mean over the n samples of the batch
+        for k, v in logs.items():
+            if k not in meters:
+                meters[k] = utils.MetricAccumulator()
+            meters[k].update(v, n)
+
+    def train(self, train_loader):
+        """Runs one epoch over `train_loader` and returns the train metrics."""
+        # set model to training mode
+        self.model.train()
+
+        # one running average per statistic of Strategy.forward
+        meters = OrderedDict()
+        end = time.time()
+        self.optimizer.zero_grad()
+
+        # ranks may run out of batches at different steps (e.g. ShardedStream)
+        join = self.model.join() if self.distributed else contextlib.nullcontext()
+
+        # Use tqdm for progress bar
+        with tqdm(total=len(train_loader), disable=not is_main()) as t, join:
+            for batch in train_loader:
+                batch = self._batch(batch)
+                if self.micro_batch is None:
+                    self.micro_batch = self._measure(batch)
+                chunks = self._split(batch, self.micro_batch)
+                for j, chunk in enumerate(chunks):
+                    n = chunk[0].size(0)
+                    # gradients are only all-reduced on the last micro-batch
+                    last = j == len(chunks) - 1
+                    no_sync = self.model.no_sync() if self.distributed and not last else contextlib.nullcontext()
+                    with no_sync:
+                        # compute model output and loss
+                        with self._autocast():
+                            loss, logs = self.strategy.forward(self.net, chunk, training=True)
+                        self._update(meters, logs, n)
+
+                        # the accumulated gradient is the one of the mean loss over the batch
+                        self.scaler.scale(loss * (n / batch[0].size(0))).backward()
+
+                # performs updates using the gradients of the whole batch
+                if self.branch_parallel:
+                    self.model.reduce_gradients()
+                self.scaler.step(self.optimizer)
+                self.scaler.update()
+                self.optimizer.zero_grad()
+
+                t.update()
+                # reading the running loss synchronizes with the device
+                if self.args.log_interval and t.n % self.args.log_interval == 0:
+                    t.set_postfix(loss='{:05.3f}'.format(meters['loss'].value()))
+
+        return self._log(meters, 'train', end)
+
+    def evaluate(self, test_loader):
+        """Runs one pass over `test_loader` and returns the test metrics."""
+        # set model to evaluation mode
+        self.model.eval()
+        meters = OrderedDict()
+        end = time.time()
+
+        with torch.no_grad(), self._autocast():
+            for batch in test_loader:
+                batch = self._batch(batch)
+                _, logs = self.strategy.forward(self.eval_net, batch, training=False)
+                self._update(meters, logs, batch[0].size(0))
+
+        return self._log(meters, 'test', end)
+
+    def _writer(self, name):
+        if name not in self.writers:
+            log_dir = os.path.join(self.model_dir, name) if name else self.model_dir
+            self.writers[name] = SummaryWriter(log_dir=log_dir)
+        return self.writers[name]
+
+    def _resume(self):
+        logging.info('Resuming from checkpoint..')
+        resumePath = os.path.join(self.args.resume, 'last.pth')
+        assert os.path.isfile(
+            resumePath), 'Error: no checkpoint directory found!'
+
+        checkpoint = torch.load(resumePath, map_location=self.device)
+        self.model.load_state_dict(checkpoint['state_dict'])
+        optim_dict = checkpoint['optim_dict']
+        if self.branch_parallel:
+            # one optimizer state per rank
+            if not isinstance(optim_dict, list) or len(optim_dict) != get_world_size():
+                raise ValueError('{} was not written by {} branch-parallel processes'.format(
+                    resumePath, get_world_size()))
+            optim_dict = optim_dict[get_rank()]
+        self.optimizer.load_state_dict(optim_dict)
+        # resume from the last epoch
+        start_epoch = checkpoint['epoch']
+        if 'scaler_dict' in checkpoint and self.scaler.is_enabled():
+            self.scaler.load_state_dict(checkpoint['scaler_dict'])
+        if 'sched_dict' in checkpoint:
+            self.scheduler.load_state_dict(checkpoint['sched_dict'])
+        else:
+            # checkpoints of the per-script loops have no scheduler state
+            self.scheduler.step(start_epoch)
+        best_acc = checkpoint[self.strategy.best]
+        result_train_metrics = torch.load(
+            os.path.join(self.args.resume, 'train_metrics'))
+        result_test_metrics = torch.load(
+            os.path.join(self.args.resume, 'test_metrics'))
+        # the run may be resumed with more epochs
+        for results in (result_train_metrics, result_test_metrics):
+            results.extend(range(len(results), self.args.num_epochs))
+        return start_epoch, best_acc, result_train_metrics, result_test_metrics
+
+    def fit(self, train_loader, test_loader):
+        """Trains for args.num_epochs, evaluating and checkpointing after every epoch.
+
+        Args:
+            train_loader, test_loader: (iterable) yield (images, labels, ...) batches
+        """
+        args = self.args
+        # overlap the host-to-device copy of the next batch with the current step
+        train_loader = self.strategy.wrap(data_loader.Prefetcher(train_loader, self.device))
+        test_loader = data_loader.Prefetcher(test_loader, self.device)
+
+        start_epoch = 0
+        best_acc = 0.
+
+        # Save the parameters for export
+        result_train_metrics = list(range(args.num_epochs))
+        result_test_metrics = list(range(args.num_epochs))
+
+        # If the training is interruptted
+        if args.resume:
+            start_epoch, best_acc, result_train_metrics, result_test_metrics = self._resume()
+
+        for epoch in range(start_epoch, args.num_epochs):
+
+            # Run one epoch
+            logging.info("Epoch {}/{}".format(epoch + 1, args.num_epochs))
+
+            self.strategy.start_epoch(epoch)
+            train_metrics = self.train(train_loader)
+            self.strategy.end_epoch(epoch)
+
+            # Evaluate for one epoch on validation set
+            test_metrics = self.evaluate(test_loader)
+            self.scheduler.step()
+
+            result_train_metrics[epoch] = train_metrics
+            result_test_metrics[epoch] = test_metrics
+            test_acc = test_metrics[self.strategy.best]
+            is_best = test_acc >= best_acc
+            if is_best:
+                best_acc = test_acc
+            state = self._state()
+            if is_main():
+                self._save(epoch, train_metrics, test_metrics, result_train_metrics,
+                           result_test_metrics, is_best, state)
+
+        for writer in self.writers.values():
+            writer.close()
+
+    def _state(self):
+        """Returns the model and optimizer states to checkpoint, gathered from all ranks under branch parallelism."""
+        optim_dict = self.optimizer.state_dict()
+        if self.branch_parallel:
+            optim_dict = self.model.gather(optim_dict)
+        return self.model.state_dict(), optim_dict
+
+    def _save(self, epoch, train_metrics, test_metrics, result_train_metrics, result_test_metrics, is_best, state):
+        """Writes TensorBoard, the metrics and the checkpoints of one epoch (on rank 0)."""
+        for phase, metrics in (('train', train_metrics), ('test', test_metrics)):
+            for writer, tag, key in self.strategy.scalars(phase):
+                self._writer(writer).add_scalar(
+                    phase.capitalize() + '/' + tag, metrics[key], epoch+1)
+
+        # Save latest train/test metrics
+        torch.save(result_train_metrics, os.path.join(
+            self.model_dir, 'train_metrics'))
+        torch.save(result_test_metrics, os.path.join(
+            self.model_dir, 'test_metrics'))
+
+        last_path = os.path.join(self.model_dir, 'last.pth')
+        # Save latest model weights, optimizer, schedule and accuracy
+        checkpoint = {'state_dict': state[0],
+                      'optim_dict': state[1],
+                      'sched_dict': self.scheduler.state_dict(),
+                      'epoch': epoch + 1}
+        if self.scaler.is_enabled():
+            checkpoint['scaler_dict'] = self.scaler.state_dict()
+        checkpoint.update((k, test_metrics[k]) for k in self.strategy.checkpoint)
+        torch.save(checkpoint, last_path)
+
+        # If best_eval, best_save_path
+        if is_best:
+            logging.info("- Found better accuracy")
+            # Save best metrics in a json file in the model directory
+            test_metrics['epoch'] = epoch + 1
+            utils.save_dict_to_json(test_metrics, os.path.join(
+                self.model_dir, "test_best_metrics.json"))
+
+            # Save model and optimizer
+            shutil.copyfile(last_path, os.path.join(self.model_dir, 'best.pth'))
+
+
+class Strategy():
+    """The method-specific part of the training loop.
+
+    forward() returns the loss of one batch and an OrderedDict of the batch
+    statistics (means over the samples of the batch) to average over the
+    epoch. It must contain 'loss'. metrics() names the averages,
+    `best` is the test metric that selects best.pth and `checkpoint` lists the
+    test metrics stored in last.pth.
+
+    Args:
+        args: (Namespace) the options of the training script
+    """
+    best = 'test_accTop1'
+    checkpoint = ('test_accTop1',)
+
+    def __init__(self, args):
+        self.args = args
+        self.criterion = nn.CrossEntropyLoss()
+
+    def wrap(self, train_loader):
+        """Returns the loader the training epochs iterate over."""
+        return train_loader
+
+    def start_epoch(self, epoch):
+        pass
+
+    def end_epoch(self, epoch):
+        pass
+
+    def forward(self, model, batch, training):
+        raise NotImplementedError
+
+    def metrics(self, values, phase):
+        # phase -> 'train' or 'test'
+        return OrderedDict((phase + '_' + k, v) for k, v in values.items())
+
+    def scalars(self, phase):
+        """(writer, tag, metric) triples logged to TensorBoard, '' is the writer of model_dir."""
+        return [('', 'Loss', phase + '_loss'), ('', 'AccTop1', phase + '_accTop1')]
+
+
+def distillation_loss(args):
+    """The KL_Loss or CE_Loss of args.loss at args.temperature."""
+    if args.loss == "KL":
+        return utils.KL_Loss(args.temperature)
+    elif args.loss == "CE":
+        return utils.CE_Loss(args.temperature)
+    raise ValueError('Unknown distillation loss {}'.format(args.loss))
+
+
+def consistency_weight(epoch, args):
+    """Weight of the distillation terms, ramped up after args.start_consistency of the epochs."""
+    consistency_epoch = args.start_consistency * args.num_epochs
+    if epoch < consistency_epoch:
+        return 1
+    # Consistency ramp-up from https://arxiv.org/abs/1610.02242
+    current, rampup_length = epoch - consistency_epoch, args.length
+    if rampup_length == 0:
+        return 1.0
+    current = np.clip(current, 0.0, rampup_length)
+    phase = 1.0 - current / rampup_length
+    return float(np.exp(-5.0 * phase * phase))
+
+
+class Baseline(Strategy):
+    """Cross entropy training of a single network."""
+    checkpoint = ('test_accTop1', 'test_accTop5')
+
+    def forward(self, model, batch, training):
+        images, labels = batch[:2]
+        output = model(images)
+        loss = self.criterion(output, labels)
+        accTop1, accTop5 = utils.accuracy(output, labels, topk=(1, 5))
+        return loss, OrderedDict([('loss', loss), ('accTop1', accTop1), ('accTop5', accTop5)])
+
+    def scalars(self, phase):
+        return super(Baseline, self).scalars(phase) + [('', 'AccTop5', phase + '_accTop5')]
+
+
+class KD(Strategy):
+    """Classic KD from a frozen teacher.
+
+    Args:
+        args: (Namespace) alpha, loss, temperature and async_teacher
+        model_T: (nn.Module) the pretrained teacher
+        device_T: (torch.device) where the teacher runs with args.async_teacher
+        teacher_cache: (utils.TeacherCache) optional cache of the teacher logits
+    """
+
+    def __init__(self, args, model_T, device_T=None, teacher_cache=None):
+        super(KD, self).__init__(args)
+        self.criterion_T = distillation_loss(args)
+        self.model_T = model_T
+        self.device_T = device_T
+        self.teacher_cache = teacher_cache
+
+    def wrap(self, train_loader):
+        if self.args.async_teacher:
+            # the teacher forward of batch i+1 overlaps the student step of batch i
+            return data_loader.TeacherPipeline(train_loader, self.model_T, self.device_T,
+                                               dtype=amp_dtype(self.args))
+        return train_loader
+
+    def start_epoch(self, epoch):
+        # set teacher model to evaluation mode
+        self.model_T.eval()
+
+    def end_epoch(self, epoch):
+        if self.teacher_cache is not None:
+            self.teacher_cache.flush()
+
+    def teacher(self, batch):
+        if self.args.async_teacher:
+            # appended by data_loader.TeacherPipeline
+            return batch[-1]
+        if self.teacher_cache is not None:
+            # batch[2:] -> sample indices and augmentation keys
+            return self.teacher_cache(self.model_T, batch[0], *batch[2:])
+        with torch.no_grad():
+            return self.model_T(batch[0])
+
+    def forward(self, model, batch, training):
+        images, labels = batch[:2]
+        output = model(images)
+        loss_true = self.criterion(output, labels)
+        accTop1 = utils.accuracy(output, labels)[0]
+        if not training:
+            return loss_true, OrderedDict([('loss', loss_true), ('accTop1', accTop1)])
+
+        loss_teacher = self.criterion_T(output, self.teacher(batch))
+        loss = loss_true + self.args.alpha * loss_teacher
+        return loss, OrderedDict([('loss', loss), ('true_loss', loss_true),
+                                  ('teacher_loss', loss_teacher), ('accTop1', accTop1)])
+
+    def scalars(self, phase):
+        if phase == 'test':
+            return super(KD, self).scalars(phase)
+        return [('', 'Loss', 'train_loss'), ('', 'Loss_true', 'train_true_loss'),
+                ('', 'Loss_teacher', 'train_teacher_loss'), ('', 'AccTop1', 'train_accTop1')]
+
+
+class MultiBranch(Strategy):
+    """Common metrics of the multi-branch methods.
+
+    accTop1 / accTop5 hold one entry per peer, then optionally the group leader,
+    then the ensemble (mean of the peers).
+    """
+    # select best.pth by the ensemble instead of the average peer (or the leader)
+    choose_E = False
+    # a group leader follows the peers
+    leader = False
+    # report every peer on its own
+    per_branch = True
+
+    @property
+    def num_peers(self):
+        return self.args.num_branches - 1 if self.leader else self.args.num_branches
+
+    @property
+    def best(self):
+        if self.choose_E:
+            return 'test_accTop1'
+        return 'stu_test_accTop1' if self.leader else 'mean_test_accTop1'
+
+    @property
+    def checkpoint(self):
+        keys = ('test_accTop1', 'mean_test_accTop1')
+        return keys + ('stu_test_accTop1',) if self.leader else keys
+
+    def metrics(self, values, phase):
+        accTop1, accTop5 = values['accTop1'], values['accTop5']
+        num = self.num_peers
+        # the peers, then the leader and the ensemble, which are read from the end
+        assert len(accTop1) == num + (2 if self.leader else 1), \
+            'expected {} peer accuracies, got {} heads'.format(num, len(accTop1))
+        metrics = OrderedDict((phase + '_' + k, values[k])
+                              for k in ('loss', 'true_loss', 'group_loss') if k in values)
+        metrics['mean_' + phase + '_accTop1'] = sum(accTop1[:num]) / num
+        metrics['mean_' + phase + '_accTop5'] = sum(accTop5[:num]) / num
+        if self.leader:
+            metrics['stu_' + phase + '_accTop1'] = accTop1[-2]
+            metrics['stu_' + phase + '_accTop5'] = accTop5[-2]
+        metrics[phase + '_accTop1'] = accTop1[-1]
+        metrics[phase + '_accTop5'] = accTop5[-1]
+        if 'dist' in values:
+            metrics['dist'] = values['dist']
+        if self.per_branch:
+            for i in range(num):
+                metrics['stu' + str(i) + phase + '_accTop1'] = accTop1[i]
+                metrics['stu' + str(i) + phase + '_accTop5'] = accTop5[i]
+        return metrics
+
+
+class GL(MultiBranch):
+    """OKDDip: peers distilled from their attention targets, the leader from the peer ensemble."""
+    leader = True
+
+    def __init__(self, args):
+        super(GL, self).__init__(args)
+        self.criterion_T = distillation_loss(args)
+        self.consistency_weight = 1
+
+    def start_epoch(self, epoch):
+        self.consistency_weight = consistency_weight(epoch, self.args)
+
+    def forward(self, model, batch, training):
+        images, labels = batch[:2]
+        output_batch, x_m, x_stu = model(images)
+        ensemble = torch.mean(output_batch, dim=2)
+        # densenet_GL also returns the column of the leader branch, the losses only cover the peers
+        peers = output_batch[:, :, :self.num_peers]
+        loss_true = utils.branch_cross_entropy(peers, labels).sum()
+        loss_group = self.criterion_T(peers, x_m[:, :, :self.num_peers])
+        loss = loss_true + self.criterion(x_stu, labels) + self.args.alpha * self.consistency_weight * (
+            loss_group + self.criterion_T(x_stu, ensemble))
+
+        # accuracy of all heads with one topk
+        accTop1, accTop5 = utils.branch_accuracy(peers, labels, topk=(1, 5),
+                                                 extra=[x_stu, ensemble])
+        logs = OrderedDict([('loss', loss), ('true_loss', loss_true), ('group_loss', loss_group),
+                            ('accTop1', accTop1), ('accTop5', accTop5)])
+        if not training:
+            logs['dist'] = utils.branch_diversity(peers).mean()
+        return loss, logs
+
+    def scalars(self, phase):
+        scalars = [('', 'Loss', phase + '_loss'), ('', 'Loss_True', phase + '_true_loss'),
+                   ('', 'Loss_Group', phase + '_group_loss'), ('', 'AccTop1', phase + '_accTop1'),
+                   ('B', 'AccTop1', 'stu_' + phase + '_accTop1')]
+        return scalars + [('B', 'AccTop1_B' + str(i), 'stu' + str(i) + phase + '_accTop1')
+                          for i in range(self.num_peers)]
+
+
+class ONE(MultiBranch):
+    """ONE (gated ensemble target) and CL-ILR (peer mean target, --avg --bpscale)."""
+    per_branch = False
+
+    def __init__(self, args):
+        super(ONE, self).__init__(args)
+        self.criterion_T = distillation_loss(args)
+        self.consistency_weight = 1
+
+    def start_epoch(self, epoch):
+        self.consistency_weight = consistency_weight(epoch, self.args)
+
+    def forward(self, model, batch, training):
+        images, labels = batch[:2]
+        output_batch, x_m = model(images)
+        loss_true = utils.branch_cross_entropy(output_batch, labels).sum()
+        if self.args.ind:
+            loss_group = output_batch.new_zeros(1)
+        else:
+            loss_group = self.criterion_T(output_batch, x_m)
+            if not self.args.avg:
+                loss_true = loss_true + self.criterion(x_m, labels)
+        loss = loss_true + self.args.alpha * self.consistency_weight * loss_group
+
+        accTop1, accTop5 = utils.branch_accuracy(output_batch, labels, topk=(1, 5),
+                                                 extra=[torch.mean(output_batch, dim=2)])
+        logs = OrderedDict([('loss', loss), ('true_loss', loss_true), ('group_loss', loss_group),
+                            ('accTop1', accTop1), ('accTop5', accTop5)])
+        if not training:
+            logs['dist'] = utils.branch_diversity(output_batch).mean()
+        return loss, logs
+
+
+class DML(MultiBranch):
+    """Deep Mutual Learning: every branch learns from the labels and from its peers."""
+
+    def __init__(self, args):
+        super(DML, self).__init__(args)
+        self.criterion_T = utils.Mutual_Loss(args.temperature, args.loss, pairwise=args.type)
+
+    def forward(self, model, batch, training):
+        images, labels = batch[:2]
+        output_batch = model(images)
+        loss = utils.branch_cross_entropy(output_batch, labels).sum() + self.criterion_T(output_batch)
+
+        accTop1, accTop5 = utils.branch_accuracy(output_batch, labels, topk=(1, 5),
+                                                 extra=[torch.mean(output_batch, dim=2)])
+        return loss, OrderedDict([('loss', loss), ('accTop1', accTop1), ('accTop5', accTop5)])
@@ -0,0 +1,149 @@
+'''
+Exports the group leader of a train_GL.py checkpoint as a plain network for inference.
+
+The leader of resnet_GL, vgg_GL and densenet_GL is the shared trunk followed by
+the last branch, layer3_{N-1} and classifier3_{N-1}. The peers and the attention
+are only needed for training. This script loads best.pth into the GL model,
+moves the trunk and the leader branch onto the plain resnet.py, vgg.py or
+densenet.py model, checks that the plain model reproduces the leader logits
+on random inputs and saves it, loadable with e.g. resnet32(pretrained=True, path=...).
+With --fold_bn it also folds the BatchNorms of the leader with
+models.fusion.fold_batchnorm and saves the folded module next to it, e.g.
+leader_folded.pth, loadable with torch.load(path, weights_only=False).
+
+Example:
+```
+python export_leader.py --model resnet32 --dataset CIFAR100 --checkpoint ./CIFAR100/300/.../best.pth
+```
+'''
+import argparse
+import logging
+import os
+
+import torch
+import utils
+import engine
+import models.model_cifar as model_cifar
+from models.fusion import fold_batchnorm
+
+# the models train_GL.py builds with an OKDDip group leader
+GL_MODELS = ['resnet32', 'resnet110', 'wide_resnet20_8', 'vgg16', 'vgg19',
+             'densenetd40k12', 'densenetd100k12']
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--model', metavar='ARCH', default='resnet32', type=str, choices=GL_MODELS,
+                    help='model architecture: ' + ' | '.join(GL_MODELS) + ' (default: resnet32)')
+parser.add_argument('--dataset', default='CIFAR10', type=str, choices=['CIFAR10', 'CIFAR100'],
+                    help='Input the name of dataset: default(CIFAR10)')
+parser.add_argument('--checkpoint', required=True, type=str,
+                    help='Input the best.pth (or last.pth) written by train_GL.py')
+parser.add_argument('--output', default='', type=str,
+                    help='Input the path of the exported leader: default(leader.pth next to --checkpoint)')
+parser.add_argument('--batch_size', default=8, type=int,
+                    help='Input the number of random inputs of the parity check: default(8)')
+parser.add_argument('--fold_bn', action='store_true',
+                    help='Decide whether or not to also save the leader with its BatchNorms folded, as <output>_folded.pth: default(False)')
+
+
+def build_gl(model, num_classes, num_branches):
+    """The GL model as train_GL.py builds it."""
+    if "resnet" in model:
+        return getattr(model_cifar.resnet_GL, model)(num_classes=num_classes, num_branches=num_branches,
+                                                     input_channel=utils.lookup(model))
+    elif "vgg" in model:
+        return getattr(model_cifar.vgg_GL, model)(num_classes=num_classes, num_branches=num_branches)
+    return getattr(model_cifar.densenet_GL, model)(num_classes=num_classes, num_branches=num_branches,
+                                                   input_channel=utils.lookup(model))
+
+
+def plain_kwargs(model):
+    """The arguments of the plain model that has the layout of the leader."""
+    if "densenet" in model:
+        # densenet_GL has no norm0/relu0 and its leader reads the raw output of the last block
+        return {'stem_norm': False, 'final_norm': False}
+    return {}
+
+
+def leader_renames(model, gl, plain):
+    """Maps the prefixes of the leader branch in `gl` onto the modules of `plain`."""
+    leader = str(gl.num_branches - 1)
+    if "resnet" in model:
+        return {'layer3_' + leader: 'layer3', 'classifier3_' + leader: 'fc'}
+    elif "vgg" in model:
+        return {'layer3_' + leader: 'layer4', 'classifier3_' + leader: 'classifier'}
+    # the branches share the last dense block of the trunk
+    last_block = [name for name, _ in plain.features.named_children() if name.startswith('denseblock')][-1]
+    return {'Branch' + leader: 'features.' + last_block, 'classifier3_' + leader: 'classifier'}
+
+
+def leader_state_dict(gl_state, renames, plain_keys):
+    """The trunk entries of `gl_state` that `plain_keys` shares, and the leader entries renamed by `renames`.
+
+    The peers, their classifiers and the attention are dropped.
+    """
+    state = {}
+    for key, value in gl_state.items():
+        prefix, _, rest = key.partition('.')
+        if prefix in renames:
+            state[renames[prefix] + '.' + rest] = value
+        elif key in plain_keys:
+            state[key] = value
+    return state
+
+
+def export_leader(model, num_classes, state_dict, batch_size=8):
+    """Returns the plain leader network of a train_GL.py state dict, after checking its logits.
+
+    Args:
+        model: (string) the architecture, one of GL_MODELS
+        num_classes: (int) number of classes
+        state_dict: (dict) the 'state_dict' of the checkpoint
+        batch_size: (int) number of random inputs of the parity check
+    """
+    # DataParallel and DistributedDataParallel checkpoints
+    state_dict = {k[len('module.'):] if k.startswith('module.') else k: v for k, v in state_dict.items()}
+    num_branches = len({k.split('.')[0] for k in state_dict if k.startswith('classifier3_')})
+    gl = build_gl(model, num_classes, num_branches)
+    gl.load_state_dict(state_dict)
+
+    family = 'resnet' if "resnet" in model else 'vgg' if "vgg" in model else 'densenet'
+    plain = getattr(getattr(model_cifar, family), model)(num_classes=num_classes, **plain_kwargs(model))
+    plain_keys = set(plain.state_dict())
+    plain.load_state_dict(leader_state_dict(gl.state_dict(), leader_renames(model, gl, plain), plain_keys))
+
+    gl.eval()
+    plain.eval()
+    x = torch.randn(batch_size, 3, 32, 32)
+    with torch.no_grad():
+        lead = gl(x)[-1]
+        out = plain(x)
+    diff = (lead - out).abs().max().item()
+    logging.info('- Leader logits max abs difference {:.3g}'.format(diff))
+    if not torch.allclose(out, lead, rtol=1e-4, atol=1e-5):
+        raise ValueError('the exported leader does not reproduce the GL leader logits '
+                         '(max abs difference {:.3g})'.format(diff))
+
+    logging.info('- {} branches {:.2f}M params, leader {:.2f}M params'.format(
+        num_branches, sum(p.numel() for p in gl.parameters())/1000000.0,
+        sum(p.numel() for p in plain.parameters())/1000000.0))
+    return plain
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    output = args.output or os.path.join(os.path.dirname(args.checkpoint), 'leader.pth')
+    utils.set_logger(os.path.splitext(output)[0] + '.log')
+
+    num_classes = engine.DATASETS[args.dataset][0]
+    checkpoint = torch.load(args.checkpoint, map_location='cpu')
+    logging.info('Exporting the leader of {}'.format(args.checkpoint))
+    leader = export_leader(args.model, num_classes, checkpoint['state_dict'], batch_size=args.batch_size)
+
+    torch.save({'state_dict': leader.state_dict(), 'model': args.model,
+                'num_classes': num_classes, 'kwargs': plain_kwargs(args.model)}, output)
+    logging.info('Saved {}'.format(output))
+    if args.fold_bn:
+        # the folded BatchNorms are nn.Identity, so the whole module is saved, not a state dict
+        folded_output = os.path.splitext(output)[0] + '_folded.pth'
+        torch.save(fold_batchnorm(leader, input_size=(args.batch_size, 3, 32, 32)), folded_output)
+        logging.info('Saved {}'.format(folded_output))
@@ -0,0 +1,493 @@
+'''
+Shared helpers for the multi-branch (GL / ONE / MultiNet / DML) models.
+
+BranchCollector gathers the per-branch logits and pooled features and
+materializes each of them with a single allocation, instead of growing them
+with one torch.cat per branch.
+
+peer_mean and gated_ensemble build the ONE / CL-ILR targets in closed form,
+benchmark_targets.py times them against the former per-branch loops.
+
+PeerAttention is the OKDDip aggregation: a single fused query/key projection
+of the stacked B x N x D branch features, followed by one batched energy,
+softmax and aggregation.
+
+Fused execution packs N identically-shaped ResNet stages side by side along the
+channel dimension, so that every convolution becomes one grouped convolution
+and every BatchNorm one wider BatchNorm. The per-branch modules keep owning
+their parameters and buffers, hence state_dict keys are unchanged.
+
+Activation checkpointing (checkpoint_policy, run_stage) keeps only the
+input of a checkpointed stage alive for backward and recomputes the stage
+when its gradient is needed. All branches read the same trunk output, so
+checkpointing the branches makes the activation memory independent of the
+number of branches.
+
+BranchParallel splits a GL model over the processes of torch.distributed
+instead of replicating it: rank 0 runs the shared trunk and broadcasts its
+output, every rank runs its own subset of the branches, and the branch
+logits and attention projections are all-gathered, so that every rank
+computes the same loss.
+
+'''
+import torch
+import torch.distributed as dist
+import torch.nn as nn
+import torch.nn.functional as F
+import torch.utils.checkpoint as cp
+
+__all__ = ['BranchCollector', 'PeerAttention', 'legacy_attention_keys',
+           'peer_mean', 'gated_ensemble', 'fused_branches', 'fused_linear',
+           'CHECKPOINT_POLICIES', 'checkpoint_policy', 'enable_checkpointing', 'checkpointed', 'run_stage',
+           'BranchParallel']
+
+# what activation checkpointing covers in the multi-branch models
+CHECKPOINT_POLICIES = ('none', 'trunk', 'branches', 'all')
+
+
+class BranchCollector():
+    """Collects per-branch outputs and stacks them once.
+
+    Example:
+    ```
+    branches = BranchCollector()
+    for i in range(num_branches):
+        branches.append(logits_i, features_i)
+    pro, feats = branches.stack()
+    ```
+    """
+
+    def __init__(self):
+        self.logits = []
+        self.features = []
+
+    def append(self, logits, features=None):
+        # logits -> B x num_classes, features -> B x D
+        self.logits.append(logits)
+        if features is not None:
+            self.features.append(features)
+
+    def __len__(self):
+        return len(self.logits)
+
+    @staticmethod
+    def _stack(tensors, dim):
+        # one output allocation and N copies; slice-assigning into a buffer
+        # instead would make autograd clone the full gradient once per branch
+        if not tensors:
+            return None
+        return torch.stack(tensors, dim)
+
+    def stack(self):
+        """Returns logits (B x num_classes x N) and features (B x N x D)."""
+        return self._stack(self.logits, -1), self._stack(self.features, 1)
+
+
+def peer_mean(pro):
+    """CL-ILR targets: every branch gets the mean of the other branches.
+
+    Args:
+        pro: (Tensor) B x num_classes x N branch logits
+
+    Returns:
+        (Tensor) B x num_classes x N, column i is (sum - pro_i) / (N - 1)
+    """
+    num_branches = pro.size(-1)
+    return (pro.sum(-1, keepdim=True) - pro) / (num_branches - 1)
+
+
+def gated_ensemble(pro, gate):
+    """ONE target: the gate-weighted sum of all branches.
+
+    Args:
+        pro: (Tensor) B x num_classes x N branch logits
+        gate: (Tensor) B x N gate weights
+
+    Returns:
+        (Tensor) B x num_classes
+    """
+    return torch.einsum('bcn,bn->bc', pro, gate)
+
+
+class PeerAttention(nn.Module):
+    r"""Attention-based aggregation of peer predictions.
+
+    Args:
+        input_channel (int) - feature size D of every branch
+        factor (int) - the query/key size is input_channel // factor
+        dtype (torch.dtype) - optional low-precision type (e.g. torch.float16 or
+            torch.bfloat16) for the projection and energy. Softmax always runs in float32.
+    """
+
+    def __init__(self, input_channel, factor=8, dtype=None):
+        super(PeerAttention, self).__init__()
+        self.dim = input_channel // factor
+        self.dtype = dtype
+        # rows [0, dim) are the query weight, rows [dim, 2*dim) the key weight
+        self.qk = nn.Linear(input_channel, 2 * self.dim, bias=False)
+
+    def project(self, feats):
+        # feats -> B x N x D (or B x D for one branch), returns the queries and keys B x N x 2*dim
+        weight = self.qk.weight
+        if self.dtype is not None:
+            feats, weight = feats.to(self.dtype), weight.to(self.dtype)
+        return F.linear(feats, weight)
+
+    def aggregate(self, proj, pro):
+        # proj -> B x N x 2*dim, pro -> B x num_classes x N
+        proj_q, proj_k = proj.split(self.dim, dim=-1)                        # B x N x dim
+        energy = torch.bmm(proj_q, proj_k.transpose(1, 2))                   # B x N x N
+        attention = F.softmax(energy.float(), dim=-1).to(pro.dtype)
+        return torch.bmm(pro, attention.transpose(1, 2))                     # B x num_classes x N
+
+    def forward(self, feats, pro):
+        # feats -> B x N x D, pro -> B x num_classes x N
+        return self.aggregate(self.project(feats), pro)
+
+
+def legacy_attention_keys(state_dict, prefix, *args):
+    """load_state_dict pre-hook that maps query_weight/key_weight checkpoints onto PeerAttention.
+
+    Register it on the model that owns `self.attention`:
+    ```
+    self._register_load_state_dict_pre_hook(legacy_attention_keys)
+    ```
+    """
+    query, key = prefix + 'query_weight.weight', prefix + 'key_weight.weight'
+    if query in state_dict and key in state_dict:
+        state_dict[prefix + 'attention.qk.weight'] = torch.cat(
+            [state_dict.pop(query), state_dict.pop(key)], 0)
+
+
+def _fused_conv(x, convs, shared_input=False):
+    """Apply N convolutions of identical shape as one grouped convolution.
+
+    Args:
+        x: (Tensor) B x (N*C_in) x H x W, or B x C_in x H x W if shared_input
+        convs: (list of nn.Conv2d) one convolution per branch
+        shared_input: (bool) every branch reads the same x
+    """
+    ref = convs[0]
+    weight = torch.cat([conv.weight for conv in convs], 0)
+    bias = None
+    if ref.bias is not None:
+        bias = torch.cat([conv.bias for conv in convs], 0)
+    groups = ref.groups if shared_input else ref.groups * len(convs)
+    return F.conv2d(x, weight, bias, ref.stride, ref.padding, ref.dilation, groups)
+
+
+def _fused_bn(x, bns):
+    """Apply N BatchNorm2d layers to channel-stacked branch features.
+
+    BatchNorm is per-channel, so normalizing the stacked tensor is exactly
+    equivalent to normalizing every branch on its own. Running statistics are
+    written back to the per-branch buffers in training mode.
+    """
+    ref = bns[0]
+    weight = bias = None
+    if ref.affine:
+        weight = torch.cat([bn.weight for bn in bns], 0)
+        bias = torch.cat([bn.bias for bn in bns], 0)
+
+    if not ref.track_running_stats:
+        return F.batch_norm(x, None, None, weight, bias, True, 0., ref.eps)
+
+    momentum = 0. if ref.momentum is None else ref.momentum
+    if ref.training:
+        for bn in bns:
+            bn.num_batches_tracked.add_(1)
+        if ref.momentum is None:
+            momentum = 1.0 / float(ref.num_batches_tracked)
+    running_mean = torch.cat([bn.running_mean for bn in bns], 0)
+    running_var = torch.cat([bn.running_var for bn in bns], 0)
+    out = F.batch_norm(x, running_mean, running_var, weight, bias,
+                       ref.training, momentum, ref.eps)
+    if ref.training:
+        for bn, mean, var in zip(bns, running_mean.chunk(len(bns)), running_var.chunk(len(bns))):
+            bn.running_mean.copy_(mean)
+            bn.running_var.copy_(var)
+    return out
+
+
+def _fused_block(x, blocks, shared_input=False):
+    """Fused forward of N BasicBlock / Bottleneck modules."""
+    num = len(blocks)
+    ref = blocks[0]
+    bottleneck = hasattr(ref, 'conv3')
+
+    out = _fused_conv(x, [b.conv1 for b in blocks], shared_input)
+    out = F.relu(_fused_bn(out, [b.bn1 for b in blocks]), inplace=True)
+    out = _fused_conv(out, [b.conv2 for b in blocks])
+    out = _fused_bn(out, [b.bn2 for b in blocks])
+    if bottleneck:
+        out = F.relu(out, inplace=True)
+        out = _fused_conv(out, [b.conv3 for b in blocks])
+        out = _fused_bn(out, [b.bn3 for b in blocks])
+
+    if ref.downsample is not None:
+        identity = _fused_conv(x, [b.downsample[0] for b in blocks], shared_input)
+        identity = _fused_bn(identity, [b.downsample[1] for b in blocks])
+    elif shared_input:
+        identity = x.repeat(1, num, 1, 1)
+    else:
+        identity = x
+
+    out += identity
+    return F.relu(out, inplace=True)
+
+
+def fused_branches(x, layers):
+    """Run N identically-shaped ResNet stages on a shared input in one pass.
+
+    Args:
+        x: (Tensor) B x C x H x W, the trunk output fed to every branch
+        layers: (list of nn.Sequential) the per-branch stages, e.g. layer3_i
+
+    Returns:
+        (Tensor) B x N x C_out x H_out x W_out
+    """
+    out = x
+    for depth in range(len(layers[0])):
+        out = _fused_block(out, [layer[depth] for layer in layers], shared_input=(depth == 0))
+    return out.view(out.size(0), len(layers), -1, out.size(2), out.size(3))
+
+
+def fused_linear(x, linears):
+    """Apply N nn.Linear heads to per-branch features in one batched matmul.
+
+    Args:
+        x: (Tensor) B x N x in_features
+        linears: (list of nn.Linear) one head per branch
+
+    Returns:
+        (Tensor) B x out_features x N
+    """
+    weight = torch.stack([fc.weight for fc in linears], 0)     # N x out x in
+    out = torch.einsum('bni,noi->bon', x, weight)
+    if linears[0].bias is not None:
+        bias = torch.stack([fc.bias for fc in linears], 1)      # out x N
+        out = out + bias
+    return out
+
+
+def checkpoint_policy(policy):
+    """Returns whether the trunk and whether the branches are checkpointed under `policy`."""
+    if policy not in CHECKPOINT_POLICIES:
+        raise ValueError('Unknown checkpointing policy {}, expected one of {}'.format(
+            policy, ', '.join(CHECKPOINT_POLICIES)))
+    return policy in ('trunk', 'all'), policy in ('branches', 'all')
+
+
+def enable_checkpointing(model, policy):
+    """Additionally checkpoints the parts of `policy` in a model built with `checkpoint=`.
+
+    Returns False if the model has no checkpointing policy.
+    """
+    trunk, branches = checkpoint_policy(policy)
+    if not hasattr(model, 'checkpoint_branches'):
+        return False
+    model.checkpoint_trunk = model.checkpoint_trunk or trunk
+    model.checkpoint_branches = model.checkpoint_branches or branches
+    return True
+
+
+class _Recompute():
+    """Calls `function`, and on the recomputation in the backward restores the BatchNorm statistics of `modules`."""
+
+    def __init__(self, function, modules):
+        self.function = function
+        self.modules = modules
+        self.calls = 0
+
+    def __call__(self, *inputs):
+        self.calls += 1
+        if self.calls == 1:
+            return self.function(*inputs)
+        # the batch statistics were already added to the running ones in the forward
+        buffers = [buf for module in self.modules for m in module.modules()
+                   if isinstance(m, nn.modules.batchnorm._BatchNorm) and m.training
+                   for buf in m.buffers()]
+        saved = [buf.clone() for buf in buffers]
+        try:
+            return self.function(*inputs)
+        finally:
+            for buf, value in zip(buffers, saved):
+                buf.copy_(value)
+
+
+def checkpointed(function, modules, *inputs):
+    """function(*inputs) with activation checkpointing.
+
+    Uses the non-reentrant checkpoint (use_reentrant, PyTorch 1.11 or later), which
+    also handles inputs that do not require gradients; requirements.txt pins the
+    version the whole engine needs.
+
+    Args:
+        function: (callable) the computation to recompute in the backward
+        modules: (list of nn.Module) the modules `function` runs, whose BatchNorm
+            running statistics are only updated once
+        inputs: (Tensor) the inputs of `function`, kept alive for the backward
+    """
+    return cp.checkpoint(_Recompute(function, modules), *inputs, use_reentrant=False)
+
+
+def run_stage(module, x, checkpoint=False, modules=None):
+    """module(x), checkpointed when `checkpoint` is set and gradients are recorded.
+
+    `module` may be any callable, `modules` then lists the modules it runs.
+    """
+    if checkpoint and torch.is_grad_enabled():
+        return checkpointed(module, [module] if modules is None else modules, x)
+    return module(x)
+
+
+# dtypes a trunk output may have, the index is sent along with its shape
+_DTYPES = (torch.float32, torch.float16, torch.bfloat16, torch.float64)
+
+
+class _Broadcast(torch.autograd.Function):
+    """Broadcasts x from `src`; the backward sums the gradients of all ranks on `src`."""
+
+    @staticmethod
+    def forward(ctx, x, src):
+        ctx.src = src
+        dist.broadcast(x, src)
+        return x.view_as(x)
+
+    @staticmethod
+    def backward(ctx, grad):
+        grad = grad.contiguous().clone()
+        dist.reduce(grad, ctx.src)
+        return (grad if dist.get_rank() == ctx.src else None), None
+
+
+class _Gather(torch.autograd.Function):
+    """All-gathers B x n x K tensors of every rank into B x (world_size*n) x K.
+
+    Every rank computes the same loss from the gathered tensor, so the gradient
+    of its own slice is already complete and the backward only cuts it out.
+    """
+
+    @staticmethod
+    def forward(ctx, x, rank, world_size):
+        ctx.rank, ctx.size = rank, x.size(1)
+        x = x.contiguous()
+        parts = [torch.empty_like(x) for _ in range(world_size)]
+        dist.all_gather(parts, x)
+        return torch.cat(parts, 1)
+
+    @staticmethod
+    def backward(ctx, grad):
+        start = ctx.rank * ctx.size
+        return grad[:, start:start + ctx.size], None, None
+
+
+def _cpu(obj):
+    # copies the tensors of a (nested) state dict to the host before pickling them
+    if torch.is_tensor(obj):
+        return obj.detach().cpu()
+    if isinstance(obj, dict):
+        return type(obj)((k, _cpu(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_cpu(v) for v in obj)
+    return obj
+
+
+class BranchParallel(nn.Module):
+    """Branch-parallel execution of a GL model, one subset of the branches per process.
+
+    Rank 0 runs the trunk and broadcasts its output; rank r owns branches
+    [r * N / world_size, (r+1) * N / world_size) (the leader is the last
+    branch), and the other ranks drop the trunk and the branches they do not
+    own. The per-branch logits and attention projections are all-gathered,
+    so every rank ends up with the full model output and must compute the
+    same loss, from the labels of rank 0. In the backward the trunk gradient
+    is summed on rank 0, and reduce_gradients() sums the gradients of the
+    modules every branch uses (the attention projection).
+
+    The wrapped model provides:
+        trunk_modules(), branch_modules(i): names of the submodules of the
+            trunk and of branch i
+        trunk(x): the shared trunk
+        branches(x, indices): per-branch outputs, each B x len(indices) x K (or B x n x K
+            with the same n on every rank)
+        head(*outputs): the model output from the gathered B x N x K (B x world_size*n x K) outputs
+
+    state_dict() and load_state_dict() read and write the full state dict of
+    the plain model, hence checkpoints are interchangeable with single-process
+    training. Both are collectives.
+
+    Args:
+        model: (nn.Module) resnet_GL, vgg_GL or densenet_GL model, already on its device
+    """
+
+    def __init__(self, model):
+        super(BranchParallel, self).__init__()
+        self.rank = dist.get_rank()
+        self.world_size = dist.get_world_size()
+        num_branches = model.num_branches
+        if num_branches % self.world_size:
+            raise ValueError('{} branches cannot be split over {} processes'.format(
+                num_branches, self.world_size))
+
+        # every rank starts from the weights of rank 0
+        for tensor in model.state_dict().values():
+            dist.broadcast(tensor, 0)
+        self.keys = list(model.state_dict().keys())
+
+        per_rank = num_branches // self.world_size
+        self.owned = list(range(self.rank * per_rank, (self.rank + 1) * per_rank))
+        dropped = [] if self.rank == 0 else list(model.trunk_modules())
+        for i in range(num_branches):
+            if i not in self.owned:
+                dropped.extend(model.branch_modules(i))
+        for name in dropped:
+            setattr(model, name, None)
+        self.dropped = tuple(name + '.' for name in dropped)
+        local = set(model.trunk_modules()) | {name for i in range(num_branches)
+                                              for name in model.branch_modules(i)}
+        # used by every branch, their gradients are partial on every rank
+        self.shared = [p for name, p in model.named_parameters() if name.split('.')[0] not in local]
+        self.module = model
+
+    def forward(self, x):
+        # header: dtype index, ndim, shape
+        header = torch.zeros(8, dtype=torch.long, device=x.device)
+        if self.rank == 0:
+            x = self.module.trunk(x)
+            header[0], header[1] = _DTYPES.index(x.dtype), x.dim()
+            header[2:2 + x.dim()] = torch.tensor(x.shape)
+        dist.broadcast(header, 0)
+        if self.rank != 0:
+            header = header.tolist()
+            x = torch.empty(header[2:2 + header[1]], dtype=_DTYPES[header[0]], device=x.device,
+                            requires_grad=torch.is_grad_enabled())
+        x = _Broadcast.apply(x, 0)
+
+        outputs = self.module.branches(x, self.owned)
+        outputs = [_Gather.apply(out, self.rank, self.world_size) for out in outputs]
+        return self.module.head(*outputs)
+
+    def reduce_gradients(self):
+        """Sums the gradients of the shared parameters over all ranks, call it before the optimizer step."""
+        for p in self.shared:
+            if p.grad is not None:
+                dist.all_reduce(p.grad)
+
+    def gather(self, obj):
+        """Returns the `obj` of every rank (e.g. optimizer states), with the tensors on the host."""
+        parts = [None] * self.world_size
+        dist.all_gather_object(parts, _cpu(obj))
+        return parts
+
+    def state_dict(self, *args, **kwargs):
+        parts = self.gather(self.module.state_dict())
+        merged = {}
+        for part in parts:
+            merged.update(part)
+        return type(parts[0])((k, merged[k]) for k in self.keys)
+
+    def load_state_dict(self, state_dict, strict=True):
+        state_dict = type(state_dict)((k, v) for k, v in state_dict.items()
+                                      if not k.startswith(self.dropped))
+        return self.module.load_state_dict(state_dict, strict)
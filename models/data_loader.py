@@ -33,14 +33,410 @@
     # 0.30810780717887876
 
 """
+import math
 import os
+import queue
+import threading
+import numpy as np
 import torch
+import torch.nn.functional as F
 import torchvision
 import torchvision.transforms as transforms
+from .shards import ShardedImageFolder, ShardedStream
 
-def dataloader(data_name= "CIFAR100", batch_size= 64, num_workers = 8, root = './Data'):
+
+class TensorLoader():
+    """Batches of a whole dataset kept in memory as one contiguous uint8 tensor.
+
+    Random crop (zero padding) and horizontal flip are applied to the whole batch
+    with tensor ops, on the device holding the data, followed by ToTensor-style
+    scaling and normalization. No worker processes are used; all randomness
+    comes from one torch.Generator, so a seed reproduces the batch order and
+    the augmentation.
+
+    Args:
+        images: (Tensor) N x C x H x W uint8 images
+        labels: (Tensor) N labels
+        batch_size: (int) samples per batch, the last batch may be smaller
+        mean, std: (sequence) per-channel normalization, as in transforms.Normalize
+        shuffle: (bool) reshuffle at every epoch
+        padding: (int) RandomCrop padding, 0 disables cropping
+        flip: (bool) RandomHorizontalFlip with p=0.5
+        device: (torch.device) where batches are produced
+        seed: (int) seed of the generator, default draws one from the torch RNG
+        preload: (bool) move the whole dataset to `device`; otherwise the data stays
+            where it is (e.g. a memory-mapped file) and only every uint8 batch is copied
+        replay: (int) augmentation replay, every sample only ever uses one of `replay`
+            crop/flip variants drawn once up front, 0 draws a fresh variant every time
+        with_keys: (bool) also yield the sample indices and augmentation keys, which
+            identify the exact augmented image (see num_keys), e.g. for TeacherCache
+        rank, num_replicas: (int) this process and the number of processes sharing the
+            data; every process takes every num_replicas-th sample of the (shuffled)
+            order, and shuffled loaders drop the remainder so that all processes run
+            the same number of batches. All processes must use the same seed.
+    """
+
+    def __init__(self, images, labels, batch_size, mean, std, shuffle=False,
+                 padding=0, flip=False, device=None, seed=None, preload=True,
+                 replay=0, with_keys=False, rank=0, num_replicas=1):
+        device = torch.device('cpu') if device is None else torch.device(device)
+        if preload:
+            images, labels = images.contiguous().to(device), labels.to(device)
+        self.images = images
+        self.labels = labels
+        self.batch_size = batch_size
+        self.mean = torch.tensor(mean, device=device).view(1, -1, 1, 1)
+        self.std = torch.tensor(std, device=device).view(1, -1, 1, 1)
+        self.shuffle = shuffle
+        self.padding = padding
+        self.flip = flip
+        self.device = device
+        if seed is None:
+            seed = int(torch.randint(2**62, (1,)))
+        self.generator = torch.Generator()
+        self.generator.manual_seed(seed)
+        self.rank = rank
+        self.num_replicas = num_replicas
+        self.total = images.size(0)
+        if shuffle:
+            self.total -= self.total % num_replicas
+        self.augment_generator = self.generator
+        if num_replicas > 1:
+            # the order and the replay pool are shared, the augmentation is drawn per process
+            self.augment_generator = torch.Generator()
+            self.augment_generator.manual_seed(seed + 1 + rank)
+
+        # a variant is ((row offset * (2 * padding + 1)) + col offset) * 2 + flip
+        self.num_variants = (2 * padding + 1) ** 2 * 2
+        self.replay = replay
+        self.with_keys = with_keys
+        if replay:
+            self.pool = torch.randint(self.num_variants, (images.size(0), replay), generator=self.generator)
+
+    @property
+    def num_keys(self):
+        """Number of distinct augmentation keys per sample."""
+        return self.replay or self.num_variants
+
+    def __len__(self):
+        return math.ceil(len(range(self.rank, self.total, self.num_replicas)) / self.batch_size)
+
+    def draw(self, index):
+        """Draws the augmentation of every sample in `index`, returns (keys, variants) on the CPU."""
+        batch_size = index.size(0)
+        if self.replay:
+            keys = torch.randint(self.replay, (batch_size,), generator=self.augment_generator)
+            return keys, self.pool[index, keys]
+        offsets = torch.zeros(2, batch_size, dtype=torch.long)
+        flipped = torch.zeros(batch_size, dtype=torch.long)
+        if self.padding:
+            offsets = torch.randint(2 * self.padding + 1, (2, batch_size), generator=self.augment_generator)
+        if self.flip:
+            flipped = (torch.rand(batch_size, generator=self.augment_generator) < 0.5).long()
+        variants = (offsets[0] * (2 * self.padding + 1) + offsets[1]) * 2 + flipped
+        return variants, variants
+
+    def augment(self, images, variants):
+        batch_size, _, height, width = images.size()
+        variants = variants.to(self.device)
+        if self.padding:
+            pad = self.padding
+            images = F.pad(images, (pad, pad, pad, pad))
+            offsets = variants // 2
+            rows = (offsets // (2 * pad + 1)).view(-1, 1) + torch.arange(height, device=self.device)
+            cols = (offsets % (2 * pad + 1)).view(-1, 1) + torch.arange(width, device=self.device)
+            index = torch.arange(batch_size, device=self.device).view(-1, 1, 1, 1)
+            channel = torch.arange(images.size(1), device=self.device).view(1, -1, 1, 1)
+            images = images[index, channel, rows.view(batch_size, 1, height, 1), cols.view(batch_size, 1, 1, width)]
+        if self.flip:
+            flipped = (variants % 2).bool()
+            images = torch.where(flipped.view(-1, 1, 1, 1), images.flip(3), images)
+        return images
+
+    def __iter__(self):
+        num = self.images.size(0)
+        order = torch.randperm(num, generator=self.generator) if self.shuffle else torch.arange(num)
+        contiguous = not self.shuffle and self.num_replicas == 1
+        if self.num_replicas > 1:
+            order = order[self.rank:self.total:self.num_replicas]
+        for start in range(0, order.size(0), self.batch_size):
+            index = order[start:start + self.batch_size]
+            if not contiguous:
+                stored = index.to(self.images.device)
+                images, labels = self.images[stored], self.labels[stored]
+            else:
+                images = self.images[start:start + self.batch_size]
+                labels = self.labels[start:start + self.batch_size]
+            images = images.to(self.device, non_blocking=True)
+            labels = labels.to(self.device, non_blocking=True)
+            keys = None
+            if self.padding or self.flip:
+                keys, variants = self.draw(index)
+                images = self.augment(images, variants)
+            images = (images.float().div_(255) - self.mean) / self.std
+            if self.with_keys:
+                if keys is None:
+                    keys = torch.zeros_like(index)
+                yield images, labels, index, keys
+            else:
+                yield images, labels
+
+
+class Prefetcher():
+    """Wraps a loader and stages the next batch on `device` while the current one is used.
+
+    On CUDA the copy (and the optional uint8 -> float normalization) of batch
+    i+1 runs on a side stream while the default stream computes on batch i. On
+    other devices a background thread fetches and moves up to `depth` batches
+    ahead.
+
+    Args:
+        loader: (iterable) yields (images, labels) batches, e.g. a DataLoader
+        device: (torch.device) where the batches are needed
+        mean, std: (sequence) normalize uint8 batches on the device, as
+            ToTensor + Normalize would; float batches are passed through
+        depth: (int) number of batches the background thread may run ahead
+    """
+
+    def __init__(self, loader, device, mean=None, std=None, depth=2):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.mean = self.std = None
+        if mean is not None:
+            self.mean = torch.tensor(mean, device=self.device).view(1, -1, 1, 1)
+            self.std = torch.tensor(std, device=self.device).view(1, -1, 1, 1)
+        self.depth = depth
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _to_device(self, batch):
+        # (images, labels, ...) -> images and labels on the device, any further
+        # bookkeeping tensors (e.g. TensorLoader keys) stay where they are
+        images, labels = batch[0], batch[1]
+        images = images.to(self.device, non_blocking=True)
+        labels = labels.to(self.device, non_blocking=True)
+        if self.mean is not None and images.dtype == torch.uint8:
+            images = (images.float().div_(255) - self.mean) / self.std
+        return (images, labels) + tuple(batch[2:])
+
+    def __iter__(self):
+        if self.device.type == 'cuda':
+            return self._cuda_iter()
+        return self._thread_iter()
+
+    def _cuda_iter(self):
+        stream = torch.cuda.Stream(self.device)
+        batches = iter(self.loader)
+        staged = None
+        while True:
+            try:
+                batch = next(batches)
+            except StopIteration:
+                batch = None
+            if batch is not None:
+                with torch.cuda.stream(stream):
+                    batch = self._to_device(batch)
+            if staged is not None:
+                yield staged
+            if batch is None:
+                return
+            torch.cuda.current_stream(self.device).wait_stream(stream)
+            for tensor in batch[:2]:
+                # keep the memory alive until the default stream is done with it
+                tensor.record_stream(torch.cuda.current_stream(self.device))
+            staged = batch
+
+    def _thread_iter(self):
+        return background((self._to_device(batch) for batch in self.loader), self.depth)
+
+
+def background(batches, depth=2):
+    """Consumes the iterable `batches` in a background thread, up to `depth` items ahead.
+
+    Exceptions of the producer are re-raised in the consumer, and leaving the
+    loop early stops the producer.
+    """
+    items = queue.Queue(maxsize=depth)
+    done = object()
+    stop = threading.Event()
+
+    def worker():
+        try:
+            for item in batches:
+                if stop.is_set():
+                    return
+                items.put(item)
+            items.put(done)
+        except Exception as e:      # re-raised in the consumer
+            items.put(e)
+
+    thread = threading.Thread(target=worker, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = items.get()
+            if item is done:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        # unblock a worker waiting on a full queue
+        while thread.is_alive():
+            try:
+                items.get_nowait()
+            except queue.Empty:
+                thread.join(0.01)
+
+
+class TeacherPipeline():
+    """Wraps a loader and runs a frozen teacher on the upcoming batches in a background thread.
+
+    Batch i+1 goes through `model_T` while the student trains on batch i, and
+    every batch is yielded with the teacher logits appended. The teacher may
+    live on another device than the batches (e.g. a second GPU, or the CPU
+    while the student uses the GPU); its logits are moved back to the device
+    of the images. On CUDA the teacher runs on its own stream.
+
+    Args:
+        loader: (iterable) yields (images, labels, ...) batches, e.g. a Prefetcher
+        model_T: (nn.Module) the teacher, in eval mode, on `device`
+        device: (torch.device) where the teacher runs, None uses the device of the images
+        depth: (int) number of batches the teacher may run ahead
+        dtype: (torch.dtype) autocast dtype of the teacher (e.g. torch.bfloat16), None runs
+            it in float32; autocast does not reach into the worker thread by itself
+    """
+
+    def __init__(self, loader, model_T, device=None, depth=2, dtype=None):
+        self.loader = loader
+        self.model_T = model_T
+        self.device = None if device is None else torch.device(device)
+        self.depth = depth
+        self.dtype = dtype
+        self.stream = None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _teacher(self, images):
+        with torch.autocast(images.device.type, dtype=self.dtype, enabled=self.dtype is not None):
+            return self.model_T(images)
+
+    def _teacher_outputs(self, images):
+        device = self.device or images.device
+        if device.type != 'cuda':
+            return self._teacher(images.to(device)).to(images.device)
+
+        if self.stream is None:
+            self.stream = torch.cuda.Stream(device)
+        if images.is_cuda:
+            # the images were staged on the default stream of their device
+            self.stream.wait_stream(torch.cuda.current_stream(images.device))
+        with torch.cuda.stream(self.stream):
+            outputs = self._teacher(images.to(device, non_blocking=True))
+        # blocks the worker thread only, the student keeps running
+        self.stream.synchronize()
+        if outputs.device == images.device:
+            # the student reads the logits on its own stream
+            outputs.record_stream(torch.cuda.current_stream(images.device))
+        return outputs.to(images.device)
+
+    def _batches(self):
+        with torch.no_grad():
+            for batch in self.loader:
+                yield tuple(batch) + (self._teacher_outputs(batch[0]),)
+
+    def __iter__(self):
+        return background(self._batches(), self.depth)
+
+
+class EpochDataLoader(torch.utils.data.DataLoader):
+    """DataLoader that calls set_epoch() of its dataset or sampler before every epoch
+    (for ShardedStream and DistributedSampler)."""
+
+    def __init__(self, *args, **kwargs):
+        super(EpochDataLoader, self).__init__(*args, **kwargs)
+        self.epoch = 0
+
+    def __iter__(self):
+        for source in (self.dataset, self.sampler):
+            if hasattr(source, 'set_epoch'):
+                source.set_epoch(self.epoch)
+        self.epoch += 1
+        return super(EpochDataLoader, self).__iter__()
+
+
+def pil_to_uint8(img):
+    """PIL image -> C x H x W uint8 tensor, i.e. ToTensor without the scaling."""
+    return torch.from_numpy(np.array(img, dtype=np.uint8)).permute(2, 0, 1)
+
+
+def cached_testset(testset, test_transformer, cache_dir, name, num_workers=8):
+    """Returns the test set as uint8 images and labels, materialized once in `cache_dir`.
+
+    The deterministic part of `test_transformer` (e.g. Resize and CenterCrop) is
+    applied once and stored in `<name>_test_images.npy`, ToTensor and Normalize are
+    left to the loader. The images are memory-mapped, not read into memory.
+    Only one process may build the cache, engine.load_data builds it on rank 0
+    while the other ranks wait.
+    """
+    images_path = os.path.join(cache_dir, name + '_test_images.npy')
+    labels_path = os.path.join(cache_dir, name + '_test_labels.npy')
+
+    if not os.path.exists(labels_path):
+        os.makedirs(cache_dir, exist_ok=True)
+        testset.transform = transforms.Compose(
+            [t for t in test_transformer.transforms
+             if not isinstance(t, (transforms.ToTensor, transforms.Normalize))] + [pil_to_uint8])
+        loader = torch.utils.data.DataLoader(testset, batch_size=256, num_workers=num_workers)
+        images, labels, start = None, [], 0
+        for batch, target in loader:
+            if images is None:
+                images = np.lib.format.open_memmap(images_path + '.tmp', mode='w+', dtype=np.uint8,
+                                                   shape=(len(testset),) + tuple(batch.shape[1:]))
+            images[start:start + batch.size(0)] = batch.numpy()
+            labels.append(target)
+            start += batch.size(0)
+        images.flush()
+        del images
+        os.replace(images_path + '.tmp', images_path)
+        np.save(labels_path, torch.cat(labels).numpy())
+        testset.transform = test_transformer
+
+    # copy-on-write mapping: pages are read lazily and shared, never written back
+    images = torch.from_numpy(np.load(images_path, mmap_mode='c'))
+    labels = torch.from_numpy(np.load(labels_path))
+    return images, labels
+
+
+def cifar_tensors(dataset):
+    """Returns the images (N x 3 x 32 x 32 uint8) and labels of a torchvision CIFAR dataset."""
+    images = torch.from_numpy(dataset.data).permute(0, 3, 1, 2).contiguous()
+    return images, torch.tensor(dataset.targets, dtype=torch.long)
+
+
+def dataloader(data_name= "CIFAR100", batch_size= 64, num_workers = 8, root = './Data',
+               in_memory=False, device=None, seed=None, shards=None, eval_cache=None,
+               replay=0, rank=0, num_replicas=1):
     """
     Fetch and return train/test dataloader.
+
+    With in_memory=True, CIFAR is kept as one uint8 tensor (on `device`) and
+    augmented a batch at a time by TensorLoader, without worker processes.
+    replay > 0 restricts every training sample to `replay` fixed augmentations.
+
+    With shards set, ImageNet is read from the train/ and val/ directories
+    written by models.shards instead of the ImageFolder tree.
+
+    With eval_cache set, the transformed test set is stored once as uint8 in
+    that directory and served by TensorLoader, normalized on `device` batch by
+    batch. CIFAR is loaded onto the device, ImageNet stays memory-mapped.
+
+    With num_replicas > 1 (torch.distributed), every process gets its own part
+    of the train and test sets; batch_size is the per-process batch size and
+    all processes must pass the same seed.
     """
     kwargs = {'batch_size': batch_size, 'num_workers': num_workers, 'pin_memory': torch.cuda.is_available()}
     
@@ -80,6 +476,18 @@ def dataloader(data_name= "CIFAR100", batch_size= 64, num_workers = 8, root = '.
                 normalize,
             ])
             
+    if in_memory and data_name in ('CIFAR10', 'CIFAR100'):
+        dataset = getattr(torchvision.datasets, data_name)
+        trainset = dataset(root=root, train=True, download=True)
+        testset = dataset(root=root, train=False, download=True)
+        stats = {'mean': normalize.mean, 'std': normalize.std, 'device': device}
+        trainloader = TensorLoader(*cifar_tensors(trainset), batch_size, shuffle=True,
+                                   padding=4, flip=True, seed=seed, replay=replay,
+                                   rank=rank, num_replicas=num_replicas, **stats)
+        testloader = TensorLoader(*cifar_tensors(testset), batch_size, rank=rank,
+                                  num_replicas=num_replicas, **stats)
+        return trainloader, testloader
+
     # Choose corresponding dataset
     if data_name == 'CIFAR10':
         trainset = torchvision.datasets.CIFAR10(root=root, train=True,
@@ -95,6 +503,11 @@ def dataloader(data_name= "CIFAR100", batch_size= 64, num_workers = 8, root = '.
         testset = torchvision.datasets.CIFAR100(root=root, train=False,
             download=True, transform=test_transformer)
             
+    elif data_name == 'imagenet' and shards:
+        trainset = ShardedStream(os.path.join(shards, 'train'), train_transformer,
+                                 seed=0 if seed is None else seed, rank=rank, num_replicas=num_replicas)
+        testset = ShardedImageFolder(os.path.join(shards, 'val'), test_transformer)
+
     elif data_name == 'imagenet':
         traindir = os.path.join(root, 'train')
         valdir = os.path.join(root, 'val')
@@ -104,8 +517,24 @@ def dataloader(data_name= "CIFAR100", batch_size= 64, num_workers = 8, root = '.
         # trainset = torchvision.datasets.ImageNet(root=root, split='train', download=False, transform=train_transformer)
         # testset = torchvision.datasets.ImageNet(root=root, split='val', download=False, transform=test_transformer)
         
-    trainloader = torch.utils.data.DataLoader(trainset, shuffle = True, **kwargs)
+    if isinstance(trainset, ShardedStream):
+        trainloader = EpochDataLoader(trainset, **kwargs)
+    elif num_replicas > 1:
+        sampler = torch.utils.data.DistributedSampler(trainset, num_replicas, rank, shuffle=True,
+                                                      seed=0 if seed is None else seed, drop_last=True)
+        trainloader = EpochDataLoader(trainset, sampler=sampler, **kwargs)
+    else:
+        trainloader = torch.utils.data.DataLoader(trainset, shuffle = True, **kwargs)
     
-    testloader = torch.utils.data.DataLoader(testset, shuffle = False, **kwargs)
+    if eval_cache:
+        images, labels = cached_testset(testset, test_transformer, eval_cache, data_name, num_workers)
+        testloader = TensorLoader(images, labels, batch_size, normalize.mean, normalize.std,
+                                  device=device, preload=(data_name != 'imagenet'),
+                                  rank=rank, num_replicas=num_replicas)
+    else:
+        if num_replicas > 1:
+            # every test sample is evaluated exactly once, without padding
+            testset = torch.utils.data.Subset(testset, range(rank, len(testset), num_replicas))
+        testloader = torch.utils.data.DataLoader(testset, shuffle = False, **kwargs)
 
     return trainloader, testloader
@@ -0,0 +1,147 @@
+'''
+Memory-efficient dense blocks shared by the DenseNet models.
+
+A dense layer reads the concatenation of all features before it. Instead of
+passing a growing list of features to every layer, which then concatenates
+it, DenseBlock allocates the block output once and every layer writes its new
+features into its channels. A layer reads the prefix of the buffer filled so
+far as a zero-copy view, so the block costs linear instead of quadratic
+memory and copying in its depth.
+
+The prefix changes while the block runs, hence the concatenation, norm1 and
+relu1 are not stored for the backward but recomputed from the buffer, as in
+the efficient DenseNet implementation. Their recomputation is cheap, conv1
+is not recomputed. The running statistics of norm1 are only updated in the
+forward.
+
+Reference:
+1. https://github.com/gpleiss/efficient_densenet_pytorch
+2. Geoff Pleiss, Danlu Chen, Gao Huang, Tongcheng Li, Laurens van der Maaten, Kilian Q. Weinberger
+Memory-Efficient Implementation of DenseNets. https://arxiv.org/abs/1707.06990
+
+'''
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from .branches import checkpointed
+
+__all__ = ['DenseLayer', 'DenseBlock']
+
+
+class _SharedBottleneck(torch.autograd.Function):
+    """conv1(relu1(norm1(buffer[:, :C]))), with C the sum of `widths`.
+
+    The backward recomputes norm1 and relu1 from the buffer and returns the
+    gradients of the channels of every feature in `features`.
+    """
+
+    @staticmethod
+    def forward(ctx, layer, buffer, widths, weight, bias, conv_weight, *features):
+        ctx.layer = layer
+        ctx.widths = widths
+        ctx.save_for_backward(buffer)
+        prefix = buffer.narrow(1, 0, sum(widths))
+        return layer.conv1(layer.relu1(layer.norm1(prefix)))
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        buffer, = ctx.saved_tensors
+        norm, conv = ctx.layer.norm1, ctx.layer.conv1
+        prefix = buffer.narrow(1, 0, sum(ctx.widths)).detach().requires_grad_()
+        with torch.enable_grad():
+            # the statistics the forward normalized with, without updating the running ones
+            batch_stats = norm.training or norm.running_mean is None
+            z = F.batch_norm(prefix, None if batch_stats else norm.running_mean,
+                             None if batch_stats else norm.running_var, norm.weight, norm.bias,
+                             batch_stats, 0.0, norm.eps)
+            z = F.relu(z)
+        # the gradients of conv1 only need its input and weight, not its output
+        grad_output = grad_output.contiguous()
+        grad_z = torch.nn.grad.conv2d_input(z.shape, conv.weight.to(grad_output.dtype), grad_output,
+                                            conv.stride, conv.padding, conv.dilation, conv.groups)
+        grad_conv = torch.nn.grad.conv2d_weight(z.detach().to(grad_output.dtype), conv.weight.shape,
+                                                grad_output, conv.stride, conv.padding, conv.dilation,
+                                                conv.groups)
+        grad_prefix, grad_weight, grad_bias = torch.autograd.grad(z, [prefix, norm.weight, norm.bias], grad_z)
+        return (None, None, None, grad_weight, grad_bias, grad_conv.to(conv.weight.dtype)) + \
+            tuple(grad_prefix.split(ctx.widths, 1))
+
+
+class _SharedConcat(torch.autograd.Function):
+    """The filled buffer as the concatenation of `features`."""
+
+    @staticmethod
+    def forward(ctx, buffer, *features):
+        ctx.widths = [f.size(1) for f in features]
+        # shares the version counter, the layers notice if the output is modified in place
+        return buffer.detach()
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        return (None,) + tuple(grad_output.split(ctx.widths, 1))
+
+
+class DenseLayer(nn.Module):
+    def __init__(self, num_input_features, growth_rate, bn_size, drop_rate, efficient=False):
+        super(DenseLayer, self).__init__()
+        self.add_module('norm1', nn.BatchNorm2d(num_input_features)),
+        self.add_module('relu1', nn.ReLU(inplace=True)),
+        self.add_module('conv1', nn.Conv2d(num_input_features, bn_size * growth_rate,
+                                           kernel_size=1, stride=1, bias=False)),
+        self.add_module('norm2', nn.BatchNorm2d(bn_size * growth_rate)),
+        self.add_module('relu2', nn.ReLU(inplace=True)),
+        self.add_module('conv2', nn.Conv2d(bn_size * growth_rate, growth_rate,
+                                           kernel_size=3, stride=1, padding=1, bias=False)),
+        self.drop_rate = drop_rate
+        self.efficient = efficient
+
+    def bottleneck(self, x):
+        new_features = self.conv2(self.relu2(self.norm2(x)))
+        if self.drop_rate > 0:
+            new_features = F.dropout(new_features, p=self.drop_rate, training=self.training)
+        return new_features
+
+    def forward(self, buffer, prev_features):
+        """New features of the features in `prev_features`, which fill the first channels of `buffer`."""
+        widths = [f.size(1) for f in prev_features]
+        x = _SharedBottleneck.apply(self, buffer, widths, self.norm1.weight, self.norm1.bias,
+                                    self.conv1.weight, *prev_features)
+        if self.efficient and x.requires_grad:
+            # norm2 updates its running statistics only once, not again in the recomputation
+            return checkpointed(self.bottleneck, [self.norm2], x)
+        return self.bottleneck(x)
+
+
+class DenseBlock(nn.Module):
+    """Dense block whose layers share one output buffer.
+
+    The output must not be modified in place before the backward.
+    """
+
+    def __init__(self, num_layers, num_input_features, bn_size, growth_rate, drop_rate, efficient=False):
+        super(DenseBlock, self).__init__()
+        self.num_output_features = num_input_features + num_layers * growth_rate
+        for i in range(num_layers):
+            layer = DenseLayer(
+                num_input_features + i * growth_rate,
+                growth_rate=growth_rate,
+                bn_size=bn_size,
+                drop_rate=drop_rate,
+                efficient=efficient,
+            )
+            self.add_module('denselayer%d' % (i + 1), layer)
+
+    def forward(self, init_features):
+        n, c, h, w = init_features.shape
+        buffer = init_features.new_empty(n, self.num_output_features, h, w)
+        # writes through .data do not count as modifications of the buffer the layers saved
+        storage = buffer.data
+        storage.narrow(1, 0, c).copy_(init_features.detach())
+        features = [init_features]
+        for name, layer in self.named_children():
+            new_features = layer(buffer, features)
+            storage.narrow(1, c, new_features.size(1)).copy_(new_features.detach())
+            c += new_features.size(1)
+            features.append(new_features)
+        return _SharedConcat.apply(buffer, *features)
@@ -0,0 +1,125 @@
+'''
+Folding of inference-mode BatchNorm into the preceding convolution or linear layer.
+
+In eval mode a BatchNorm is a per-channel affine map, so when it directly
+normalizes the output of a Conv2d (or of a Linear, for BatchNorm1d) it can be
+merged into the weight and bias of that layer and removed. This saves one
+read and write of the activation per folded BatchNorm.
+
+The pairs are found by running the model once with forward hooks instead of
+with per-architecture rules: a BatchNorm folds into a layer when on every call
+it reads the tensor the layer wrote, and nothing but the BatchNorm reads it.
+Hence the same pass covers ResNet blocks and downsamples, VGG, the bottleneck
+of the dense layers (conv1 -> norm2), MobileNetV2 ConvBNActivation, ShuffleNetV2
+and the ONE gate, whereas pre-activation BatchNorms (DenseNet norm1 and the
+transitions) are kept. Operations outside modules are not seen by the hooks,
+so the folded model is always checked against the original one.
+
+Example:
+```
+leader = fold_batchnorm(resnet32(pretrained=True, path='leader.pth', num_classes=100).eval())
+```
+'''
+import copy
+import logging
+
+import torch
+import torch.nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_weights, fuse_linear_bn_weights
+
+__all__ = ['foldable_pairs', 'fold_batchnorm']
+
+
+def _is_leaf(module):
+    return next(module.children(), None) is None
+
+
+def foldable_pairs(model, *inputs):
+    """Returns the (layer, norm) pairs of `model` where `norm` can be folded into `layer`.
+
+    Args:
+        model: (nn.Module) the network in eval mode
+        inputs: (Tensor) the arguments of one forward pass
+    """
+    producer = {}       # id of a tensor -> the leaf module that wrote it last
+    outputs = []        # keeps the tensors alive, so that their ids are not reused
+    sources = {}        # norm -> the modules that wrote its inputs
+    readers = {}        # layer -> the modules that read its outputs
+
+    def hook(module, args, output):
+        for arg in args:
+            if torch.is_tensor(arg) and id(arg) in producer:
+                readers.setdefault(producer[id(arg)], set()).add(module)
+        if isinstance(module, nn.modules.batchnorm._BatchNorm):
+            # BatchNorm1d normalizes the features of a Linear only for B x C inputs
+            source = producer.get(id(args[0])) if args[0].dim() != 3 else None
+            sources.setdefault(module, set()).add(source)
+        if torch.is_tensor(output):
+            # an in-place module (e.g. ReLU) becomes the producer of its input
+            producer[id(output)] = module
+            outputs.append(output)
+
+    handles = [m.register_forward_hook(hook) for m in model.modules() if _is_leaf(m)]
+    try:
+        with torch.no_grad():
+            model(*inputs)
+    finally:
+        for handle in handles:
+            handle.remove()
+
+    pairs = []
+    for norm, layers in sources.items():
+        if len(layers) != 1:
+            continue
+        layer, = layers
+        if layer is None or readers.get(layer) != {norm} or norm.running_mean is None:
+            continue
+        if isinstance(layer, nn.Conv2d) or (isinstance(layer, nn.Linear) and isinstance(norm, nn.BatchNorm1d)):
+            pairs.append((layer, norm))
+    return pairs
+
+
+def _flatten(output):
+    if torch.is_tensor(output):
+        return [output]
+    return [t for o in output for t in _flatten(o)]
+
+
+def fold_batchnorm(model, input_size=(8, 3, 32, 32), rtol=1e-4, atol=1e-4):
+    """Returns a copy of `model` with every foldable BatchNorm folded and replaced by nn.Identity.
+
+    The copy is checked against `model` on random inputs of `input_size`.
+
+    Args:
+        model: (nn.Module) the network in eval mode
+        input_size: (tuple) the shape of the random inputs
+        rtol, atol: (float) the tolerances of the parity check
+    """
+    if model.training:
+        raise ValueError('BatchNorm folding needs a model in eval mode')
+    folded = copy.deepcopy(model)
+    param = next(model.parameters())
+    x = torch.randn(input_size, device=param.device, dtype=param.dtype)
+
+    pairs = foldable_pairs(folded, x)
+    with torch.no_grad():
+        for layer, norm in pairs:
+            fuse = fuse_linear_bn_weights if isinstance(layer, nn.Linear) else fuse_conv_bn_weights
+            layer.weight, layer.bias = fuse(layer.weight, layer.bias, norm.running_mean, norm.running_var,
+                                            norm.eps, norm.weight, norm.bias)
+    norms = set(norm for _, norm in pairs)
+    for module in folded.modules():
+        # _modules also lists a module registered under several names
+        for name, child in list(module._modules.items()):
+            if child in norms:
+                setattr(module, name, nn.Identity())
+
+    with torch.no_grad():
+        expected, actual = _flatten(model(x)), _flatten(folded(x))
+    diff = max((e - a).abs().max().item() for e, a in zip(expected, actual))
+    logging.info('- Folded {} of {} BatchNorm layers, max abs difference {:.3g}'.format(
+        len(pairs), sum(isinstance(m, nn.modules.batchnorm._BatchNorm) for m in model.modules()), diff))
+    if not all(torch.allclose(a, e, rtol=rtol, atol=atol) for e, a in zip(expected, actual)):
+        raise ValueError('the folded model does not reproduce the outputs of the model '
+                         '(max abs difference {:.3g})'.format(diff))
+    return folded
@@ -1,5 +1,5 @@
-import torch
 import torch.nn as nn
+from ..branches import BranchCollector, checkpoint_policy, run_stage
 from .resnet import *
 from .densenet import *
 from .vgg import *
@@ -10,9 +10,11 @@ __all__ = ['MutualNet']
 
 
 class MutualNet(nn.Module):
-    def __init__(self, model="resnet32", num_branches=4, num_classes=10, dropout=0.0):
+    def __init__(self, model="resnet32", num_branches=4, num_classes=10, dropout=0.0, checkpoint='none'):
         super(MutualNet, self).__init__()
         self.num_branches = num_branches
+        # the students share no trunk, 'branches' and 'all' checkpoint every student as a whole
+        self.checkpoint_trunk, self.checkpoint_branches = checkpoint_policy(checkpoint)
 
         for i in range(num_branches):
             if model == "resnet18":
@@ -36,10 +38,8 @@ class MutualNet(nn.Module):
                 raise NotImplementedError(model)
 
     def forward(self, x):
-        out = self.stu0(x)
-        out = out.unsqueeze(-1)
-        for i in range(1, self.num_branches):
-            temp_out = getattr(self, 'stu'+str(i))(x)
-            temp_out = temp_out.unsqueeze(-1)
-            out = torch.cat([out, temp_out], -1)
+        branches = BranchCollector()
+        for i in range(self.num_branches):
+            branches.append(run_stage(getattr(self, 'stu'+str(i)), x, self.checkpoint_branches))
+        out, _ = branches.stack()        # B x num_classes x num_branches
         return out
@@ -1,6 +1,5 @@
-import torch
 import torch.nn as nn
-import torch.nn.functional as F
+from ..branches import BranchCollector, PeerAttention, legacy_attention_keys
 from .resnet import *
 from .vgg import *
 from .densenet import *
@@ -31,57 +30,24 @@ class StuNet(nn.Module):
                 setattr(self, 'stu'+str(i),
                         wide_resnet20_8(num_classes=num_classes, KD=True))
 
-        self.query_weight = nn.Linear(
-            input_channel, input_channel//factor, bias=False)
-        self.key_weight = nn.Linear(
-            input_channel, input_channel//factor, bias=False)
+        self.attention = PeerAttention(input_channel, factor)
+        self._register_load_state_dict_pre_hook(legacy_attention_keys)
 
     def forward(self, x):
         # (B X 64), (B X num_classes)
-        x_f, pro = self.stu0(x)
-        # B x input_channel//factor
-        proj_query = self.query_weight(x_f)
-        # B x input_channel//factor
-        proj_key = self.key_weight(x_f)
-
-        proj_query = proj_query[:, None, :]
-        proj_key = proj_key[:, None, :]
-        pro = pro.unsqueeze(-1)
+        x_f, temp_pro = self.stu0(x)
+        branches = BranchCollector()
+        branches.append(temp_pro, x_f)
+        num_peers = self.num_branches if self.en else self.num_branches - 1
+        for i in range(1, num_peers):
+            temp_x_f, temp_pro = getattr(self, 'stu'+str(i))(x)
+            branches.append(temp_pro, temp_x_f)
+        # B X num_classes X num_students, B X num_students X input_channel
+        pro, feats = branches.stack()
+        x_m = self.attention(feats, pro)
         if self.en:
-            for i in range(1, self.num_branches):
-                temp_x_f, temp_pro = getattr(self, 'stu'+str(i))(x)
-                # B x input_channel//factor
-                x_f_q = self.query_weight(temp_x_f)
-                # B x input_channel//factor
-                x_f_k = self.key_weight(temp_x_f)
-                temp_pro = temp_pro.unsqueeze(-1)
-                # B X num_students X input_channel//factor
-                proj_query = torch.cat([proj_query, x_f_q[:, None, :]], 1)
-                proj_key = torch.cat([proj_key, x_f_k[:, None, :]], 1)
-                # B X num_classes X num_students
-                pro = torch.cat([pro, temp_pro], -1)
-                # B X num_students X num_features
-            energy = torch.bmm(proj_query, proj_key.permute(0, 2, 1))
-            attention = F.softmax(energy, dim=-1)
-            x_m = torch.bmm(pro, attention.permute(0, 2, 1))
             return pro, x_m
-        else:
-            for i in range(1, self.num_branches-1):
-                temp_x_f, temp_pro = getattr(self, 'stu'+str(i))(x)
-                # B x input_channel//factor
-                x_f_q = self.query_weight(temp_x_f)
-                # B x input_channel//factor
-                x_f_k = self.key_weight(temp_x_f)
-                temp_pro = temp_pro.unsqueeze(-1)
-                # B X num_students X input_channel//factor
-                proj_query = torch.cat([proj_query, x_f_q[:, None, :]], 1)
-                proj_key = torch.cat([proj_key, x_f_k[:, None, :]], 1)
-                # B X num_classes X num_students
-                pro = torch.cat([pro, temp_pro], -1)
-            energy = torch.bmm(proj_query, proj_key.permute(0, 2, 1))
-            attention = F.softmax(energy, dim=-1)
-            x_m = torch.bmm(pro, attention.permute(0, 2, 1))
 
-            _, temp_pro = getattr(self, 'stu'+str(self.num_branches - 1))(x)
+        _, temp_pro = getattr(self, 'stu'+str(self.num_branches - 1))(x)
 
-            return pro, x_m, temp_pro
+        return pro, x_m, temp_pro
@@ -12,49 +12,13 @@ Densely Connetcted Convolutional Networks. https://arxiv.org/abs/1608.06993
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-import torch.utils.checkpoint as cp
 from collections import OrderedDict
+from ..dense_blocks import DenseBlock
 
 __all__ = ['DenseNet', 'densenetd40k12', 'densenetd100k12', "densenet121",
            'densenetd100k40', 'densenetd190k12']
 
 
-def _bn_function_factory(norm, relu, conv):
-    def bn_function(*inputs):
-        concated_features = torch.cat(inputs, 1)
-        bottleneck_output = conv(relu(norm(concated_features)))
-        return bottleneck_output
-
-    return bn_function
-
-
-class _DenseLayer(nn.Module):
-    def __init__(self, num_input_features, growth_rate, bn_size, drop_rate, efficient=False):
-        super(_DenseLayer, self).__init__()
-        self.add_module('norm1', nn.BatchNorm2d(num_input_features)),
-        self.add_module('relu1', nn.ReLU(inplace=True)),
-        self.add_module('conv1', nn.Conv2d(num_input_features, bn_size * growth_rate,
-                                           kernel_size=1, stride=1, bias=False)),
-        self.add_module('norm2', nn.BatchNorm2d(bn_size * growth_rate)),
-        self.add_module('relu2', nn.ReLU(inplace=True)),
-        self.add_module('conv2', nn.Conv2d(bn_size * growth_rate, growth_rate,
-                                           kernel_size=3, stride=1, padding=1, bias=False)),
-        self.drop_rate = drop_rate
-        self.efficient = efficient
-
-    def forward(self, *prev_features):
-        bn_function = _bn_function_factory(self.norm1, self.relu1, self.conv1)
-        if self.efficient and any(prev_feature.requires_grad for prev_feature in prev_features):
-            bottleneck_output = cp.checkpoint(bn_function, *prev_features)
-        else:
-            bottleneck_output = bn_function(*prev_features)
-        new_features = self.conv2(self.relu2(self.norm2(bottleneck_output)))
-        if self.drop_rate > 0:
-            new_features = F.dropout(
-                new_features, p=self.drop_rate, training=self.training)
-        return new_features
-
-
 class _Transition(nn.Sequential):
     def __init__(self, num_input_features, num_output_features):
         super(_Transition, self).__init__()
@@ -65,27 +29,6 @@ class _Transition(nn.Sequential):
         self.add_module('pool', nn.AvgPool2d(kernel_size=2, stride=2))
 
 
-class _DenseBlock(nn.Module):
-    def __init__(self, num_layers, num_input_features, bn_size, growth_rate, drop_rate, efficient=False):
-        super(_DenseBlock, self).__init__()
-        for i in range(num_layers):
-            layer = _DenseLayer(
-                num_input_features + i * growth_rate,
-                growth_rate=growth_rate,
-                bn_size=bn_size,
-                drop_rate=drop_rate,
-                efficient=efficient,
-            )
-            self.add_module('denselayer%d' % (i + 1), layer)
-
-    def forward(self, init_features):
-        features = [init_features]
-        for name, layer in self.named_children():
-            new_features = layer(*features)
-            features.append(new_features)
-        return torch.cat(features, 1)
-
-
 class DenseNet(nn.Module):
     r"""Densenet-BC model class, based on
     `"Densely Connected Convolutional Networks" <https://arxiv.org/pdf/1608.06993.pdf>`
@@ -98,25 +41,31 @@ class DenseNet(nn.Module):
         drop_rate (float) - dropout rate after each dense layer
         num_classes (int) - number of classification classes
         small_inputs (bool) - set to True if images are 32x32. Otherwise assumes images are larger.
-        efficient (bool) - set to True to use checkpointing. Much more memory efficient, but slower.
+        efficient (bool) - set to True to also recompute norm2, relu2 and conv2 of every dense layer in the backward. More memory efficient, but slower.
+        stem_norm (bool) - set to False to skip norm0 and relu0 with small inputs, as densenet_GL does.
+        final_norm (bool) - set to False to classify the last dense block without norm_final and relu,
+            as the densenet_GL group leader does.
     """
 
     def __init__(self, growth_rate=12, block_config=[16, 16, 16], compression=0.5,
                  num_init_features=24, bn_size=4, drop_rate=0,
-                 num_classes=10, small_inputs=True, efficient=False, KD=False):
+                 num_classes=10, small_inputs=True, efficient=False, KD=False,
+                 stem_norm=True, final_norm=True):
 
         super(DenseNet, self).__init__()
         assert 0 < compression <= 1, 'compression of densenet should be between 0 and 1'
         self.avgpool_size = 8 if small_inputs else 7
         self.KD = KD
+        self.final_norm = final_norm
         # First convolution
         if small_inputs:
             self.features = nn.Sequential(OrderedDict([
                 ('conv0', nn.Conv2d(3, num_init_features,
                                     kernel_size=3, stride=1, padding=1, bias=False)),
-                ('norm0', nn.BatchNorm2d(num_init_features)),
-                ('relu0', nn.ReLU(inplace=True)),
             ]))
+            if stem_norm:
+                self.features.add_module('norm0', nn.BatchNorm2d(num_init_features))
+                self.features.add_module('relu0', nn.ReLU(inplace=True))
         else:
             self.features = nn.Sequential(OrderedDict([
                 ('conv0', nn.Conv2d(3, num_init_features,
@@ -131,7 +80,7 @@ class DenseNet(nn.Module):
         # Each denseblock
         num_features = num_init_features
         for i, num_layers in enumerate(block_config):
-            block = _DenseBlock(
+            block = DenseBlock(
                 num_layers=num_layers,
                 num_input_features=num_features,
                 bn_size=bn_size,
@@ -148,7 +97,8 @@ class DenseNet(nn.Module):
                 num_features = int(num_features * compression)
 
         # Final batch norm
-        self.features.add_module('norm_final', nn.BatchNorm2d(num_features))
+        if final_norm:
+            self.features.add_module('norm_final', nn.BatchNorm2d(num_features))
 
         # Linear layer
         self.classifier = nn.Linear(num_features, num_classes)
@@ -168,7 +118,7 @@ class DenseNet(nn.Module):
         # D40K12    B x 132 x 8 x 8
         # D100K12   B x 342 x 8 x 8
         # D100K40   B x 1126 x 8 x 8
-        x = F.relu(features, inplace=True)
+        x = F.relu(features, inplace=True) if self.final_norm else features
         x_f = F.adaptive_avg_pool2d(x, (1, 1))
         x_f = torch.flatten(x_f, 1)
         x = self.classifier(x_f)
@@ -202,7 +152,7 @@ def densenetd40k12(pretrained=False, path=None, **kwargs):
 
     model = DenseNet(growth_rate=12, block_config=[6, 6, 6], **kwargs)
     if pretrained:
-        model.load_state_dict((torch.load(path))['state_dict'])
+        model.load_state_dict((torch.load(path, map_location='cpu'))['state_dict'])
     return model
 
 
@@ -216,7 +166,7 @@ def densenetd100k12(pretrained=False, path=None, **kwargs):
 
     model = DenseNet(growth_rate=12, block_config=[16, 16, 16], **kwargs)
     if pretrained:
-        model.load_state_dict((torch.load(path))['state_dict'])
+        model.load_state_dict((torch.load(path, map_location='cpu'))['state_dict'])
     return model
 
 
@@ -230,7 +180,7 @@ def densenetd190k12(pretrained=False, path=None, **kwargs):
 
     model = DenseNet(growth_rate=12, block_config=[31, 31, 31], **kwargs)
     if pretrained:
-        model.load_state_dict((torch.load(path))['state_dict'])
+        model.load_state_dict((torch.load(path, map_location='cpu'))['state_dict'])
     return model
 
 
@@ -244,5 +194,5 @@ def densenetd100k40(pretrained=False, path=None, **kwargs):
 
     model = DenseNet(growth_rate=40, block_config=[16, 16, 16], **kwargs)
     if pretrained:
-        model.load_state_dict((torch.load(path))['state_dict'])
+        model.load_state_dict((torch.load(path, map_location='cpu'))['state_dict'])
     return model
@@ -11,47 +11,12 @@ Densely Connetcted Convolutional Networks. https://arxiv.org/abs/1608.06993
 '''
 import torch
 import torch.nn as nn
-import torch.nn.functional as F
-import torch.utils.checkpoint as cp
 from collections import OrderedDict
+from ..branches import BranchCollector, PeerAttention, legacy_attention_keys, checkpoint_policy
+from ..dense_blocks import DenseBlock
 
 __all__ = ['DenseNet', 'densenetd40k12', 'densenetd100k12']
 
-def _bn_function_factory(norm, relu, conv):
-    def bn_function(*inputs):
-        concated_features = torch.cat(inputs, 1)
-        bottleneck_output = conv(relu(norm(concated_features)))
-        return bottleneck_output
-
-    return bn_function
-
-
-class _DenseLayer(nn.Module):
-    def __init__(self, num_input_features, growth_rate, bn_size, drop_rate, efficient=False):
-        super(_DenseLayer, self).__init__()
-        self.add_module('norm1', nn.BatchNorm2d(num_input_features)),
-        self.add_module('relu1', nn.ReLU(inplace=True)),
-        self.add_module('conv1', nn.Conv2d(num_input_features, bn_size * growth_rate,
-                        kernel_size=1, stride=1, bias=False)),
-        self.add_module('norm2', nn.BatchNorm2d(bn_size * growth_rate)),
-        self.add_module('relu2', nn.ReLU(inplace=True)),
-        self.add_module('conv2', nn.Conv2d(bn_size * growth_rate, growth_rate,
-                        kernel_size=3, stride=1, padding=1, bias=False)),
-        self.drop_rate = drop_rate
-        self.efficient = efficient
-
-    def forward(self, *prev_features):
-        bn_function = _bn_function_factory(self.norm1, self.relu1, self.conv1)
-        if self.efficient and any(prev_feature.requires_grad for prev_feature in prev_features):
-            bottleneck_output = cp.checkpoint(bn_function, *prev_features)
-        else:
-            bottleneck_output = bn_function(*prev_features)
-        new_features = self.conv2(self.relu2(self.norm2(bottleneck_output)))
-        if self.drop_rate > 0:
-            new_features = F.dropout(new_features, p=self.drop_rate, training=self.training)
-        return new_features
-
-
 class _Transition(nn.Sequential):
     def __init__(self, num_input_features, num_output_features):
         super(_Transition, self).__init__()
@@ -62,26 +27,6 @@ class _Transition(nn.Sequential):
         self.add_module('pool', nn.AvgPool2d(kernel_size=2, stride=2))
 
 
-class _DenseBlock(nn.Module):
-    def __init__(self, num_layers, num_input_features, bn_size, growth_rate, drop_rate, efficient=False):
-        super(_DenseBlock, self).__init__()
-        for i in range(num_layers):
-            layer = _DenseLayer(
-                num_input_features + i * growth_rate,
-                growth_rate=growth_rate,
-                bn_size=bn_size,
-                drop_rate=drop_rate,
-                efficient=efficient,
-            )
-            self.add_module('denselayer%d' % (i + 1), layer)
-
-    def forward(self, init_features):
-        features = [init_features]
-        for name, layer in self.named_children():
-            new_features = layer(*features)
-            features.append(new_features)
-        return torch.cat(features, 1)
-
 class ILR(torch.autograd.Function):
     """
     We can implement our own custom autograd Functions by subclassing
@@ -123,15 +68,18 @@ class DenseNet(nn.Module):
         drop_rate (float) - dropout rate after each dense layer
         num_classes (int) - number of classification classes
         small_inputs (bool) - set to True if images are 32x32. Otherwise assumes images are larger.
-        efficient (bool) - set to True to use checkpointing. Much more memory efficient, but slower.
+        efficient (bool) - set to True to also recompute norm2, relu2 and conv2 of every dense layer in the backward. More memory efficient, but slower.
+        checkpoint (str) - 'none', 'trunk', 'branches' or 'all': the dense blocks checkpointed
+            as with `efficient`, 'branches' covers the last block shared by the branches
     """
     def __init__(self, growth_rate=12, block_config=(16, 16, 16), num_branches = 3, bpscale = False, input_channel= 132, factor = 8, compression=0.5,
                  num_init_features=24, bn_size=4, drop_rate=0,
-                 num_classes=10, small_inputs=True, efficient=False):
+                 num_classes=10, small_inputs=True, efficient=False, checkpoint='none'):
 
         super(DenseNet, self).__init__()
         assert 0 < compression <= 1, 'compression of densenet should be between 0 and 1'
         self.avgpool_size = 8 if small_inputs else 7
+        checkpoint_trunk, checkpoint_branches = checkpoint_policy(checkpoint)
         self.num_branches = num_branches
         self.bpscale = bpscale
         # First convolution
@@ -152,13 +100,13 @@ class DenseNet(nn.Module):
         num_features = num_init_features
         for i, num_layers in enumerate(block_config):
             if i != len(block_config) - 1:
-                block = _DenseBlock(
+                block = DenseBlock(
                     num_layers=num_layers,
                     num_input_features=num_features,
                     bn_size=bn_size,
                     growth_rate=growth_rate,
                     drop_rate=drop_rate,
-                    efficient=efficient,
+                    efficient=efficient or checkpoint_trunk,
                 )
                 self.features.add_module('denseblock%d' % (i + 1), block)
                 num_features = num_features + num_layers * growth_rate
@@ -168,13 +116,13 @@ class DenseNet(nn.Module):
                 self.features.add_module('transition%d' % (i + 1), trans)
                 num_features = int(num_features * compression)
             else:                
-                block = _DenseBlock(
+                block = DenseBlock(
                 num_layers=num_layers,
                 num_input_features=num_features,
                 bn_size=bn_size,
                 growth_rate=growth_rate,
                 drop_rate=drop_rate,
-                efficient=efficient,
+                efficient=efficient or checkpoint_branches,
                 )
                 for i in range(self.num_branches):
                     setattr(self, 'Branch' + str(i), block)
@@ -202,48 +150,65 @@ class DenseNet(nn.Module):
             elif isinstance(m, nn.Linear):
                 nn.init.constant_(m.bias, 0)
                 
-        self.query_weight = nn.Linear(input_channel, input_channel//factor, bias = False)
-        self.key_weight = nn.Linear(input_channel, input_channel//factor, bias = False)
+        self.attention = PeerAttention(input_channel, factor)
+        self._register_load_state_dict_pre_hook(legacy_attention_keys)
         if self.bpscale:
             self.layer_ILR = ILR.apply
             
+    def trunk_modules(self):
+        # every Branch_i is the same dense block, branch parallelism runs it once in the trunk
+        return ['features'] + ['Branch' + str(i) for i in range(self.num_branches)]
+
+    def branch_modules(self, i):
+        return ['norm_final_' + str(i), 'relu_final_' + str(i), 'classifier3_' + str(i)]
+
+    def trunk(self, x):
+        x = self.features(x)
+        if self.bpscale:
+            x = self.layer_ILR(x, self.num_branches)
+        return self.Branch0(x)                  # B x 132 x 8 x 8
+
+    def branches(self, x, indices):
+        # logits and attention projections, each B x len(indices) x K, and the leader logits
+        # (classifier on the raw block output) B x 1 x K, zeros unless the leader is in indices
+        feats, logits = [], []
+        for i in indices:
+            temp = getattr(self, 'relu_final_' + str(i))(getattr(self, 'norm_final_' + str(i))(x))
+            temp = self.avgpool(temp).flatten(1)
+            feats.append(temp)
+            logits.append(getattr(self, 'classifier3_' + str(i))(temp))
+        leader = self.num_branches - 1
+        if leader in indices:
+            lead = getattr(self, 'classifier3_' + str(leader))(self.avgpool(x).flatten(1))
+        else:
+            lead = torch.zeros_like(logits[-1])
+        return (torch.stack(logits, 1), self.attention.project(torch.stack(feats, 1)),
+                lead.unsqueeze(1))
+
+    def head(self, logits, proj, leads):
+        # leads holds one column per rank, the last rank owns the leader
+        pro = logits.transpose(1, 2)            # B x num_classes x num_branches
+        x_m = self.attention.aggregate(proj, pro)
+        return pro, x_m, leads[:, -1]
+
     def forward(self, x):
         # For depth 40 growth_rate 1      B x 3 x 32 x 32
         x = self.features(x)            # B x 60 x 8 x 8 
         if self.bpscale:
             x = self.layer_ILR(x, self.num_branches)
             
-        x_3 = getattr(self, 'Branch0')(x)         # B x 132 x 8 x 8
-        x_3 = getattr(self, 'norm_final_0')(x_3)
-        x_3 = getattr(self, 'relu_final_0')(x_3)
-        x_3 = self.avgpool(x_3).view(x_3.size(0), -1)         # B x 132 
-        proj_q = self.query_weight(x_3)     # B x 8
-        proj_q = proj_q[:, None, :]
-        proj_k = self.key_weight(x_3)       # B x 8  
-        proj_k = proj_k[:, None, :]
-        x_3_1 = getattr(self, 'classifier3_0')(x_3)                         # B x num_classes
-        pro = x_3_1.unsqueeze(-1)
-        for i in range(1, self.num_branches):
-            temp = getattr(self, 'Branch' + str(i))(x)
-            temp = getattr(self, 'norm_final_' + str(i))(temp)
+        # every Branch_i is the same dense block, run it once for all the branches and the leader
+        x = self.Branch0(x)             # B x 132 x 8 x 8
+        branches = BranchCollector()
+        for i in range(self.num_branches):
+            temp = getattr(self, 'norm_final_' + str(i))(x)
             temp = getattr(self, 'relu_final_' + str(i))(temp)
             temp = self.avgpool(temp).view(temp.size(0), -1)         # B x 132 
-            temp_q = self.query_weight(temp)
-            temp_k = self.key_weight(temp)
-            temp_q = temp_q[:, None, :]
-            temp_k = temp_k[:, None, :]
-            temp_1 = getattr(self, 'classifier3_' + str(i))(temp)      # B x num_classes
-            temp_1 = temp_1.unsqueeze(-1)
-            pro = torch.cat([pro, temp_1], -1)
-            proj_q = torch.cat([proj_q, temp_q], 1) # B x num_branches x 8
-            proj_k = torch.cat([proj_k, temp_k], 1) 
-            
-        energy =  torch.bmm(proj_q, proj_k.permute(0,2,1)) 
-        attention = F.softmax(energy, dim = -1) 
-        x_m = torch.bmm(pro, attention.permute(0,2,1))
+            branches.append(getattr(self, 'classifier3_' + str(i))(temp), temp)   # B x num_classes
+        pro, feats = branches.stack()   # B x num_classes x num_branches, B x num_branches x 132
+        x_m = self.attention(feats, pro)
         
-        temp = getattr(self, 'Branch'+str(self.num_branches - 1))(x)
-        temp = self.avgpool(temp)       # B x 64 x 1 x 1
+        temp = self.avgpool(x)       # B x 132 x 1 x 1
         temp = temp.view(temp.size(0), -1)   
         temp_out = getattr(self, 'classifier3_' + str(self.num_branches - 1))(temp)
         return pro, x_m, temp_out
@@ -264,7 +229,7 @@ def densenetd40k12(pretrained=False, path=None, **kwargs):
     
     model = DenseNet(growth_rate = 12, block_config = [6,6,6], **kwargs)
     if pretrained:
-        model.load_state_dict((torch.load(path))['state_dict'])
+        model.load_state_dict((torch.load(path, map_location='cpu'))['state_dict'])
     return model
 
 def densenetd100k12(pretrained=False, path=None, **kwargs):
@@ -277,5 +242,5 @@ def densenetd100k12(pretrained=False, path=None, **kwargs):
     
     model = DenseNet(growth_rate = 12, block_config = [16,16,16], **kwargs)
     if pretrained:
-        model.load_state_dict((torch.load(path))['state_dict'])
+        model.load_state_dict((torch.load(path, map_location='cpu'))['state_dict'])
     return model
\ No newline at end of file
@@ -15,46 +15,12 @@ Densely Connetcted Convolutional Networks. https://arxiv.org/abs/1608.06993
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-import torch.utils.checkpoint as cp
 from collections import OrderedDict
+from ..branches import BranchCollector, peer_mean, gated_ensemble, checkpoint_policy
+from ..dense_blocks import DenseBlock
 
 __all__ = ['DenseNet', 'densenetd40k12', 'densenetd100k12', 'densenetd100k40']
 
-def _bn_function_factory(norm, relu, conv):
-    def bn_function(*inputs):
-        concated_features = torch.cat(inputs, 1)
-        bottleneck_output = conv(relu(norm(concated_features)))
-        return bottleneck_output
-
-    return bn_function
-
-
-class _DenseLayer(nn.Module):
-    def __init__(self, num_input_features, growth_rate, bn_size, drop_rate, efficient=False):
-        super(_DenseLayer, self).__init__()
-        self.add_module('norm1', nn.BatchNorm2d(num_input_features)),
-        self.add_module('relu1', nn.ReLU(inplace=True)),
-        self.add_module('conv1', nn.Conv2d(num_input_features, bn_size * growth_rate,
-                        kernel_size=1, stride=1, bias=False)),
-        self.add_module('norm2', nn.BatchNorm2d(bn_size * growth_rate)),
-        self.add_module('relu2', nn.ReLU(inplace=True)),
-        self.add_module('conv2', nn.Conv2d(bn_size * growth_rate, growth_rate,
-                        kernel_size=3, stride=1, padding=1, bias=False)),
-        self.drop_rate = drop_rate
-        self.efficient = efficient
-
-    def forward(self, *prev_features):
-        bn_function = _bn_function_factory(self.norm1, self.relu1, self.conv1)
-        if self.efficient and any(prev_feature.requires_grad for prev_feature in prev_features):
-            bottleneck_output = cp.checkpoint(bn_function, *prev_features)
-        else:
-            bottleneck_output = bn_function(*prev_features)
-        new_features = self.conv2(self.relu2(self.norm2(bottleneck_output)))
-        if self.drop_rate > 0:
-            new_features = F.dropout(new_features, p=self.drop_rate, training=self.training)
-        return new_features
-
-
 class _Transition(nn.Sequential):
     def __init__(self, num_input_features, num_output_features):
         super(_Transition, self).__init__()
@@ -65,26 +31,6 @@ class _Transition(nn.Sequential):
         self.add_module('pool', nn.AvgPool2d(kernel_size=2, stride=2))
 
 
-class _DenseBlock(nn.Module):
-    def __init__(self, num_layers, num_input_features, bn_size, growth_rate, drop_rate, efficient=False):
-        super(_DenseBlock, self).__init__()
-        for i in range(num_layers):
-            layer = _DenseLayer(
-                num_input_features + i * growth_rate,
-                growth_rate=growth_rate,
-                bn_size=bn_size,
-                drop_rate=drop_rate,
-                efficient=efficient,
-            )
-            self.add_module('denselayer%d' % (i + 1), layer)
-
-    def forward(self, init_features):
-        features = [init_features]
-        for name, layer in self.named_children():
-            new_features = layer(*features)
-            features.append(new_features)
-        return torch.cat(features, 1)
-
 class ILR(torch.autograd.Function):
 
     @staticmethod
@@ -110,15 +56,18 @@ class DenseNet(nn.Module):
         drop_rate (float) - dropout rate after each dense layer
         num_classes (int) - number of classification classes
         small_inputs (bool) - set to True if images are 32x32. Otherwise assumes images are larger.
-        efficient (bool) - set to True to use checkpointing. Much more memory efficient, but slower.
+        efficient (bool) - set to True to also recompute norm2, relu2 and conv2 of every dense layer in the backward. More memory efficient, but slower.
+        checkpoint (str) - 'none', 'trunk', 'branches' or 'all': the dense blocks checkpointed
+            as with `efficient`, 'branches' covers the last block shared by the branches
     """
     def __init__(self, growth_rate=12, block_config=(16, 16, 16), num_branches = 3, bpscale = False, avg=False, compression=0.5,
                  num_init_features=24, bn_size=4, drop_rate=0,
-                 num_classes=10, small_inputs=True, efficient=False, ind = False):
+                 num_classes=10, small_inputs=True, efficient=False, checkpoint='none', ind = False):
 
         super(DenseNet, self).__init__()
         assert 0 < compression <= 1, 'compression of densenet should be between 0 and 1'
         self.avgpool_size = 8 if small_inputs else 7
+        checkpoint_trunk, checkpoint_branches = checkpoint_policy(checkpoint)
         self.num_branches = num_branches
         self.avg = avg
         self.ind = ind
@@ -141,13 +90,13 @@ class DenseNet(nn.Module):
         num_features = num_init_features
         for i, num_layers in enumerate(block_config):
             if i != len(block_config) - 1:
-                block = _DenseBlock(
+                block = DenseBlock(
                     num_layers=num_layers,
                     num_input_features=num_features,
                     bn_size=bn_size,
                     growth_rate=growth_rate,
                     drop_rate=drop_rate,
-                    efficient=efficient,
+                    efficient=efficient or checkpoint_trunk,
                 )
                 self.features.add_module('denseblock%d' % (i + 1), block)
                 num_features = num_features + num_layers * growth_rate
@@ -157,13 +106,13 @@ class DenseNet(nn.Module):
                 self.features.add_module('transition%d' % (i + 1), trans)
                 num_features = int(num_features * compression)
             else:                
-                block = _DenseBlock(
+                block = DenseBlock(
                 num_layers=num_layers,
                 num_input_features=num_features,
                 bn_size=bn_size,
                 growth_rate=growth_rate,
                 drop_rate=drop_rate,
-                efficient=efficient,
+                efficient=efficient or checkpoint_branches,
                 )
                 for i in range(self.num_branches):
                     setattr(self, 'layer3_' + str(i), block)
@@ -208,32 +157,21 @@ class DenseNet(nn.Module):
         x_3 = getattr(self, 'norm_final_0')(x_3)
         x_3 = getattr(self, 'relu_final_0')(x_3)
         x_3 = self.avgpool(x_3).view(x_3.size(0), -1)         # B x 132 
-        x_3_1 = getattr(self, 'classifier3_0')(x_3)                         # B x num_classes
-        pro = x_3_1.unsqueeze(-1)
+        branches = BranchCollector()
+        branches.append(getattr(self, 'classifier3_0')(x_3))                # B x num_classes
         for i in range(1, self.num_branches):
             temp = getattr(self, 'layer3_' + str(i))(x)
             temp = getattr(self, 'norm_final_' + str(i))(temp)
             temp = getattr(self, 'relu_final_' + str(i))(temp)
             temp = self.avgpool(temp).view(temp.size(0), -1)         # B x 132 
-            temp_1 = getattr(self, 'classifier3_' + str(i))(temp)      # B x num_classes
-            temp_1 = temp_1.unsqueeze(-1)
-            pro = torch.cat([pro, temp_1], -1)
+            branches.append(getattr(self, 'classifier3_' + str(i))(temp))      # B x num_classes
+        pro, _ = branches.stack()            # B x num_classes x num_branches
         # CL
         if self.ind:
             return pro, None
         else:
             if self.avg:
-                x_m = 0
-                for i in range(1, self.num_branches):
-                    x_m += 1/(self.num_branches-1) * pro[:,:,i]
-                x_m = x_m.unsqueeze(-1)
-                for i in range(1, self.num_branches):
-                    temp = 0    
-                    for j in range(0, self.num_branches):
-                        if j != i:
-                            temp += 1/(self.num_branches-1) * pro[:,:,j]       # B x num_classes
-                    temp = temp.unsqueeze(-1)
-                    x_m = torch.cat([x_m, temp],-1)                            # B x num_classes x num_branches
+                x_m = peer_mean(pro)            # B x num_classes x num_branches
             # ONE
             else: 
                 x_c = self.avgpool_c(x)           # B x 60 x 1 x 1
@@ -242,9 +180,7 @@ class DenseNet(nn.Module):
                 x_c=self.bn_v1(x_c)  
                 x_c=F.relu(x_c)      
                 x_c = F.softmax(x_c, dim=1)     # B x 3  
-                x_m = x_c[:,0].view(-1, 1).repeat(1, pro[:,:,0].size(1)) * pro[:,:,0]
-                for i in range(1, self.num_branches):
-                    x_m += x_c[:,i].view(-1, 1).repeat(1, pro[:,:,i].size(1)) * pro[:,:,i]       # B x num_classes                
+                x_m = gated_ensemble(pro, x_c)  # B x num_classes
             return pro, x_m
 
         # features = self.features(x)
@@ -263,7 +199,7 @@ def densenetd40k12(pretrained=False, path=None, **kwargs):
     
     model = DenseNet(growth_rate = 12, block_config = [6,6,6], **kwargs)
     if pretrained:
-        model.load_state_dict((torch.load(path))['state_dict'])
+        model.load_state_dict((torch.load(path, map_location='cpu'))['state_dict'])
     return model
 
 def densenetd100k12(pretrained=False, path=None, **kwargs):
@@ -276,7 +212,7 @@ def densenetd100k12(pretrained=False, path=None, **kwargs):
     
     model = DenseNet(growth_rate = 12, block_config = [16,16,16], **kwargs)
     if pretrained:
-        model.load_state_dict((torch.load(path))['state_dict'])
+        model.load_state_dict((torch.load(path, map_location='cpu'))['state_dict'])
     return model
     
 def densenetd100k40(pretrained=False, path=None, **kwargs):
@@ -289,5 +225,5 @@ def densenetd100k40(pretrained=False, path=None, **kwargs):
     
     model = DenseNet(growth_rate = 40, block_config = [16,16,16], **kwargs)
     if pretrained:
-        model.load_state_dict((torch.load(path))['state_dict'])
+        model.load_state_dict((torch.load(path, map_location='cpu'))['state_dict'])
     return model
\ No newline at end of file
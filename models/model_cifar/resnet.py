@@ -245,6 +245,74 @@ class ResNet(nn.Module):
         return self._forward_impl(x)
 
 
+class CifarResNet(nn.Module):
+    """Three-stage ResNet for 32x32 inputs (16, 32 and 64 planes), the layout of resnet_GL.
+
+    The group leader of a resnet_GL model is a CifarResNet, see export_leader.py.
+    """
+
+    def __init__(
+        self,
+        block: Type[Union[BasicBlock, Bottleneck]],
+        layers: List[int],
+        num_classes: int = 10,
+        zero_init_residual: bool = False,
+        groups: int = 1,
+        width_per_group: int = 64,
+        norm_layer: Optional[Callable[..., nn.Module]] = None
+    ) -> None:
+        super(CifarResNet, self).__init__()
+        if norm_layer is None:
+            norm_layer = nn.BatchNorm2d
+        self._norm_layer = norm_layer
+
+        self.inplanes = 16
+        self.dilation = 1
+        self.groups = groups
+        self.base_width = width_per_group
+        self.conv1 = nn.Conv2d(3, self.inplanes, kernel_size=3, padding=1, bias=False)
+        self.bn1 = norm_layer(self.inplanes)
+        self.relu = nn.ReLU(inplace=True)
+
+        self.layer1 = self._make_layer(block, 16, layers[0])
+        self.layer2 = self._make_layer(block, 32, layers[1], stride=2)
+        self.layer3 = self._make_layer(block, 64, layers[2], stride=2)
+        self.avgpool = nn.AdaptiveAvgPool2d((1, 1))
+        self.fc = nn.Linear(64 * block.expansion, num_classes)
+
+        for m in self.modules():
+            if isinstance(m, nn.Conv2d):
+                nn.init.kaiming_normal_(
+                    m.weight, mode='fan_out', nonlinearity='relu')
+            elif isinstance(m, (nn.BatchNorm2d, nn.GroupNorm)):
+                nn.init.constant_(m.weight, 1)
+                nn.init.constant_(m.bias, 0)
+
+        if zero_init_residual:
+            for m in self.modules():
+                if isinstance(m, Bottleneck):
+                    nn.init.constant_(m.bn3.weight, 0)
+                elif isinstance(m, BasicBlock):
+                    nn.init.constant_(m.bn2.weight, 0)
+
+    _make_layer = ResNet._make_layer
+
+    def forward(self, x: Tensor) -> Tensor:
+        x = self.conv1(x)
+        x = self.bn1(x)
+        x = self.relu(x)
+
+        x = self.layer1(x)
+        x = self.layer2(x)
+        x = self.layer3(x)
+
+        x = self.avgpool(x)
+        x = torch.flatten(x, 1)
+        x = self.fc(x)
+
+        return x
+
+
 def _resnet(
     arch: str,
     block: Type[Union[BasicBlock, Bottleneck]],
@@ -372,3 +440,40 @@ def wide_resnet101_2(pretrained: bool = False, progress: bool = True, **kwargs:
     kwargs['width_per_group'] = 64 * 2
     return _resnet('wide_resnet101_2', Bottleneck, [3, 4, 23, 3],
                    pretrained, progress, **kwargs)
+
+
+def resnet32(pretrained: bool = False, path: Optional[str] = None, **kwargs: Any) -> CifarResNet:
+    r"""ResNet-32 model for CIFAR, the group leader of resnet_GL.resnet32.
+    Args:
+        pretrained (bool): If True, returns a model pre-trained, e.g. exported by export_leader.py
+        path (str): the checkpoint of the pre-trained model
+    """
+    model = CifarResNet(BasicBlock, [5, 5, 5], **kwargs)
+    if pretrained:
+        model.load_state_dict((torch.load(path, map_location='cpu'))['state_dict'])
+    return model
+
+
+def resnet110(pretrained: bool = False, path: Optional[str] = None, **kwargs: Any) -> CifarResNet:
+    r"""ResNet-110 model for CIFAR, the group leader of resnet_GL.resnet110.
+    Args:
+        pretrained (bool): If True, returns a model pre-trained, e.g. exported by export_leader.py
+        path (str): the checkpoint of the pre-trained model
+    """
+    model = CifarResNet(Bottleneck, [12, 12, 12], **kwargs)
+    if pretrained:
+        model.load_state_dict((torch.load(path, map_location='cpu'))['state_dict'])
+    return model
+
+
+def wide_resnet20_8(pretrained: bool = False, path: Optional[str] = None, **kwargs: Any) -> CifarResNet:
+    r"""Wide ResNet-20-8 model for CIFAR, the group leader of resnet_GL.wide_resnet20_8.
+    Args:
+        pretrained (bool): If True, returns a model pre-trained, e.g. exported by export_leader.py
+        path (str): the checkpoint of the pre-trained model
+    """
+    kwargs['width_per_group'] = 64 * 8
+    model = CifarResNet(Bottleneck, [2, 2, 2], **kwargs)
+    if pretrained:
+        model.load_state_dict((torch.load(path, map_location='cpu'))['state_dict'])
+    return model
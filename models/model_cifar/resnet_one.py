@@ -14,6 +14,8 @@ Deep Residual Learning for Image Recognition. https://arxiv.org/abs/1512.03385
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from ..branches import BranchCollector, peer_mean, gated_ensemble, \
+    checkpoint_policy, run_stage
 
 __all__ = ['ResNet', 'resnet32', 'resnet110', 'wide_resnet20_8']
 
@@ -130,7 +132,7 @@ class ILR(torch.autograd.Function):
 class ResNet(nn.Module):
 
     def __init__(self, block, layers, num_classes=10, num_branches=3, bpscale=False, avg=False, ind=False, zero_init_residual=False,
-                 groups=1, width_per_group=64, replace_stride_with_dilation=None, norm_layer=None):
+                 groups=1, width_per_group=64, replace_stride_with_dilation=None, norm_layer=None, checkpoint='none'):
 
         super(ResNet, self).__init__()
         if norm_layer is None:
@@ -141,6 +143,7 @@ class ResNet(nn.Module):
         self.avg = avg
         self.bpscale = bpscale
         self.num_branches = num_branches
+        self.checkpoint_trunk, self.checkpoint_branches = checkpoint_policy(checkpoint)
 
         self.inplanes = 16
         self.dilation = 1
@@ -157,22 +160,30 @@ class ResNet(nn.Module):
         self.conv1 = nn.Conv2d(3, 16, kernel_size=3, padding=1, bias=False)
         self.bn1 = nn.BatchNorm2d(16)
         self.relu = nn.ReLU(inplace=True)
-        # self.layer1 = self._make_layer(block, 16, layers[0])
-        # self.layer2 = self._make_layer(block, 32, layers[1], stride=2)
-        self.layer1 = self._make_layer(block, 64, layers[0])
-        self.layer2 = self._make_layer(block, 128, layers[1], stride=2,
-                                       dilate=replace_stride_with_dilation[0])
-        self.layer3 = self._make_layer(block, 256, layers[2], stride=2,
-                                       dilate=replace_stride_with_dilation[1])
+        # the last stage is replicated per branch: layer3_i for the 3-stage CIFAR models
+        # (resnet32, resnet110, wide_resnet20_8), layer4_i for the 4-stage resnet18
+        self.num_stages = len(layers)
+        if self.num_stages == 3:
+            self.layer1 = self._make_layer(block, 16, layers[0])
+            self.layer2 = self._make_layer(block, 32, layers[1], stride=2,
+                                           dilate=replace_stride_with_dilation[0])
+            branch_planes = 64
+        else:
+            self.layer1 = self._make_layer(block, 64, layers[0])
+            self.layer2 = self._make_layer(block, 128, layers[1], stride=2,
+                                           dilate=replace_stride_with_dilation[0])
+            self.layer3 = self._make_layer(block, 256, layers[2], stride=2,
+                                           dilate=replace_stride_with_dilation[1])
+            branch_planes = 512
         fix_inplanes = self.inplanes    # 32
         self.avgpool = nn.AdaptiveAvgPool2d((1, 1))
         for i in range(num_branches):
-            setattr(self, 'layer4_' + str(i),
-                    self._make_layer(block, 512, layers[3], stride=2,
-                                     dilate=replace_stride_with_dilation[2]))
+            setattr(self, 'layer' + str(self.num_stages) + '_' + str(i),
+                    self._make_layer(block, branch_planes, layers[-1], stride=2,
+                                     dilate=replace_stride_with_dilation[self.num_stages - 2]))
             self.inplanes = fix_inplanes  # reuse self.inplanes
-            setattr(self, 'classifier4_' + str(i),
-                    nn.Linear(512 * block.expansion, num_classes))
+            setattr(self, 'classifier' + str(self.num_stages) + '_' + str(i),
+                    nn.Linear(branch_planes * block.expansion, num_classes))
 
         if self.avg == False:
             # self.avgpool_c = nn.AvgPool2d(16)
@@ -229,57 +240,41 @@ class ResNet(nn.Module):
         x = self.bn1(x)
         x = self.relu(x)            # B x 16 x 32 x 32
 
-        x = self.layer1(x)          # B x 16 x 32 x 32
-        x = self.layer2(x)          # B x 32 x 16 x 16
-        x = self.layer3(x)
+        x = run_stage(self.layer1, x, self.checkpoint_trunk)          # B x 16 x 32 x 32
+        x = run_stage(self.layer2, x, self.checkpoint_trunk)          # B x 32 x 16 x 16
+        if self.num_stages == 4:
+            x = run_stage(self.layer3, x, self.checkpoint_trunk)
         if self.bpscale:
             x = self.layer_ILR(x, self.num_branches)  # Backprop rescaling
 
-        x_3 = getattr(self, 'layer4_0')(x)   # B x 64 x 8 x 8
+        stage = str(self.num_stages)
+        x_3 = run_stage(getattr(self, 'layer' + stage + '_0'), x, self.checkpoint_branches)   # B x 64 x 8 x 8
         x_3 = self.avgpool(x_3)             # B x 64 x 1 x 1
         x_3 = x_3.view(x_3.size(0), -1)     # B x 64
-        x_3_1 = getattr(self, 'classifier4_0')(x_3)     # B x num_classes
-        pro = x_3_1.unsqueeze(-1)
+        branches = BranchCollector()
+        branches.append(getattr(self, 'classifier' + stage + '_0')(x_3))     # B x num_classes
         for i in range(1, self.num_branches):
-            temp = getattr(self, 'layer4_'+str(i))(x)
+            temp = run_stage(getattr(self, 'layer' + stage + '_' + str(i)), x, self.checkpoint_branches)
             temp = self.avgpool(temp)       # B x 64 x 1 x 1
             temp = temp.view(temp.size(0), -1)
-            temp_1 = getattr(self, 'classifier4_' + str(i))(temp)
-            temp_1 = temp_1.unsqueeze(-1)
-            # B x num_classes x num_branches
-            pro = torch.cat([pro, temp_1], -1)
+            branches.append(getattr(self, 'classifier' + stage + '_' + str(i))(temp))
+        # B x num_classes x num_branches
+        pro, _ = branches.stack()
         if self.ind:
             return pro, None
         # CL
         else:
             if self.avg:
-                x_m = 0
-                for i in range(1, self.num_branches):
-                    x_m += 1/(self.num_branches-1) * pro[:, :, i]
-                x_m = x_m.unsqueeze(-1)
-                for i in range(1, self.num_branches):
-                    temp = 0
-                    for j in range(0, self.num_branches):
-                        if j != i:
-                            temp += 1/(self.num_branches-1) * \
-                                pro[:, :, j]       # B x num_classes
-                    temp = temp.unsqueeze(-1)
-                    # B x num_classes x num_branches
-                    x_m = torch.cat([x_m, temp], -1)
+                x_m = peer_mean(pro)        # B x num_classes x num_branches
             # ONE
             else:
-                x_c = self.avgpool_c(x)     # B x 32 x 1 x 1
-                x_c = x_c.view(x_c.size(0), -1)  # B x 32
+                x_c = self.avgpool(x)       # B x 256 x 1 x 1
+                x_c = x_c.view(x_c.size(0), -1)  # B x 256
                 x_c = self.control_v1(x_c)    # B x 3
                 x_c = self.bn_v1(x_c)
                 x_c = F.relu(x_c)
                 x_c = F.softmax(x_c, dim=1)  # B x 3
-                x_m = x_c[:, 0].view(-1, 1).repeat(1,
-                                                   pro[:, :, 0].size(1)) * pro[:, :, 0]
-                for i in range(1, self.num_branches):
-                    # B x num_classes
-                    x_m += x_c[:, i].view(-1, 1).repeat(1,
-                                                        pro[:, :, i].size(1)) * pro[:, :, i]
+                x_m = gated_ensemble(pro, x_c)  # B x num_classes
             return pro, x_m
 
 
@@ -303,7 +298,7 @@ def resnet32(pretrained=False, path=None, **kwargs):
 
     model = ResNet(BasicBlock, [5, 5, 5], **kwargs)
     if pretrained:
-        model.load_state_dict((torch.load(path))['state_dict'])
+        model.load_state_dict((torch.load(path, map_location='cpu'))['state_dict'])
     return model
 
 
@@ -317,7 +312,7 @@ def resnet110(pretrained=False, path=None, **kwargs):
 
     model = ResNet(Bottleneck, [12, 12, 12], **kwargs)
     if pretrained:
-        model.load_state_dict((torch.load(path))['state_dict'])
+        model.load_state_dict((torch.load(path, map_location='cpu'))['state_dict'])
     return model
 
 
@@ -333,5 +328,5 @@ def wide_resnet20_8(pretrained=False, path=None, **kwargs):
 
     model = ResNet(Bottleneck, [2, 2, 2], width_per_group=64 * 8, **kwargs)
     if pretrained:
-        model.load_state_dict((torch.load(path))['state_dict'])
+        model.load_state_dict((torch.load(path, map_location='cpu'))['state_dict'])
     return model
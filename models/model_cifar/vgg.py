@@ -100,7 +100,7 @@ def vgg16(pretrained=False, path=None, **kwargs):
     """
     model = VGG(depth=16, **kwargs)
     if pretrained:
-        model.load_state_dict((torch.load(path))['state_dict'])
+        model.load_state_dict((torch.load(path, map_location='cpu'))['state_dict'])
     return model
     
 def vgg19(pretrained=False, path=None, **kwargs):
@@ -112,5 +112,5 @@ def vgg19(pretrained=False, path=None, **kwargs):
     """
     model = VGG(depth=19, **kwargs)
     if pretrained:
-        model.load_state_dict((torch.load(path))['state_dict'])
+        model.load_state_dict((torch.load(path, map_location='cpu'))['state_dict'])
     return model
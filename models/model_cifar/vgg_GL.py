@@ -8,7 +8,8 @@ Reference:
 
 import torch
 import torch.nn as nn
-import torch.nn.functional as F
+from ..branches import BranchCollector, PeerAttention, legacy_attention_keys, \
+    checkpoint_policy, run_stage
 __all__ = ['vgg16', 'vgg19']
 
 #cfg = {
@@ -17,11 +18,12 @@ __all__ = ['vgg16', 'vgg19']
 #}
 
 class VGG(nn.Module):
-    def __init__(self, num_classes=10, num_branches=3, factor = 8, en= False, depth=16, dropout = 0.5):
+    def __init__(self, num_classes=10, num_branches=3, factor = 8, en= False, depth=16, dropout = 0.5, checkpoint = 'none'):
         super(VGG, self).__init__()
         self.inplances = 64
         self.en = en
         self.num_branches = num_branches
+        self.checkpoint_trunk, self.checkpoint_branches = checkpoint_policy(checkpoint)
         self.conv1 = nn.Conv2d(3, self.inplances, kernel_size=3, padding=1)
         self.bn1 = nn.BatchNorm2d(self.inplances)
         self.conv2 = nn.Conv2d(self.inplances, self.inplances, kernel_size=3, padding=1)
@@ -51,8 +53,8 @@ class VGG(nn.Module):
             ))
     
         input_channel = 512
-        self.query_weight = nn.Linear(input_channel, input_channel//factor, bias = False)
-        self.key_weight = nn.Linear(input_channel, input_channel//factor, bias = False)        
+        self.attention = PeerAttention(input_channel, factor)
+        self._register_load_state_dict_pre_hook(legacy_attention_keys)
         
         for m in self.modules():
             if isinstance(m, nn.Conv2d):
@@ -74,6 +76,38 @@ class VGG(nn.Module):
         layers += [nn.MaxPool2d(kernel_size=2, stride=2)]
         return nn.Sequential(*layers)
     
+    def trunk_modules(self):
+        return ['conv1', 'bn1', 'conv2', 'bn2', 'layer1', 'layer2', 'layer3']
+
+    def branch_modules(self, i):
+        return ['layer3_' + str(i), 'classifier3_' + str(i)]
+
+    def trunk(self, x):
+        x = self.relu(self.bn1(self.conv1(x)))
+        x = self.relu(self.bn2(self.conv2(x)))
+        x = self.maxpool(x)
+        x = run_stage(self.layer1, x, self.checkpoint_trunk)
+        x = run_stage(self.layer2, x, self.checkpoint_trunk)
+        return run_stage(self.layer3, x, self.checkpoint_trunk)
+
+    def branches(self, x, indices):
+        # logits B x len(indices) x num_classes, attention projections B x len(indices) x 2*dim
+        feats, logits = [], []
+        for i in indices:
+            temp = run_stage(getattr(self, 'layer3_' + str(i)), x, self.checkpoint_branches).flatten(1)    # B x 512
+            feats.append(temp)
+            logits.append(getattr(self, 'classifier3_' + str(i))(temp))
+        return torch.stack(logits, 1), self.attention.project(torch.stack(feats, 1))
+
+    def head(self, logits, proj):
+        # logits B x num_branches x num_classes and proj of all branches, the leader last
+        pro = logits.transpose(1, 2)                # B x num_classes x num_branches
+        num_peers = self.num_branches if self.en else self.num_branches - 1
+        x_m = self.attention.aggregate(proj[:, :num_peers], pro[:, :, :num_peers])
+        if self.en:
+            return pro, x_m
+        return pro[:, :, :num_peers], x_m, pro[:, :, -1]
+
     def forward(self, x):
     
         x = self.conv1(x)
@@ -85,57 +119,27 @@ class VGG(nn.Module):
         x = self.relu(x)
         x = self.maxpool(x)
         
-        x = self.layer1(x)
-        x = self.layer2(x)
-        x = self.layer3(x)
-        x_3 = getattr(self,'layer3_0')(x)   # B x 512 x 1 x 1
+        x = run_stage(self.layer1, x, self.checkpoint_trunk)
+        x = run_stage(self.layer2, x, self.checkpoint_trunk)
+        x = run_stage(self.layer3, x, self.checkpoint_trunk)
+        x_3 = run_stage(getattr(self, 'layer3_0'), x, self.checkpoint_branches)   # B x 512 x 1 x 1
         x_3 = x_3.view(x_3.size(0), -1)     # B x 512
-        proj_q = self.query_weight(x_3)     # B x 64
-        proj_q = proj_q[:, None, :]
-        proj_k = self.key_weight(x_3)       # B x 64 
-        proj_k = proj_k[:, None, :]
-        x_3_1 = getattr(self, 'classifier3_0')(x_3)     # B x num_classes
-        pro = x_3_1.unsqueeze(-1)        
+        branches = BranchCollector()
+        branches.append(getattr(self, 'classifier3_0')(x_3), x_3)     # B x num_classes, B x 512
+        num_peers = self.num_branches if self.en else self.num_branches - 1
+        for i in range(1, num_peers):
+            temp = run_stage(getattr(self, 'layer3_'+str(i)), x, self.checkpoint_branches)
+            temp = temp.view(temp.size(0), -1)
+            branches.append(getattr(self, 'classifier3_' + str(i))(temp), temp)
+        pro, feats = branches.stack()   # B x num_classes x num_peers, B x num_peers x 512
+        x_m = self.attention(feats, pro)
         if self.en:
-            for i in range(1, self.num_branches):
-                temp = getattr(self, 'layer3_'+str(i))(x)
-                temp = temp.view(temp.size(0), -1)  
-                temp_q = self.query_weight(temp)
-                temp_k = self.key_weight(temp)
-                temp_q = temp_q[:, None, :]
-                temp_k = temp_k[:, None, :]
-                temp_1 = getattr(self, 'classifier3_' + str(i))(temp)
-                temp_1 = temp_1.unsqueeze(-1)
-                pro = torch.cat([pro,temp_1],-1)        # B x num_classes x num_branches
-                proj_q = torch.cat([proj_q, temp_q], 1) # B x num_branches x 8
-                proj_k = torch.cat([proj_k, temp_k], 1) 
-            
-            energy = torch.bmm(proj_q, proj_k.permute(0,2,1)) 
-            attention = F.softmax(energy, dim = -1) 
-            x_m = torch.bmm(pro, attention.permute(0,2,1))
             return pro, x_m
-        else:
-            for i in range(1, self.num_branches - 1):
-                temp = getattr(self, 'layer3_'+str(i))(x)
-                temp = temp.view(temp.size(0), -1)   
-                temp_q = self.query_weight(temp)
-                temp_k = self.key_weight(temp)
-                temp_q = temp_q[:, None, :]
-                temp_k = temp_k[:, None, :]
-                temp_1 = getattr(self, 'classifier3_' + str(i))(temp)
-                temp_1 = temp_1.unsqueeze(-1)
-                pro = torch.cat([pro,temp_1],-1)        # B x num_classes x num_branches
-                proj_q = torch.cat([proj_q, temp_q], 1) # B x num_branches x 8
-                proj_k = torch.cat([proj_k, temp_k], 1) 
-            
-            energy =  torch.bmm(proj_q, proj_k.permute(0,2,1)) 
-            attention = F.softmax(energy, dim = -1) 
-            x_m = torch.bmm(pro, attention.permute(0,2,1))
-            
-            temp = getattr(self, 'layer3_'+str(self.num_branches - 1))(x)
-            temp = temp.view(temp.size(0), -1)   
-            temp_out = getattr(self, 'classifier3_' + str(self.num_branches - 1))(temp)
-            return pro, x_m, temp_out
+
+        temp = run_stage(getattr(self, 'layer3_'+str(self.num_branches - 1)), x, self.checkpoint_branches)
+        temp = temp.view(temp.size(0), -1)
+        temp_out = getattr(self, 'classifier3_' + str(self.num_branches - 1))(temp)
+        return pro, x_m, temp_out
 
 def vgg16(pretrained=False, path=None, **kwargs):
     """
@@ -146,7 +150,7 @@ def vgg16(pretrained=False, path=None, **kwargs):
     """
     model = VGG(depth=16, **kwargs)
     if pretrained:
-        model.load_state_dict((torch.load(path))['state_dict'])
+        model.load_state_dict((torch.load(path, map_location='cpu'))['state_dict'])
     return model
     
 def vgg19(pretrained=False, path=None, **kwargs):
@@ -158,5 +162,5 @@ def vgg19(pretrained=False, path=None, **kwargs):
     """
     model = VGG(depth=19, **kwargs)
     if pretrained:
-        model.load_state_dict((torch.load(path))['state_dict'])
+        model.load_state_dict((torch.load(path, map_location='cpu'))['state_dict'])
     return model
@@ -11,6 +11,8 @@ Reference:
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from ..branches import BranchCollector, peer_mean, gated_ensemble, \
+    checkpoint_policy, run_stage
 
 __all__ = ['vgg16', 'vgg19']
 
@@ -33,12 +35,13 @@ class ILR(torch.autograd.Function):
 
 
 class VGG(nn.Module):
-    def __init__(self, num_classes=10, num_branches=3, bpscale = False, avg = False, ind = False, depth=16):
+    def __init__(self, num_classes=10, num_branches=3, bpscale = False, avg = False, ind = False, depth=16, checkpoint = 'none'):
         super(VGG, self).__init__()
         self.inplances = 64
         self.avg = avg
         self.bpscale = bpscale
         self.num_branches = num_branches
+        self.checkpoint_trunk, self.checkpoint_branches = checkpoint_policy(checkpoint)
         self.conv1 = nn.Conv2d(3, self.inplances, kernel_size=3, padding=1)
         self.bn1 = nn.BatchNorm2d(self.inplances)
         self.conv2 = nn.Conv2d(self.inplances, self.inplances, kernel_size=3, padding=1)
@@ -101,60 +104,37 @@ class VGG(nn.Module):
         x = self.bn2(x)
         x = self.relu(x)
         x = self.maxpool(x)
-        x = self.layer1(x)
-        x = self.layer2(x)
-        x = self.layer3(x)
+        x = run_stage(self.layer1, x, self.checkpoint_trunk)
+        x = run_stage(self.layer2, x, self.checkpoint_trunk)
+        x = run_stage(self.layer3, x, self.checkpoint_trunk)
         if self.bpscale:
             x = self.layer_ILR(x, self.num_branches) # Backprop rescaling
             
-        x_3 = getattr(self,'layer3_0')(x)   # B x 64 x 8 x 8
+        x_3 = run_stage(getattr(self, 'layer3_0'), x, self.checkpoint_branches)   # B x 64 x 8 x 8
         x_3 = x_3.view(x_3.size(0), -1)     # B x 64
-        x_3_1 = getattr(self, 'classifier3_0')(x_3)     # B x num_classes
-        pro = x_3_1.unsqueeze(-1)        
+        branches = BranchCollector()
+        branches.append(getattr(self, 'classifier3_0')(x_3))     # B x num_classes
         for i in range(1, self.num_branches):
-            temp = getattr(self, 'layer3_'+str(i))(x)
+            temp = run_stage(getattr(self, 'layer3_'+str(i)), x, self.checkpoint_branches)
             temp = temp.view(temp.size(0), -1)   
-            temp_1 = getattr(self, 'classifier3_' + str(i))(temp)
-            temp_1 = temp_1.unsqueeze(-1)
-            pro = torch.cat([pro,temp_1],-1)        # B x num_classes x num_branches
+            branches.append(getattr(self, 'classifier3_' + str(i))(temp))
+        pro, _ = branches.stack()        # B x num_classes x num_branches
         
         if self.ind:
             return pro, None
         # CL
         else:
             if self.avg:
-                x_m = 0
-                for i in range(1, self.num_branches):
-                    x_m += 1/(self.num_branches-1) * pro[:,:,i]
-                x_m = x_m.unsqueeze(-1)
-                for i in range(1, self.num_branches):
-                    temp = 0
-                    for j in range(0, self.num_branches):
-                        if j != i:
-                            temp += 1/(self.num_branches-1) * pro[:,:,j]       # B x num_classes
-                    temp = temp.unsqueeze(-1)
-                    x_m = torch.cat([x_m, temp],-1)                            # B x num_classes x num_branches
+                x_m = peer_mean(pro)        # B x num_classes x num_branches
             # ONE
             else:
                 x_c=self.avgpool_c(x)
-                x_c = x_c.view(x_c.size(0), -1) # B x 32 
+                x_c = x_c.view(x_c.size(0), -1) # B x 512 
                 x_c=self.control_v1(x_c)    # B x 3
                 x_c=self.bn_v1(x_c)  
                 x_c=F.relu(x_c)      
                 x_c = F.softmax(x_c, dim=1) # B x 3  
-            
-                x_3 = getattr(self,'layer3_0')(x)   # B x 64 x 8 x 8
-                x_3 = x_3.view(x_3.size(0), -1)     # B x 64
-                x_3_1 = getattr(self, 'classifier3_0')(x_3)     # B x num_classes
-                x_m = x_c[:,0].view(-1, 1).repeat(1, x_3_1.size(1)) * x_3_1
-                pro = x_3_1.unsqueeze(-1) 
-                for i in range(1, self.num_branches):
-                    temp = getattr(self, 'layer3_'+str(i))(x)
-                    temp = temp.view(temp.size(0), -1)   
-                    temp_1 = getattr(self, 'classifier3_' + str(i))(temp)
-                    x_m += x_c[:,i].view(-1, 1).repeat(1, temp_1.size(1)) * temp_1       # B x num_classes
-                    temp_1 = temp_1.unsqueeze(-1)
-                    pro = torch.cat([pro,temp_1],-1)        # B x num_classes x num_branches
+                x_m = gated_ensemble(pro, x_c)  # B x num_classes
               
             return pro, x_m
     
@@ -167,7 +147,7 @@ def vgg16(pretrained=False, path=None, **kwargs):
     """
     model = VGG(depth=16, **kwargs)
     if pretrained:
-        model.load_state_dict((torch.load(path))['state_dict'])
+        model.load_state_dict((torch.load(path, map_location='cpu'))['state_dict'])
     return model
     
 def vgg19(pretrained=False, path=None, **kwargs):
@@ -179,5 +159,5 @@ def vgg19(pretrained=False, path=None, **kwargs):
     """
     model = VGG(depth=19, **kwargs)
     if pretrained:
-        model.load_state_dict((torch.load(path))['state_dict'])
+        model.load_state_dict((torch.load(path, map_location='cpu'))['state_dict'])
     return model
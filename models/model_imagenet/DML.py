@@ -1,14 +1,16 @@
-import torch
 import torch.nn as nn
+from ..branches import BranchCollector, checkpoint_policy, run_stage
 from .resnet import * 
 from .densenet import * 
 
 __all__ = ['MutualNet']
 
 class MutualNet(nn.Module):
-    def __init__(self, model="resnet32", num_branches = 4, num_classes=10):
+    def __init__(self, model="resnet32", num_branches = 4, num_classes=10, checkpoint='none'):
         super(MutualNet, self).__init__()
         self.num_branches = num_branches
+        # the students share no trunk, 'branches' and 'all' checkpoint every student as a whole
+        self.checkpoint_trunk, self.checkpoint_branches = checkpoint_policy(checkpoint)
         
         for i in range(num_branches):
             if model == "resnet34":
@@ -17,10 +19,8 @@ class MutualNet(nn.Module):
                 setattr(self, 'stu'+str(i), densenetd40k12(num_classes = num_classes))
             
     def forward(self, x):
-        out = self.stu0(x) 
-        out = out.unsqueeze(-1)
-        for i in range(1, self.num_branches):
-            temp_out = getattr(self, 'stu'+str(i))(x)
-            temp_out = temp_out.unsqueeze(-1)
-            out = torch.cat([out, temp_out],-1)        
-        return out
\ No newline at end of file
+        branches = BranchCollector()
+        for i in range(self.num_branches):
+            branches.append(run_stage(getattr(self, 'stu'+str(i)), x, self.checkpoint_branches))
+        out, _ = branches.stack()        # B x num_classes x num_branches
+        return out
@@ -214,7 +214,7 @@ def resnet18(pretrained=False, path=None, **kwargs):
     
     model = ResNet(BasicBlock, [2, 2, 2, 2], **kwargs)
     if pretrained:
-        model.load_state_dict((torch.load(path))['state_dict'])
+        model.load_state_dict((torch.load(path, map_location='cpu'))['state_dict'])
     return model
 
 def resnet34(pretrained=False, path=None, **kwargs):
@@ -227,7 +227,7 @@ def resnet34(pretrained=False, path=None, **kwargs):
     
     model = ResNet(BasicBlock, [3, 4, 6, 3], **kwargs)
     if pretrained:
-        model.load_state_dict((torch.load(path))['state_dict'])
+        model.load_state_dict((torch.load(path, map_location='cpu'))['state_dict'])
     return model
    
 def resnet50(pretrained=False, path=None, **kwargs):
@@ -240,7 +240,7 @@ def resnet50(pretrained=False, path=None, **kwargs):
     
     model = ResNet(Bottleneck, [3, 4, 6, 3], **kwargs)
     if pretrained:
-        model.load_state_dict((torch.load(path))['state_dict'])
+        model.load_state_dict((torch.load(path, map_location='cpu'))['state_dict'])
     return model
 
 def resnet101(pretrained=False, path=None, **kwargs):
@@ -253,7 +253,7 @@ def resnet101(pretrained=False, path=None, **kwargs):
     
     model = ResNet(Bottleneck, [3, 4, 23, 3], **kwargs)
     if pretrained:
-        model.load_state_dict((torch.load(path))['state_dict'])
+        model.load_state_dict((torch.load(path, map_location='cpu'))['state_dict'])
     return model
 
 def resnet152(pretrained=False, path=None, **kwargs):
@@ -266,7 +266,7 @@ def resnet152(pretrained=False, path=None, **kwargs):
     
     model = ResNet(Bottleneck, [3, 8, 36, 3], **kwargs)
     if pretrained:
-        model.load_state_dict((torch.load(path))['state_dict'])
+        model.load_state_dict((torch.load(path, map_location='cpu'))['state_dict'])
     return model
 
 def resnext50_32x4d(pretrained=False, progress=True, **kwargs):
@@ -306,7 +306,7 @@ def wide_resnet14_10(pretrained=False, path=None, **kwargs):
     
     model = ResNet(Bottleneck, [1, 1, 1, 1], width_per_group = 64 * 10, **kwargs)
     if pretrained:
-        model.load_state_dict((torch.load(path))['state_dict'])
+        model.load_state_dict((torch.load(path, map_location='cpu'))['state_dict'])
     return model
 
 def wide_resnet101_2(pretrained=False, progress=True, **kwargs):
@@ -320,5 +320,5 @@ def wide_resnet101_2(pretrained=False, progress=True, **kwargs):
     """
     model = ResNet(Bottleneck, [3, 4, 23, 3], width_per_group = 64 * 2, **kwargs)
     if pretrained:
-        model.load_state_dict((torch.load(path))['state_dict'])
+        model.load_state_dict((torch.load(path, map_location='cpu'))['state_dict'])
     return model
@@ -11,7 +11,8 @@ Deep Residual Learning for Image Recognition. https://arxiv.org/abs/1512.03385
 
 import torch
 import torch.nn as nn
-import torch.nn.functional as F
+from ..branches import BranchCollector, PeerAttention, legacy_attention_keys, \
+    checkpoint_policy, run_stage
 
 __all__ = ['GL_ResNet', 'resnet32', 'resnet110']
 
@@ -108,7 +109,7 @@ class Bottleneck(nn.Module):
 
 class GL_ResNet(nn.Module):
     def __init__(self, block, layers, num_classes=10, num_branches = 3, input_channel=64, factor=8, en = False, zero_init_residual=False, 
-        groups=1, width_per_group=64, replace_stride_with_dilation=None, norm_layer=None, KD = False):
+        groups=1, width_per_group=64, replace_stride_with_dilation=None, norm_layer=None, KD = False, checkpoint = 'none'):
         super(GL_ResNet, self).__init__()
         if norm_layer is None:
             norm_layer = nn.BatchNorm2d
@@ -116,6 +117,7 @@ class GL_ResNet(nn.Module):
         
         self.en = en
         self.num_branches = num_branches
+        self.checkpoint_trunk, self.checkpoint_branches = checkpoint_policy(checkpoint)
         
         self.inplanes = 16
         self.dilation = 1
@@ -141,8 +143,8 @@ class GL_ResNet(nn.Module):
             self.inplanes = fix_inplanes  ##reuse self.inplanes
             setattr(self, 'classifier3_' +str(i), nn.Linear(64 * block.expansion, num_classes))
         
-        self.query_weight = nn.Linear(input_channel, input_channel//factor, bias = False)
-        self.key_weight = nn.Linear(input_channel, input_channel//factor, bias = False)
+        self.attention = PeerAttention(input_channel, factor)
+        self._register_load_state_dict_pre_hook(legacy_attention_keys)
         
         for m in self.modules():
             if isinstance(m, nn.Conv2d):
@@ -184,66 +186,65 @@ class GL_ResNet(nn.Module):
 
         return nn.Sequential(*layers)
         
+    def trunk_modules(self):
+        return ['conv1', 'bn1', 'layer1', 'layer2']
+
+    def branch_modules(self, i):
+        return ['layer3_' + str(i), 'classifier3_' + str(i)]
+
+    def trunk(self, x):
+        x = self.relu(self.bn1(self.conv1(x)))
+        x = run_stage(self.layer1, x, self.checkpoint_trunk)
+        return run_stage(self.layer2, x, self.checkpoint_trunk)
+
+    def branches(self, x, indices):
+        # logits B x len(indices) x num_classes, attention projections B x len(indices) x 2*dim
+        feats, logits = [], []
+        for i in indices:
+            temp = run_stage(getattr(self, 'layer3_' + str(i)), x, self.checkpoint_branches)
+            temp = self.avgpool(temp).flatten(1)
+            feats.append(temp)
+            logits.append(getattr(self, 'classifier3_' + str(i))(temp))
+        return torch.stack(logits, 1), self.attention.project(torch.stack(feats, 1))
+
+    def head(self, logits, proj):
+        # logits B x num_branches x num_classes and proj of all branches, the leader last
+        pro = logits.transpose(1, 2)                # B x num_classes x num_branches
+        num_peers = self.num_branches if self.en else self.num_branches - 1
+        x_m = self.attention.aggregate(proj[:, :num_peers], pro[:, :, :num_peers])
+        if self.en:
+            return pro, x_m
+        return pro[:, :, :num_peers], x_m, pro[:, :, -1]
+
     def forward(self, x):
 
         x = self.conv1(x)
         x = self.bn1(x)
         x = self.relu(x)            # B x 16 x 32 x 32
 
-        x = self.layer1(x)          # B x 16 x 32 x 32
-        x = self.layer2(x)          # B x 32 x 16 x 16
-        x_3 = getattr(self,'layer3_0')(x)   # B x 64 x 8 x 8
+        x = run_stage(self.layer1, x, self.checkpoint_trunk)    # B x 16 x 32 x 32
+        x = run_stage(self.layer2, x, self.checkpoint_trunk)    # B x 32 x 16 x 16
+        x_3 = run_stage(getattr(self,'layer3_0'), x, self.checkpoint_branches)   # B x 64 x 8 x 8
         x_3 = self.avgpool(x_3)             # B x 64 x 1 x 1
         x_3 = x_3.view(x_3.size(0), -1)     # B x 64
-        proj_q = self.query_weight(x_3)     # B x 8
-        proj_q = proj_q[:, None, :]
-        proj_k = self.key_weight(x_3)       # B x 8  
-        proj_k = proj_k[:, None, :]
-        x_3_1 = getattr(self, 'classifier3_0')(x_3)     # B x num_classes
-        pro = x_3_1.unsqueeze(-1) 
+        branches = BranchCollector()
+        branches.append(getattr(self, 'classifier3_0')(x_3), x_3)     # B x num_classes, B x 64
+        num_peers = self.num_branches if self.en else self.num_branches - 1
+        for i in range(1, num_peers):
+            temp = run_stage(getattr(self, 'layer3_'+str(i)), x, self.checkpoint_branches)
+            temp = self.avgpool(temp)       # B x 64 x 1 x 1
+            temp = temp.view(temp.size(0), -1)
+            branches.append(getattr(self, 'classifier3_' + str(i))(temp), temp)
+        pro, feats = branches.stack()   # B x num_classes x num_peers, B x num_peers x 64
+        x_m = self.attention(feats, pro)
         if self.en:
-            for i in range(1, self.num_branches):
-                temp = getattr(self, 'layer3_'+str(i))(x)
-                temp = self.avgpool(temp)       # B x 64 x 1 x 1
-                temp = temp.view(temp.size(0), -1)   
-                temp_q = self.query_weight(temp)
-                temp_k = self.key_weight(temp)
-                temp_q = temp_q[:, None, :]
-                temp_k = temp_k[:, None, :]
-                temp_1 = getattr(self, 'classifier3_' + str(i))(temp)
-                temp_1 = temp_1.unsqueeze(-1)
-                pro = torch.cat([pro,temp_1],-1)        # B x num_classes x num_branches
-                proj_q = torch.cat([proj_q, temp_q], 1) # B x num_branches x 8
-                proj_k = torch.cat([proj_k, temp_k], 1) 
-            
-            energy = torch.bmm(proj_q, proj_k.permute(0,2,1)) 
-            attention = F.softmax(energy, dim = -1) 
-            x_m = torch.bmm(pro, attention.permute(0,2,1))
             return pro, x_m
-        else:
-            for i in range(1, self.num_branches - 1):
-                temp = getattr(self, 'layer3_'+str(i))(x)
-                temp = self.avgpool(temp)       # B x 64 x 1 x 1
-                temp = temp.view(temp.size(0), -1)   
-                temp_q = self.query_weight(temp)
-                temp_k = self.key_weight(temp)
-                temp_q = temp_q[:, None, :]
-                temp_k = temp_k[:, None, :]
-                temp_1 = getattr(self, 'classifier3_' + str(i))(temp)
-                temp_1 = temp_1.unsqueeze(-1)
-                pro = torch.cat([pro,temp_1],-1)        # B x num_classes x num_branches
-                proj_q = torch.cat([proj_q, temp_q], 1) # B x num_branches x 8
-                proj_k = torch.cat([proj_k, temp_k], 1) 
-            
-            energy =  torch.bmm(proj_q, proj_k.permute(0,2,1)) 
-            attention = F.softmax(energy, dim = -1) 
-            x_m = torch.bmm(pro, attention.permute(0,2,1))
-            
-            temp = getattr(self, 'layer3_'+str(self.num_branches - 1))(x)
-            temp = self.avgpool(temp)       # B x 64 x 1 x 1
-            temp = temp.view(temp.size(0), -1)   
-            temp_out = getattr(self, 'classifier3_' + str(self.num_branches - 1))(temp)
-            return pro, x_m, temp_out
+
+        temp = run_stage(getattr(self, 'layer3_'+str(self.num_branches - 1)), x, self.checkpoint_branches)
+        temp = self.avgpool(temp)       # B x 64 x 1 x 1
+        temp = temp.view(temp.size(0), -1)
+        temp_out = getattr(self, 'classifier3_' + str(self.num_branches - 1))(temp)
+        return pro, x_m, temp_out
         
 def resnet32(pretrained=False, path=None, **kwargs):
     """
@@ -255,7 +256,7 @@ def resnet32(pretrained=False, path=None, **kwargs):
     
     model = GL_ResNet(BasicBlock, [5, 5, 5], **kwargs)
     if pretrained:
-        model.load_state_dict((torch.load(path))['state_dict'])
+        model.load_state_dict((torch.load(path, map_location='cpu'))['state_dict'])
     return model
 
 def resnet110(pretrained=False, path=None, **kwargs):
@@ -268,6 +269,6 @@ def resnet110(pretrained=False, path=None, **kwargs):
     
     model = GL_ResNet(Bottleneck, [12, 12, 12], **kwargs)
     if pretrained:
-        model.load_state_dict((torch.load(path))['state_dict'])
+        model.load_state_dict((torch.load(path, map_location='cpu'))['state_dict'])
     return model
     
\ No newline at end of file
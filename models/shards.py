@@ -0,0 +1,251 @@
+"""
+    Packed ImageNet shards.
+
+    pack_image_folder() converts an ImageFolder tree (root/class_x/xxx.JPEG) into a
+    few large shard files plus an offset index, once:
+
+    python -m models.shards --src ./Data/train --dst ./Data/shards/train --size 256 --shuffle
+    python -m models.shards --src ./Data/val --dst ./Data/shards/val --size 256
+
+    dst/
+        meta.json           classes, format, size, number of shards
+        index.npy           one (shard, offset, length, label) record per image
+        shard_00000.bin     concatenated records
+
+    Records are either JPEG bytes ('jpeg', resized so that the shorter side is
+    `size`, or the original file bytes if size is 0) or size x size x 3 uint8
+    arrays ('raw', resized and center cropped). Shards are read through mmap:
+    ShardedImageFolder is a map-style Dataset, ShardedStream an IterableDataset
+    that splits the shards over DataLoader workers and reads every shard
+    sequentially through a shuffle buffer.
+"""
+import argparse
+import io
+import json
+import os
+import random
+from multiprocessing import Pool
+
+import numpy as np
+import torch
+import torchvision
+from PIL import Image
+
+__all__ = ['pack_image_folder', 'ShardedImageFolder', 'ShardedStream']
+
+INDEX_DTYPE = np.dtype([('shard', '<i4'), ('offset', '<i8'), ('length', '<i8'), ('label', '<i4')])
+
+
+def _encode(args):
+    path, fmt, size = args
+    if fmt == 'jpeg' and not size:
+        with open(path, 'rb') as f:
+            return f.read()
+    img = Image.open(path).convert('RGB')
+    if size:
+        img = torchvision.transforms.functional.resize(img, size)
+    if fmt == 'raw':
+        img = torchvision.transforms.functional.center_crop(img, size)
+        return np.asarray(img, dtype=np.uint8).tobytes()
+    out = io.BytesIO()
+    img.save(out, format='JPEG', quality=95)
+    return out.getvalue()
+
+
+def pack_image_folder(src, dst, fmt='jpeg', size=256, shard_mb=1024, shuffle=False,
+                      seed=0, num_workers=8):
+    """Packs an ImageFolder tree into shards.
+
+    Args:
+        src: (string) ImageFolder root
+        dst: (string) output directory
+        fmt: (string) 'jpeg' or 'raw'
+        size: (int) shorter side after resizing, 0 keeps the original JPEG bytes ('jpeg' only)
+        shard_mb: (int) approximate shard size in MB
+        shuffle: (bool) store the images in a random order, so that every shard mixes all
+            classes (recommended for the train split)
+        seed: (int) seed of the shuffle
+        num_workers: (int) decoding processes
+    """
+    if fmt not in ('jpeg', 'raw'):
+        raise ValueError('Unknown shard format {}'.format(fmt))
+    if fmt == 'raw' and not size:
+        raise ValueError('raw shards need a fixed size')
+
+    folder = torchvision.datasets.ImageFolder(src)
+    samples = list(folder.samples)
+    if shuffle:
+        random.Random(seed).shuffle(samples)
+
+    os.makedirs(dst, exist_ok=True)
+    index = np.zeros(len(samples), dtype=INDEX_DTYPE)
+    shard, offset, out = 0, 0, None
+    jobs = ((path, fmt, size) for path, _ in samples)
+    with Pool(num_workers) as pool:
+        for i, record in enumerate(pool.imap(_encode, jobs, chunksize=64)):
+            if out is None or offset >= shard_mb * 2**20:
+                if out is not None:
+                    out.close()
+                    shard += 1
+                out = open(os.path.join(dst, 'shard_%05d.bin' % shard), 'wb')
+                offset = 0
+            out.write(record)
+            index[i] = (shard, offset, len(record), samples[i][1])
+            offset += len(record)
+    if out is not None:
+        out.close()
+        shard += 1
+
+    np.save(os.path.join(dst, 'index.npy'), index)
+    meta = {'classes': folder.classes, 'format': fmt, 'size': size, 'num_shards': shard}
+    with open(os.path.join(dst, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=4)
+
+
+class _Shards():
+    """Lazily mmapped shard files of one packed split, opened separately in every worker."""
+
+    def __init__(self, root):
+        self.root = root
+        with open(os.path.join(root, 'meta.json')) as f:
+            meta = json.load(f)
+        self.classes = meta['classes']
+        self.format = meta['format']
+        self.size = meta['size']
+        self.num_shards = meta['num_shards']
+        self.index = np.load(os.path.join(root, 'index.npy'))
+        self._maps = {}
+
+    def __getstate__(self):
+        # mmaps are not shared with worker processes
+        state = self.__dict__.copy()
+        state['_maps'] = {}
+        return state
+
+    def shard(self, k):
+        if k not in self._maps:
+            self._maps[k] = np.memmap(os.path.join(self.root, 'shard_%05d.bin' % k),
+                                      dtype=np.uint8, mode='r')
+        return self._maps[k]
+
+    def image(self, record):
+        data = self.shard(int(record['shard']))[record['offset']:record['offset'] + record['length']]
+        if self.format == 'raw':
+            return Image.fromarray(np.array(data).reshape(self.size, self.size, 3))
+        return Image.open(io.BytesIO(data.tobytes())).convert('RGB')
+
+
+class ShardedImageFolder(torch.utils.data.Dataset):
+    """Map-style dataset over packed shards, a drop-in replacement for ImageFolder.
+
+    Args:
+        root: (string) a directory written by pack_image_folder
+        transform: (callable) applied to the PIL image
+    """
+
+    def __init__(self, root, transform=None):
+        self.shards = _Shards(root)
+        self.classes = self.shards.classes
+        self.targets = self.shards.index['label'].tolist()
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.shards.index)
+
+    def __getitem__(self, idx):
+        record = self.shards.index[idx]
+        img = self.shards.image(record)
+        if self.transform is not None:
+            img = self.transform(img)
+        return img, int(record['label'])
+
+
+class ShardedStream(torch.utils.data.IterableDataset):
+    """Streams packed shards sequentially, with a shuffle buffer.
+
+    Every epoch the shard order is reshuffled and the shards are dealt out
+    round-robin to the DataLoader workers (and to `num_replicas` processes),
+    so each shard file is read front to back by exactly one worker.
+
+    Args:
+        root: (string) a directory written by pack_image_folder
+        transform: (callable) applied to the PIL image
+        shuffle_buffer: (int) number of samples to shuffle over, 0 keeps the stored order
+        seed: (int) base seed of the shard order and the shuffle buffer
+        rank, num_replicas: (int) this process and the number of processes sharing the data
+    """
+
+    def __init__(self, root, transform=None, shuffle_buffer=4096, seed=0, rank=0, num_replicas=1):
+        super(ShardedStream, self).__init__()
+        self.shards = _Shards(root)
+        self.classes = self.shards.classes
+        self.transform = transform
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.rank = rank
+        self.num_replicas = num_replicas
+        self.epoch = 0
+        self._records = [np.flatnonzero(self.shards.index['shard'] == k)
+                         for k in range(self.shards.num_shards)]
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _assigned(self, rank, num_replicas):
+        order = list(range(self.shards.num_shards))
+        if self.shuffle_buffer:
+            random.Random(self.seed + self.epoch).shuffle(order)
+        return order[rank::num_replicas]
+
+    def __len__(self):
+        return sum(len(self._records[k]) for k in self._assigned(self.rank, self.num_replicas))
+
+    def __iter__(self):
+        worker = torch.utils.data.get_worker_info()
+        num_workers, worker_id = (1, 0) if worker is None else (worker.num_workers, worker.id)
+        shards = self._assigned(self.rank * num_workers + worker_id, self.num_replicas * num_workers)
+        rng = random.Random((self.seed + self.epoch) * 1000003 + self.rank * num_workers + worker_id)
+
+        buffer = []
+        for k in shards:
+            for idx in self._records[k]:
+                record = self.shards.index[idx]
+                if len(buffer) < self.shuffle_buffer:
+                    buffer.append(record)
+                    continue
+                j = rng.randrange(len(buffer))
+                buffer[j], record = record, buffer[j]
+                yield self._sample(record)
+        rng.shuffle(buffer)
+        for record in buffer:
+            yield self._sample(record)
+
+    def _sample(self, record):
+        img = self.shards.image(record)
+        if self.transform is not None:
+            img = self.transform(img)
+        return img, int(record['label'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pack an ImageFolder tree into mmap shards')
+    parser.add_argument('--src', required=True, type=str,
+                        help='Input the ImageFolder root, e.g. ./Data/train')
+    parser.add_argument('--dst', required=True, type=str,
+                        help='Input the output directory, e.g. ./Data/shards/train')
+    parser.add_argument('--format', default='jpeg', choices=['jpeg', 'raw'],
+                        help='Define the record format: default(jpeg)')
+    parser.add_argument('--size', default=256, type=int,
+                        help='Input the shorter side after resizing, 0 keeps the original JPEG: default(256)')
+    parser.add_argument('--shard_mb', default=1024, type=int,
+                        help='Input the approximate shard size in MB: default(1024)')
+    parser.add_argument('--shuffle', action='store_true',
+                        help='Decide whether or not to store the images in random order: default(False)')
+    parser.add_argument('--seed', default=0, type=int,
+                        help='Input the seed of the shuffle: default(0)')
+    parser.add_argument('--num_workers', default=8, type=int,
+                        help='Input the number of works: default(8)')
+    args = parser.parse_args()
+
+    pack_image_folder(args.src, args.dst, fmt=args.format, size=args.size, shard_mb=args.shard_mb,
+                      shuffle=args.shuffle, seed=args.seed, num_workers=args.num_workers)
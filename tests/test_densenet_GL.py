@@ -0,0 +1,89 @@
+'''
+Regression test of the densenet_GL forward against the pre-change one, which
+ran the shared last dense block once per branch and again for the leader.
+'''
+import pytest
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from models.model_cifar.densenet_GL import densenetd40k12
+
+
+class LegacyDenseNet(nn.Module):
+    """The pre-change forward on the modules of a densenet_GL, with its own query_weight/key_weight."""
+
+    def __init__(self, model):
+        super(LegacyDenseNet, self).__init__()
+        self.model = model
+        query, key = model.attention.qk.weight.detach().split(model.attention.dim, 0)
+        self.query_weight = nn.Linear(query.size(1), query.size(0), bias=False)
+        self.key_weight = nn.Linear(key.size(1), key.size(0), bias=False)
+        with torch.no_grad():
+            self.query_weight.weight.copy_(query)
+            self.key_weight.weight.copy_(key)
+
+    def forward(self, x):
+        m = self.model
+        x = m.features(x)
+        pro, proj_q, proj_k = [], [], []
+        for i in range(m.num_branches):
+            temp = getattr(m, 'Branch' + str(i))(x)
+            temp = getattr(m, 'norm_final_' + str(i))(temp)
+            temp = getattr(m, 'relu_final_' + str(i))(temp)
+            temp = m.avgpool(temp).view(temp.size(0), -1)
+            proj_q.append(self.query_weight(temp)[:, None, :])
+            proj_k.append(self.key_weight(temp)[:, None, :])
+            pro.append(getattr(m, 'classifier3_' + str(i))(temp).unsqueeze(-1))
+        pro, proj_q, proj_k = torch.cat(pro, -1), torch.cat(proj_q, 1), torch.cat(proj_k, 1)
+        attention = F.softmax(torch.bmm(proj_q, proj_k.permute(0, 2, 1)), dim=-1)
+        x_m = torch.bmm(pro, attention.permute(0, 2, 1))
+
+        temp = getattr(m, 'Branch' + str(m.num_branches - 1))(x)
+        temp = m.avgpool(temp).view(temp.size(0), -1)
+        temp_out = getattr(m, 'classifier3_' + str(m.num_branches - 1))(temp)
+        return pro, x_m, temp_out
+
+
+@pytest.mark.parametrize('train', [True, False])
+def test_outputs_match_legacy_forward(train):
+    torch.manual_seed(0)
+    model = densenetd40k12(num_classes=10, num_branches=3, input_channel=132)
+    # random BatchNorm statistics, so that eval mode does not normalize with the initial ones
+    for m in model.modules():
+        if isinstance(m, nn.BatchNorm2d):
+            m.running_mean.uniform_(-0.5, 0.5)
+            m.running_var.uniform_(0.5, 2)
+    reference = densenetd40k12(num_classes=10, num_branches=3, input_channel=132)
+    reference.load_state_dict(model.state_dict())
+    legacy = LegacyDenseNet(reference)
+    model.train(train)
+    legacy.train(train)
+
+    x = torch.randn(4, 3, 32, 32)
+    outputs, expected = model(x), legacy(x)
+    for out, ref in zip(outputs, expected):
+        assert out.shape == ref.shape
+        assert torch.allclose(out, ref, rtol=1e-5, atol=1e-6)
+
+    # the block gets the gradients of all the branches and the leader, as when it ran once per branch
+    sum(o.sum() for o in outputs).backward()
+    sum(o.sum() for o in expected).backward()
+    block, ref_block = model.Branch0.denselayer1.conv1.weight, reference.Branch0.denselayer1.conv1.weight
+    assert torch.allclose(block.grad, ref_block.grad, rtol=1e-4, atol=1e-5)
+
+
+def test_branch_parallel_path_matches_forward():
+    torch.manual_seed(0)
+    model = densenetd40k12(num_classes=10, num_branches=4, input_channel=132).eval()
+    x = torch.randn(4, 3, 32, 32)
+    with torch.no_grad():
+        expected = model(x)
+        trunk = model.trunk(x)
+        outputs = model.head(*model.branches(trunk, range(4)))
+        # the ranks without the leader contribute zeros, the last rank the leader logits
+        halves = [model.branches(trunk, indices) for indices in (range(2), range(2, 4))]
+        gathered = model.head(*[torch.cat(parts, 1) for parts in zip(*halves)])
+    for out, split, ref in zip(outputs, gathered, expected):
+        assert torch.equal(out, ref)
+        assert torch.equal(split, ref)
@@ -0,0 +1,83 @@
+'''
+Regression test of the branch-batched GL loss against the per-branch loops
+of the former train_GL.py, for the three GL model families.
+'''
+import argparse
+
+import pytest
+import torch
+import torch.nn as nn
+
+import engine
+import utils
+from models.model_cifar import resnet_GL, vgg_GL, densenet_GL
+
+NUM_BRANCHES = 4
+
+
+def build(model):
+    if "resnet" in model:
+        return resnet_GL.resnet32(num_classes=10, num_branches=NUM_BRANCHES, input_channel=utils.lookup(model))
+    elif "vgg" in model:
+        return vgg_GL.vgg16(num_classes=10, num_branches=NUM_BRANCHES)
+    return densenet_GL.densenetd40k12(num_classes=10, num_branches=NUM_BRANCHES, input_channel=utils.lookup(model))
+
+
+def legacy_losses(output_batch, x_m, x_stu, labels, criterion, criterion_T, alpha):
+    # the loops of train_GL.py before the engine, only the first num_branches - 1 columns are peers
+    loss_true = 0
+    loss_group = 0
+    for i in range(NUM_BRANCHES - 1):
+        loss_true += criterion(output_batch[:, :, i], labels)
+        loss_group += criterion_T(output_batch[:, :, i], x_m[:, :, i])
+    loss = loss_true + criterion(x_stu, labels) + alpha * (
+        loss_group + criterion_T(x_stu, torch.mean(output_batch, dim=2)))
+    return loss, loss_true, loss_group
+
+
+@pytest.mark.parametrize('model', ['resnet32', 'vgg16', 'densenetd40k12'])
+def test_gl_loss_matches_legacy_loops(model):
+    torch.manual_seed(0)
+    args = argparse.Namespace(num_branches=NUM_BRANCHES, loss='KL', temperature=3.0, alpha=1.0)
+    strategy = engine.GL(args)
+    net = build(model).eval()
+    images, labels = torch.randn(4, 3, 32, 32), torch.randint(10, (4,))
+
+    with torch.no_grad():
+        loss, logs = strategy.forward(net, (images, labels), training=True)
+        expected = legacy_losses(*net(images), labels, nn.CrossEntropyLoss(),
+                                 utils.KL_Loss(args.temperature), args.alpha)
+    for name, value in zip(('loss', 'true_loss', 'group_loss'), expected):
+        assert torch.allclose(logs[name].reshape(()), value.reshape(()), rtol=1e-5, atol=1e-6), name
+
+
+@pytest.mark.parametrize('model', ['resnet32', 'vgg16', 'densenetd40k12'])
+def test_gl_metrics_read_the_leader_and_ensemble(model):
+    torch.manual_seed(0)
+    args = argparse.Namespace(num_branches=NUM_BRANCHES, loss='KL', temperature=3.0, alpha=1.0)
+    strategy = engine.GL(args)
+    net = build(model).eval()
+    images, labels = torch.randn(8, 3, 32, 32), torch.randint(10, (8,))
+
+    with torch.no_grad():
+        _, logs = strategy.forward(net, (images, labels), training=False)
+        output_batch, _, x_stu = net(images)
+    metrics = strategy.metrics(logs, 'test')
+    stu = utils.accuracy(x_stu, labels, topk=(1, 5))
+    ensemble = utils.accuracy(torch.mean(output_batch, dim=2), labels, topk=(1, 5))
+    assert len(logs['accTop1']) == NUM_BRANCHES + 1
+    assert float(metrics['stu_test_accTop1']) == pytest.approx(float(stu[0]))
+    assert float(metrics['stu_test_accTop5']) == pytest.approx(float(stu[1]))
+    assert float(metrics['test_accTop1']) == pytest.approx(float(ensemble[0]))
+
+
+def test_gl_diversity_only_covers_the_peers():
+    torch.manual_seed(0)
+    args = argparse.Namespace(num_branches=NUM_BRANCHES, loss='KL', temperature=3.0, alpha=1.0)
+    net = build('densenetd40k12').eval()
+    images, labels = torch.randn(4, 3, 32, 32), torch.randint(10, (4,))
+    with torch.no_grad():
+        _, logs = engine.GL(args).forward(net, (images, labels), training=False)
+        output_batch = net(images)[0]
+    expected = utils.branch_diversity(output_batch[:, :, :NUM_BRANCHES - 1]).mean()
+    assert torch.allclose(logs['dist'], expected)
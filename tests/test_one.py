@@ -0,0 +1,36 @@
+'''
+Regression test of the closed-form ONE / CL-ILR targets of the CIFAR ONE
+models against the per-branch loops they replaced.
+'''
+import pytest
+import torch
+import torch.nn.functional as F
+
+from benchmark_targets import loop_peer_mean, loop_gated_ensemble
+from models.model_cifar import resnet_one, vgg_one, densenet_one
+
+MODELS = [(resnet_one, 'resnet32'), (resnet_one, 'resnet110'), (resnet_one, 'wide_resnet20_8'),
+          (vgg_one, 'vgg16'), (densenet_one, 'densenetd40k12')]
+
+
+@pytest.mark.parametrize('family, name', MODELS)
+def test_one_target_matches_legacy_loop(family, name):
+    torch.manual_seed(0)
+    model = getattr(family, name)(num_classes=10, num_branches=3).eval()
+    gate = []
+    # the gate is softmax(relu(bn_v1(...))), see the ONE branch of forward
+    model.bn_v1.register_forward_hook(lambda m, args, out: gate.append(F.softmax(F.relu(out), dim=1)))
+    with torch.no_grad():
+        pro, x_m = model(torch.randn(2, 3, 32, 32))
+    assert x_m.shape == (2, 10)
+    assert torch.allclose(x_m, loop_gated_ensemble(pro, gate[0]), rtol=1e-5, atol=1e-6)
+
+
+@pytest.mark.parametrize('family, name', MODELS)
+def test_cl_ilr_target_matches_legacy_loop(family, name):
+    torch.manual_seed(0)
+    model = getattr(family, name)(num_classes=10, num_branches=3, avg=True).eval()
+    with torch.no_grad():
+        pro, x_m = model(torch.randn(2, 3, 32, 32))
+    assert x_m.shape == pro.shape
+    assert torch.allclose(x_m, loop_peer_mean(pro), rtol=1e-5, atol=1e-6)
@@ -1,6 +1,10 @@
 import json
 import logging
+import os
+from collections import OrderedDict
+import numpy as np
 import torch
+import torch.distributed as dist
 import torch.nn as nn
 import torch.nn.functional as F
 
@@ -29,7 +33,59 @@ class RunningAverage():
         return self.total/float(self.steps)
 
 
-def set_logger(log_path):
+class MetricAccumulator():
+    """A running average that stays on the device of the values it is fed
+
+    update() only queues an addition on the device, so feeding it a loss or an
+    accuracy tensor does not wait for the GPU the way `.item()` does. The host
+    synchronizes once, when value() is called (at the end of an epoch or every
+    `log_interval` steps).
+
+    A vector value (e.g. the accuracy of every branch) is averaged element-wise
+    and value() then returns a list.
+
+    Example:
+    ```
+    loss_avg = MetricAccumulator()
+    loss_avg.update(loss)       # no host-device synchronization
+    loss_avg.value()            # one synchronization
+    ```
+    """
+
+    def __init__(self):
+        self.steps = 0
+        self.total = 0
+
+    def update(self, val, n=1):
+        # val -> the mean of n samples
+        if torch.is_tensor(val):
+            val = val.detach().double()
+        self.total = self.total + val * n
+        self.steps += n
+
+    def all_reduce(self):
+        """Sums the totals and counts of all processes (torch.distributed), call it on every rank."""
+        if not (dist.is_available() and dist.is_initialized()):
+            return
+        total = self.total
+        if not torch.is_tensor(total):
+            device = 'cuda' if dist.get_backend() == 'nccl' else 'cpu'
+            total = torch.tensor(float(total), dtype=torch.float64, device=device)
+        buffer = torch.cat([total.reshape(-1), total.new_tensor([self.steps])])
+        dist.all_reduce(buffer)
+        self.total = buffer[:-1].view_as(total)
+        self.steps = int(buffer[-1].item())
+
+    def value(self):
+        total = self.total
+        if torch.is_tensor(total):
+            if total.numel() > 1:
+                return [v/float(self.steps) for v in total.tolist()]
+            total = total.item()
+        return total/float(self.steps)
+
+
+def set_logger(log_path, console=True):
     """Set the logger to log info in terminal and file `log_path`.
 
     In general, it is useful to have a logger so that every output to the terminal is saved
@@ -42,6 +98,7 @@ def set_logger(log_path):
 
     Args:
         log_path: (string) where to log
+        console: (bool) also log to the terminal
     """
     logger = logging.getLogger()
     logger.setLevel(logging.INFO)
@@ -54,9 +111,10 @@ def set_logger(log_path):
         logger.addHandler(file_handler)
 
         # Logging to console
-        stream_handler = logging.StreamHandler()
-        stream_handler.setFormatter(logging.Formatter('%(message)s'))
-        logger.addHandler(stream_handler)
+        if console:
+            stream_handler = logging.StreamHandler()
+            stream_handler.setFormatter(logging.Formatter('%(message)s'))
+            logger.addHandler(stream_handler)
 
 
 def save_dict_to_json(d, json_path):
@@ -99,6 +157,203 @@ def accuracy(output, target, topk=(1,)):
     return res
 
 
+def branch_accuracy(output, target, topk=(1,), extra=None):
+    """Computes the precision@k of every branch with a single topk
+
+    Args:
+        output: (Tensor) B x num_classes x num_branches logits
+        target: (Tensor) B labels
+        topk: (tuple) the values of k
+        extra: (list of Tensor) optional B x num_classes heads (e.g. leader, ensemble)
+            evaluated as additional branches after the last one
+
+    Returns:
+        (list of Tensor) one (num_branches + len(extra)) tensor per k
+    """
+    if extra:
+        output = torch.cat([output] + [head.unsqueeze(-1) for head in extra], dim=-1)
+    maxk = max(topk)
+    batch_size = target.size(0)
+
+    _, pred = output.topk(maxk, dim=1, largest=True, sorted=True)      # B x maxk x heads
+    correct = pred.eq(target.view(-1, 1, 1))
+
+    res = []
+    for k in topk:
+        correct_k = correct[:, :k].float().sum((0, 1))
+        res.append(correct_k.mul_(100.0 / batch_size))
+    return res
+
+
+def branch_diversity(output_batch):
+    """Mean pairwise L2 distance between the softmax outputs of the branches
+
+    Args:
+        output_batch: (Tensor) B x num_classes x num_branches logits
+
+    Returns:
+        (Tensor) B distances, each averaged over the num_branches*(num_branches-1)/2 pairs
+    """
+    num_branches = output_batch.size(-1)
+    if num_branches < 2:
+        return output_batch.new_zeros(output_batch.size(0))
+    probs = F.softmax(output_batch.float(), dim=1).transpose(1, 2)         # B x num_branches x num_classes
+    dist = torch.cdist(probs, probs)                               # B x num_branches x num_branches
+    # every pair is counted twice and the diagonal is zero
+    return dist.sum((1, 2)) / (num_branches * (num_branches - 1))
+
+
+def branch_cross_entropy(output_batch, labels_batch):
+    """Cross entropy of every branch against the hard labels in one call.
+
+    Args:
+        output_batch: (Tensor) B x num_classes x num_branches logits
+        labels_batch: (Tensor) B labels
+
+    Returns:
+        (Tensor) num_branches losses, each equal to nn.CrossEntropyLoss()(output_batch[:, :, i], labels_batch)
+    """
+    labels_batch = labels_batch.unsqueeze(1).expand(-1, output_batch.size(-1))
+    return F.cross_entropy(output_batch.float(), labels_batch, reduction='none').mean(0)
+
+
+def branch_cost(model, input_size=(1, 3, 32, 32)):
+    """Counts the multiply-accumulates of one forward pass per top-level child
+
+    Every call of a child is charged, so a branch that runs twice shows up
+    twice. Children registered under several names (e.g. shared Branch{i}
+    blocks) are charged to those names in call order.
+
+    Args:
+        model: (nn.Module) the network to profile
+        input_size: (tuple) shape of the random input
+    """
+    names = OrderedDict()
+    for name, child in model._modules.items():
+        names.setdefault(id(child), []).append(name)
+    costs = OrderedDict((name, 0) for name in model._modules)
+    calls = {}
+    scope = []
+
+    def enter(module, inputs):
+        aliases = names[id(module)]
+        k = calls.get(id(module), 0)
+        calls[id(module)] = k + 1
+        scope.append(aliases[k % len(aliases)])
+
+    def leave(module, inputs, output):
+        scope.pop()
+
+    def count(module, inputs, output):
+        if isinstance(module, nn.Conv2d):
+            kernel = module.kernel_size[0] * module.kernel_size[1]
+            macs = output.numel() * kernel * module.in_channels // module.groups
+        else:
+            macs = output.numel() * module.in_features
+        key = scope[-1] if scope else 'other'
+        costs[key] = costs.get(key, 0) + macs
+
+    handles = []
+    for m in model.modules():
+        if isinstance(m, (nn.Conv2d, nn.Linear)):
+            handles.append(m.register_forward_hook(count))
+    for child in {id(c): c for c in model._modules.values()}.values():
+        handles.append(child.register_forward_pre_hook(enter))
+        handles.append(child.register_forward_hook(leave))
+
+    training = model.training
+    model.eval()
+    param = next(model.parameters())
+    with torch.no_grad():
+        model(torch.randn(*input_size, device=param.device, dtype=param.dtype))
+    model.train(training)
+    for h in handles:
+        h.remove()
+    return costs
+
+
+class TeacherCache():
+    """Memory-mapped cache of frozen-teacher logits, keyed by (sample index, augmentation key)
+
+    The teacher only runs on the samples of a batch whose (index, key) pair has
+    not been seen before; all other logits are read back from `path`. The keys
+    come from data_loader.TensorLoader(with_keys=True); with augmentation replay
+    there are only `replay` keys per sample, so the teacher runs at most
+    `replay` times per sample over the whole training. Logits are stored as
+    float16, or with topk > 0 as the top-k logits plus the mean of the
+    remaining ones, which fills all the other classes on reconstruction.
+
+    Example:
+    ```
+    cache = TeacherCache(path, len(train_set), train_loader.num_keys, num_classes)
+    teacher_outputs = cache(model_T, train_batch, index, keys)
+    ```
+
+    Args:
+        path: (string) directory of the cache files, reused when its layout matches
+        num_samples: (int) number of training samples
+        num_keys: (int) augmentation keys per sample
+        num_classes: (int) number of logits
+        topk: (int) store only the top-k logits, 0 stores all of them
+    """
+
+    def __init__(self, path, num_samples, num_keys, num_classes, topk=0):
+        self.num_classes = num_classes
+        self.topk = topk
+        width = topk + 1 if topk else num_classes
+        layout = {'num_samples': num_samples, 'num_keys': num_keys,
+                  'num_classes': num_classes, 'topk': topk}
+
+        meta_path = os.path.join(path, 'cache.json')
+        reuse = os.path.exists(meta_path) and load_json_to_dict(meta_path) == layout
+        mode = 'r+' if reuse else 'w+'
+        os.makedirs(path, exist_ok=True)
+
+        def array(name, dtype, shape):
+            return np.lib.format.open_memmap(os.path.join(path, name + '.npy'), mode=mode,
+                                             dtype=dtype, shape=None if reuse else shape)
+        self.filled = array('filled', np.bool_, (num_samples, num_keys))
+        self.values = array('values', np.float16, (num_samples, num_keys, width))
+        if topk:
+            self.indices = array('indices', np.int16 if num_classes < 2**15 else np.int32,
+                                 (num_samples, num_keys, topk))
+        if not reuse:
+            save_dict_to_json(layout, meta_path)
+
+    def _store(self, index, keys, logits):
+        logits = logits.float()
+        if self.topk:
+            top, indices = logits.topk(self.topk, dim=1)
+            rest = (logits.sum(1, keepdim=True) - top.sum(1, keepdim=True)) / (self.num_classes - self.topk)
+            self.indices[index, keys] = indices.cpu().numpy()
+            logits = torch.cat([top, rest], 1)
+        self.values[index, keys] = logits.cpu().numpy()
+        self.filled[index, keys] = True
+
+    def _load(self, index, keys, device):
+        values = torch.from_numpy(self.values[index, keys]).to(device).float()
+        if not self.topk:
+            return values
+        indices = torch.from_numpy(self.indices[index, keys].astype(np.int64)).to(device)
+        logits = values[:, -1:].repeat(1, self.num_classes)
+        return logits.scatter_(1, indices, values[:, :-1])
+
+    def __call__(self, model_T, images, index, keys):
+        # index, keys -> B CPU tensors from TensorLoader(with_keys=True)
+        index, keys = index.numpy(), keys.numpy()
+        missing = np.flatnonzero(~self.filled[index, keys])
+        if missing.size:
+            with torch.no_grad():
+                missing_t = torch.from_numpy(missing).to(images.device)
+                self._store(index[missing], keys[missing], model_T(images[missing_t]))
+        return self._load(index, keys, images.device)
+
+    def flush(self):
+        for array in (self.filled, self.values, getattr(self, 'indices', None)):
+            if array is not None:
+                array.flush()
+
+
 class kd_loss_fn(nn.Module):
     def __init__(self, num_classes, args):
         super(kd_loss_fn, self).__init__()
@@ -119,8 +374,9 @@ class kd_loss_fn(nn.Module):
         # teacher_outputs = (teacher_outputs - torch.mean(teacher_outputs, dim=1).view(-1,1))/100.0
         # output_batch = (output_batch - torch.mean(output_batch, dim=1).view(-1,1))/100.0
 
-        teacher_outputs = F.softmax(teacher_outputs/self.T, dim=1)
-        output_batch = F.log_softmax(output_batch/self.T, dim=1)
+        # softmax at temperature in float32, also under autocast
+        teacher_outputs = F.softmax(teacher_outputs.float()/self.T, dim=1)
+        output_batch = F.log_softmax(output_batch.float()/self.T, dim=1)
 
         #CE_teacher = -torch.sum(torch.sum(torch.mul(teacher_outputs,output_batch)))/teacher_outputs.size(0)
         # CE_teacher.requires_grad_(True)
@@ -143,6 +399,8 @@ class Att_Loss(nn.Module):
         # teacher_outputs -> B X num_classes
 
         batch_size, num_classes, num_student = output_batch.size()
+        # softmax at temperature in float32, also under autocast
+        output_batch, attention = output_batch.float(), attention.float()
         # B X num_student
         labels_batch = labels_batch.view(-1, 1).repeat(1, num_student)
         loss_true = nn.CrossEntropyLoss()(output_batch, labels_batch) * num_student
@@ -181,13 +439,31 @@ class KL_Loss(nn.Module):
         super(KL_Loss, self).__init__()
         self.T = temperature
 
+    def branch_losses(self, output_batch, teacher_outputs):
+        # output_batch  -> B X num_classes X num_branches
+        # teacher_outputs -> B X num_classes X num_branches, or B X num_classes shared by all branches
+        # returns num_branches losses, the i-th equal to forward(output_batch[:, :, i], teacher_outputs[:, :, i])
+        if teacher_outputs.dim() == 2:
+            teacher_outputs = teacher_outputs.unsqueeze(-1)
+        # softmax at temperature in float32, also under autocast
+        output_batch, teacher_outputs = output_batch.float(), teacher_outputs.float()
+        output_batch = F.log_softmax(output_batch/self.T, dim=1)
+        teacher_outputs = F.softmax(teacher_outputs/self.T, dim=1) + 10**(-7)
+
+        loss = torch.sum(teacher_outputs * (torch.log(teacher_outputs) - output_batch), dim=(0, 1))
+        return self.T * self.T * loss / output_batch.size(0)
+
     def forward(self, output_batch, teacher_outputs):
         # output_batch  -> B X num_classes
         # teacher_outputs -> B X num_classes
+        # B X num_classes X num_branches inputs return the sum over branches
+        if output_batch.dim() == 3:
+            return self.branch_losses(output_batch, teacher_outputs).sum()
 
         # loss_2 = -torch.sum(torch.sum(torch.mul(F.log_softmax(teacher_outputs,dim=1), F.softmax(teacher_outputs,dim=1)+10**(-7))))/teacher_outputs.size(0)
         # print('loss H:',loss_2)
 
+        output_batch, teacher_outputs = output_batch.float(), teacher_outputs.float()
         output_batch = F.log_softmax(output_batch/self.T, dim=1)
         teacher_outputs = F.softmax(teacher_outputs/self.T, dim=1) + 10**(-7)
 
@@ -204,11 +480,29 @@ class CE_Loss(nn.Module):
         super(CE_Loss, self).__init__()
         self.T = temperature
 
+    def branch_losses(self, output_batch, teacher_outputs):
+        # output_batch  -> B X num_classes X num_branches
+        # teacher_outputs -> B X num_classes X num_branches, or B X num_classes shared by all branches
+        # returns num_branches losses, the i-th equal to forward(output_batch[:, :, i], teacher_outputs[:, :, i])
+        if teacher_outputs.dim() == 2:
+            teacher_outputs = teacher_outputs.unsqueeze(-1)
+        # softmax at temperature in float32, also under autocast
+        output_batch, teacher_outputs = output_batch.float(), teacher_outputs.float()
+        output_batch = F.log_softmax(output_batch/self.T, dim=1)
+        teacher_outputs = F.softmax(teacher_outputs/self.T, dim=1)
+
+        loss = -torch.sum(output_batch * teacher_outputs, dim=(0, 1))
+        return self.T * self.T * loss / output_batch.size(0)
+
     def forward(self, output_batch, teacher_outputs):
 
         # output_batch      -> B X num_classes
         # teacher_outputs   -> B X num_classes
+        # B X num_classes X num_branches inputs return the sum over branches
+        if output_batch.dim() == 3:
+            return self.branch_losses(output_batch, teacher_outputs).sum()
 
+        output_batch, teacher_outputs = output_batch.float(), teacher_outputs.float()
         output_batch = F.log_softmax(output_batch/self.T, dim=1)
         teacher_outputs = F.softmax(teacher_outputs/self.T, dim=1)
 
@@ -220,6 +514,59 @@ class CE_Loss(nn.Module):
         return loss
 
 
+class Mutual_Loss(nn.Module):
+    """Mutual-learning loss of all branches at once (DML).
+
+    Equal to the sum of KL_Loss / CE_Loss over the branch pairs, but the
+    softmax / log_softmax of every branch is computed only once.
+
+    Args:
+        temperature: (float) softening temperature
+        loss: (str) 'KL' or 'CE'
+        pairwise: (bool) True  -> 1/(N-1) * sum_{j != k} loss(branch_j, branch_k)
+                         False -> sum_j loss(branch_j, mean of the other branches)
+    """
+
+    def __init__(self, temperature=1, loss='KL', pairwise=True):
+        super(Mutual_Loss, self).__init__()
+        if loss not in ('KL', 'CE'):
+            raise ValueError('Mutual_Loss supports KL or CE, got {}'.format(loss))
+        self.T = temperature
+        self.loss = loss
+        self.pairwise = pairwise
+
+    def forward(self, output_batch):
+        # output_batch  -> B X num_classes X num_branches
+        batch_size, num_branches = output_batch.size(0), output_batch.size(-1)
+        # softmax at temperature in float32, also under autocast
+        output_batch = output_batch.float()
+        log_probs = F.log_softmax(output_batch/self.T, dim=1)
+
+        if self.pairwise:
+            probs = F.softmax(output_batch/self.T, dim=1)
+            if self.loss == 'KL':
+                probs = probs + 10**(-7)
+            # sum_{k != j} p_k for every branch j
+            peer_probs = probs.sum(-1, keepdim=True) - probs
+            loss = -torch.sum(peer_probs * log_probs)
+            if self.loss == 'KL':
+                # every branch is the teacher of the N-1 others
+                loss = loss + (num_branches - 1) * torch.sum(probs * torch.log(probs))
+            loss = loss / (num_branches - 1)
+        # ensemble first
+        else:
+            peer_logits = (output_batch.sum(-1, keepdim=True) -
+                           output_batch) / (num_branches - 1)
+            probs = F.softmax(peer_logits/self.T, dim=1)
+            if self.loss == 'KL':
+                probs = probs + 10**(-7)
+                loss = torch.sum(probs * (torch.log(probs) - log_probs))
+            else:
+                loss = -torch.sum(probs * log_probs)
+
+        return self.T * self.T * loss / batch_size
+
+
 class MSE_Loss(nn.Module):
     def __init__(self):
         super(MSE_Loss, self).__init__()
@@ -230,8 +577,8 @@ class MSE_Loss(nn.Module):
         # teacher_outputs   -> B X num_classes
 
         batch_size = output_batch.size(0)
-        output_batch = F.softmax(output_batch, dim=1)
-        teacher_outputs = F.softmax(teacher_outputs, dim=1)
+        output_batch = F.softmax(output_batch.float(), dim=1)
+        teacher_outputs = F.softmax(teacher_outputs.float(), dim=1)
         # Same result MSE-loss implementation torch.sum -> sum of all element
         loss = torch.sum((output_batch - teacher_outputs) ** 2) / batch_size
 
@@ -248,7 +595,7 @@ class E_Loss(nn.Module):
         # output_batch      -> B X num_classes
         # teacher_outputs   -> B X num_classes
 
-        output_batch = F.log_softmax(output_batch/self.T, dim=1)
+        output_batch = F.log_softmax(output_batch.float()/self.T, dim=1)
         self_outputs = F.softmax(output_batch/self.T, dim=1)
 
         # Same result CE-loss implementation torch.sum -> sum of all element